@@ -0,0 +1,6 @@
+'''
+Benchmarks for the SINTEF harvesters. Each module can be run on its own,
+e.g.::
+
+    python -m ckanext.sintef.benchmarks.gather_memory --records 100000
+'''
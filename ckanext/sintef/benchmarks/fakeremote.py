@@ -0,0 +1,336 @@
+'''
+Local fake of the Geonorge and Data Norge APIs, for load tests.
+
+The fake serves a synthetic catalogue of any size. Each record is made
+from its index when it is asked for, so a catalogue of a million datasets
+takes no memory. The remote can be made slow and unreliable:
+
+    latency          Mean seconds before each response is sent.
+    distribution     How the latency is drawn: 'fixed', 'uniform' between
+                     0 and twice the mean, or 'exponential'.
+    error_rate       Share of the requests answered with HTTP 500.
+    duplicate_rate   Share of the search pages that start one record early,
+                     so the last record of the page before is sent again,
+                     like a catalogue that changes while it is paged
+                     through.
+    body_rate        Bytes per second the bodies of responses are sent at,
+                     or 0 to send them at once.
+
+Geonorge is served at /api/search/ and /api/getdata/{uuid}, Data Norge at
+/api/dcat/data.json.
+
+Usage::
+
+    python -m ckanext.sintef.benchmarks.fakeremote [--kind geonorge|datanorge] [--records N] [--port N] [--latency S] [--distribution D] [--error-rate F] [--duplicate-rate F] [--body-rate B]
+'''
+import cgi
+import time
+import random
+import urlparse
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.benchmarks.synthetic import (geonorge_search_result,
+                                                 datanorge_dataset)
+
+# Datasets on a page of the Data Norge catalogue
+DATANORGE_PAGE_SIZE = 100
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'exponential')
+
+
+class Scenario(object):
+    '''
+    The catalogue and behaviour of a fake remote, see the module docstring.
+    '''
+
+    def __init__(self, kind='geonorge', records=10000, latency=0.0,
+                 distribution='fixed', error_rate=0.0, duplicate_rate=0.0,
+                 body_rate=0, seed=0):
+        if kind not in ('geonorge', 'datanorge'):
+            raise ValueError('Unknown kind of remote: %s' % kind)
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError('Unknown latency distribution: %s' %
+                             distribution)
+        self.kind = kind
+        self.records = records
+        self.latency = latency
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.duplicate_rate = duplicate_rate
+        self.body_rate = body_rate
+        self.seed = seed
+
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class FakeCatalogue(object):
+    '''
+    The synthetic records of a fake remote. The same index always gives the
+    same record.
+    '''
+
+    def __init__(self, kind, size, seed=0):
+        self.kind = kind
+        self.size = size
+        self.seed = seed
+
+
+    def record(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        if self.kind == 'geonorge':
+            return geonorge_search_result(index, rng)
+        return datanorge_dataset(index, rng)
+
+
+    def modified(self, index):
+        '''
+        Returns the last modified date of a record, as in the record.
+        '''
+        if self.kind == 'datanorge':
+            return self.record(index)[u'modified']
+        return u'2016-%02d-%02dT12:00:00' % (index % 12 + 1, index % 28 + 1)
+
+
+class FakeRemoteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server of a fake remote. 'stats' counts what it has served.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, scenario, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeRemoteHandler)
+        self.scenario = scenario
+        self.catalogue = FakeCatalogue(scenario.kind, scenario.records,
+                                       scenario.seed)
+        self._rng = random.Random(scenario.seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors_injected': 0,
+                      'duplicates_injected': 0, 'bytes_sent': 0,
+                      'records_sent': 0}
+
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+
+    def count(self, **counts):
+        self._lock.acquire()
+        try:
+            for key, value in counts.items():
+                self.stats[key] += value
+        finally:
+            self._lock.release()
+
+
+    def draw(self):
+        '''
+        Returns the latency of a response, whether it fails and whether the
+        page starts one record early.
+        '''
+        scenario = self.scenario
+        self._lock.acquire()
+        try:
+            if scenario.distribution == 'uniform':
+                latency = self._rng.uniform(0, 2 * scenario.latency)
+            elif scenario.distribution == 'exponential' and scenario.latency:
+                latency = self._rng.expovariate(1.0 / scenario.latency)
+            else:
+                latency = scenario.latency
+            fail = self._rng.random() < scenario.error_rate
+            shift = self._rng.random() < scenario.duplicate_rate
+        finally:
+            self._lock.release()
+        return latency, fail, shift
+
+
+    def snapshot(self):
+        self._lock.acquire()
+        try:
+            return dict(self.stats)
+        finally:
+            self._lock.release()
+
+
+class FakeRemoteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        server = self.server
+        latency, fail, shift = server.draw()
+        server.count(requests=1)
+        if latency:
+            time.sleep(latency)
+        if fail:
+            server.count(errors_injected=1)
+            self._send(500, '{"error": "Injected error"}')
+            return
+
+        url = urlparse.urlparse(self.path)
+        params = dict((key, values[-1]) for key, values
+                      in cgi.parse_qs(url.query).items())
+        catalogue = server.catalogue
+        if catalogue.kind == 'geonorge' and url.path.startswith('/api/search'):
+            body, records = self._geonorge_search(params, shift)
+        elif catalogue.kind == 'geonorge' and \
+                url.path.startswith('/api/getdata/'):
+            body, records = self._geonorge_getdata(url.path.split('/')[-1])
+        elif catalogue.kind == 'datanorge' and \
+                url.path.startswith('/api/dcat/data.json'):
+            body, records = self._datanorge_page(params, shift)
+        else:
+            body, records = None, 0
+        if body is None:
+            self._send(404, '{"error": "Not found"}')
+            return
+        server.count(records_sent=records)
+        self._send(200, body)
+
+
+    def _page(self, start, stop, shift):
+        # Start one record early, as if a record was added in front
+        if shift and start > 0:
+            self.server.count(duplicates_injected=1)
+            start -= 1
+            stop -= 1
+        catalogue = self.server.catalogue
+        return [catalogue.record(index)
+                for index in xrange(start, min(stop, catalogue.size))]
+
+
+    def _geonorge_search(self, params, shift):
+        offset = max(int(params.get('offset', 1)), 1)
+        limit = max(int(params.get('limit', 10)), 0)
+        results = self._page(offset - 1, offset - 1 + limit, shift)
+        return json.dumps({'NumFound': self.server.catalogue.size,
+                           'Results': results}), len(results)
+
+
+    def _geonorge_getdata(self, uuid):
+        catalogue = self.server.catalogue
+        try:
+            index = int(uuid.split('-')[0], 16)
+        except ValueError:
+            return None, 0
+        if index >= catalogue.size:
+            return None, 0
+        return json.dumps({'Uuid': uuid,
+                           'DateMetadataUpdated': catalogue.modified(index)}), 1
+
+
+    def _datanorge_page(self, params, shift):
+        page = max(int(params.get('page', 1)), 1)
+        start = (page - 1) * DATANORGE_PAGE_SIZE
+        datasets = self._page(start, start + DATANORGE_PAGE_SIZE, shift)
+        since = params.get('modified_since')
+        if since:
+            datasets = [dataset for dataset in datasets
+                        if dataset[u'modified'] >= since]
+        return json.dumps({'total': self.server.catalogue.size,
+                           'datasets': datasets}), len(datasets)
+
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        rate = self.server.scenario.body_rate
+        if not rate:
+            self.wfile.write(body)
+        else:
+            # Ten writes per second at the given rate
+            chunk_size = max(rate // 10, 1)
+            for start in xrange(0, len(body), chunk_size):
+                chunk = body[start:start + chunk_size]
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                time.sleep(len(chunk) / float(rate))
+        self.server.count(bytes_sent=len(body))
+
+
+def start_fake_remote(scenario, port=0):
+    '''
+    Starts a fake remote in a background thread.
+
+    :param scenario: Scenario of the remote.
+    :param port: Port to listen on, or 0 for any free port.
+    :returns: The FakeRemoteServer. Call shutdown() to stop it.
+    '''
+    server = FakeRemoteServer(scenario, port)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='sintef-fake-remote')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_scenario_options(parser):
+    '''
+    Adds the options of a Scenario to an optparse parser.
+    '''
+    parser.add_option('--records', type='int', default=10000,
+                      help='Number of datasets in the catalogue '
+                           '[default: %default]')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Mean seconds before each response '
+                           '[default: %default]')
+    parser.add_option('--distribution', default='fixed',
+                      help='Distribution of the latency: %s [default: '
+                           '%%default]' % ', '.join(DISTRIBUTIONS))
+    parser.add_option('--error-rate', dest='error_rate', type='float',
+                      default=0.0,
+                      help='Share of requests answered with HTTP 500 '
+                           '[default: %default]')
+    parser.add_option('--duplicate-rate', dest='duplicate_rate',
+                      type='float', default=0.0,
+                      help='Share of pages that repeat the last record of the '
+                           'page before [default: %default]')
+    parser.add_option('--body-rate', dest='body_rate', type='int', default=0,
+                      help='Bytes per second bodies are sent at, 0 for no '
+                           'limit [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the random generators [default: %default]')
+
+
+def scenario_from_options(kind, options):
+    return Scenario(kind, options.records, options.latency,
+                    options.distribution, options.error_rate,
+                    options.duplicate_rate, options.body_rate, options.seed)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--kind', default='geonorge',
+                      help='geonorge or datanorge [default: %default]')
+    parser.add_option('--port', type='int', default=8765,
+                      help='Port to listen on [default: %default]')
+    add_scenario_options(parser)
+    options, args = parser.parse_args(args)
+
+    server = FakeRemoteServer(scenario_from_options(options.kind, options),
+                              options.port)
+    print 'Fake %s with %s datasets at %s' % (options.kind, options.records,
+                                              server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print json.dumps(server.snapshot(), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''
+Compares the memory used by the gather stage to hold the datasets of a
+remote catalogue, before and after HarvestObjects are made of them.
+
+The old representation is a list of decoded dictionaries plus a set of the
+identifiers, and one JSON string per dataset for HarvestObject.content. The
+new representation is a list of GatherRecords plus an IdSet, where the JSON
+string of each record is used as HarvestObject.content as is.
+
+The datasets are synthetic, or read from a snapshot file made with
+"paster sintef snapshot-export".
+
+Usage::
+
+    python -m ckanext.sintef.benchmarks.gather_memory [--records N] [--snapshot PATH]
+'''
+import sys
+import random
+import optparse
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.benchmarks.synthetic import (geonorge_search_result,
+                                                 datanorge_dataset)
+from ckanext.sintef.harvesters.records import GatherRecord, IdSet
+from ckanext.sintef.harvesters.snapshot import SnapshotReader
+
+
+def deep_sizeof(obj, seen=None):
+    '''
+    Returns the number of bytes used by 'obj' and everything it refers to,
+    counting shared objects once.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, '__slots__'):
+        for slot in obj.__slots__:
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def measure(pkg_dicts, guid_key, title_key, modified_key=None):
+    '''
+    Returns the number of bytes used by the old and the new representation
+    of 'pkg_dicts', at the point where every HarvestObject has been made.
+    '''
+    # The content of the pages is decoded with the json module, so the
+    # dictionaries are made the same way here.
+    decoded = json.loads(json.dumps(pkg_dicts))
+
+    ids = set(pkg_dict[guid_key] for pkg_dict in decoded)
+    contents = [json.dumps(pkg_dict) for pkg_dict in decoded]
+    old_size = deep_sizeof([decoded, ids, contents])
+
+    records = [GatherRecord.from_dict(pkg_dict, guid_key, title_key,
+                                      modified_key)
+               for pkg_dict in decoded]
+    del decoded
+    id_set = IdSet(record.guid for record in records)
+    # HarvestObject.content refers to record.raw, so it adds nothing
+    contents = [record.raw for record in records]
+    new_size = deep_sizeof([records, id_set._hashes, contents])
+
+    return old_size, new_size
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--records', type='int', default=20000,
+                      help='Number of synthetic datasets [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the random generator [default: %default]')
+    parser.add_option('--snapshot', default=None,
+                      help='Measure the datasets of a snapshot file instead')
+    options, args = parser.parse_args(args)
+
+    if options.snapshot:
+        reader = SnapshotReader(options.snapshot)
+        try:
+            pkg_dicts = [json.loads(record.raw) for record in reader]
+            source_type = reader.meta.get('source_type')
+        finally:
+            reader.close()
+        keys = ('Uuid', 'Title', None)
+        if source_type == 'datanorge':
+            keys = ('id', 'title', 'modified')
+        old_size, new_size = measure(pkg_dicts, *keys)
+        print '%-10s %8d records: dicts %8.1f MiB, records %8.1f MiB, ' \
+              '%.1fx smaller' % (source_type, len(pkg_dicts),
+                                 old_size / 1048576.0, new_size / 1048576.0,
+                                 float(old_size) / new_size)
+        return
+
+    for name, make, keys in (
+            ('Geonorge', geonorge_search_result, ('Uuid', 'Title', None)),
+            ('Data Norge', datanorge_dataset, ('id', 'title', 'modified'))):
+        rng = random.Random(options.seed)
+        pkg_dicts = [make(index, rng) for index in range(options.records)]
+        old_size, new_size = measure(pkg_dicts, *keys)
+        print '%-10s %8d records: dicts %8.1f MiB, records %8.1f MiB, ' \
+              '%.1fx smaller' % (name, options.records,
+                                 old_size / 1048576.0, new_size / 1048576.0,
+                                 float(old_size) / new_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Measures what loading the plugins of ckanext-sintef costs a CKAN process:
+the seconds it takes to import each entry point in a new interpreter, and
+the modules it loads that ckanext-harvest and CKAN do not load themselves.
+
+Each entry point is imported --repeat times, each time in a new process,
+and the median is reported. With --max-seconds, the benchmark fails if an
+entry point takes longer than that, or loads one of the modules it should
+not load, e.g. the other harvester.
+
+Usage::
+
+    python -m ckanext.sintef.benchmarks.import_time [--repeat N] [--max-seconds S]
+'''
+import sys
+import optparse
+import subprocess
+
+from ckan.lib.helpers import json
+
+# Entry points of setup.py, with the modules they should not load
+ENTRY_POINTS = [
+    ('geonorge_harvester',
+     'ckanext.sintef.harvesters.geonorgeharvester:GeonorgeHarvester',
+     ['ckanext.sintef.harvesters.datanorgeharvester']),
+    ('datanorge_harvester',
+     'ckanext.sintef.harvesters.datanorgeharvester:DataNorgeHarvester',
+     ['ckanext.sintef.harvesters.geonorgeharvester']),
+    ('sintef', 'ckanext.sintef.plugin:SintefPlugin',
+     ['ckanext.sintef.harvesters.datanorgeharvester',
+      'ckanext.sintef.harvesters.geonorgeharvester']),
+]
+
+# What CKAN has loaded before it loads the plugins
+BASELINE = 'import ckan.plugins, ckanext.harvest.model, ' \
+           'ckanext.harvest.harvesters.base'
+
+_SCRIPT = '''
+import sys, time, json
+%s
+before = set(sys.modules)
+started = time.time()
+module, _, name = sys.argv[1].partition(':')
+getattr(__import__(module, fromlist=[name]), name)
+seconds = time.time() - started
+json.dump({'seconds': seconds,
+           'modules': sorted(key for key in set(sys.modules) - before
+                             if sys.modules[key] is not None)}, sys.stdout)
+'''
+
+
+def import_entry_point(target, baseline=BASELINE):
+    '''
+    Imports an entry point in a new interpreter.
+
+    :param target: The entry point, as "module:attribute".
+    :param baseline: Statement run before the import is timed.
+    :returns: The seconds the import took and the names of the modules it
+              loaded.
+    '''
+    process = subprocess.Popen([sys.executable, '-c', _SCRIPT % baseline,
+                                target], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError('Importing %s failed: %s' % (target, err.strip()))
+    result = json.loads(out)
+    return result['seconds'], result['modules']
+
+
+def forbidden_modules(modules, forbidden):
+    '''
+    Returns the modules of a list that are, or are in, one of the forbidden
+    packages or modules.
+    '''
+    return [module for module in modules
+            if any(module == name or module.startswith(name + '.')
+                   for name in forbidden)]
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Imports of each entry point [default: %default]')
+    parser.add_option('--max-seconds', dest='max_seconds', type='float',
+                      default=None,
+                      help='Fail if an entry point takes longer to import')
+    options, args = parser.parse_args(args)
+
+    failures = []
+    for name, target, forbidden in ENTRY_POINTS:
+        timings = []
+        for _ in range(options.repeat):
+            seconds, modules = import_entry_point(target)
+            timings.append(seconds)
+        median = sorted(timings)[len(timings) // 2]
+        own = [module for module in modules
+               if module.startswith('ckanext.sintef')]
+        print '%-20s %8.1f ms  %4d modules (%d of ckanext-sintef)' % (
+            name, median * 1000, len(modules), len(own))
+
+        loaded = forbidden_modules(modules, forbidden)
+        if loaded:
+            failures.append('%s loads %s' % (name, ', '.join(loaded)))
+        if options.max_seconds is not None and median > options.max_seconds:
+            failures.append('%s takes %.3f s to import, more than %s s' % (
+                name, median, options.max_seconds))
+
+    for failure in failures:
+        print 'FAIL: %s' % failure
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+Load test of the harvesters against a fake remote, see fakeremote.
+
+A temporary harvest source of the given type is made for a fake remote
+started in this process, and harvest jobs of it are run one after the other:
+the gather stage, then the fetch and import stages of the HarvestObjects it
+created. The report, a JSON object, has for each job:
+
+    gather     Seconds, HarvestObjects created, datasets per second, gather
+               errors and the requests, injected errors and duplicates the
+               fake served
+    import     Objects imported, their results, latency percentiles and
+               objects per second
+    memory     Peak resident memory of the process after the stages, in MiB
+
+and, for all the jobs, whether and after how many jobs a gather got through
+the injected errors.
+
+Run with "paster sintef loadtest {geonorge|datanorge}", as the stages need
+the database of a CKAN instance. The source, its jobs and its datasets are
+removed afterwards unless --keep is given. Do not run it against a
+production instance.
+'''
+import time
+import datetime
+import resource
+
+from ckan import model
+from ckan.logic import get_action
+from ckan.lib.helpers import json
+
+from ckanext.sintef.benchmarks.fakeremote import start_fake_remote
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def max_rss_mib():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                 1)
+
+
+def latency_percentiles(seconds):
+    '''
+    Returns the 50th, 90th and 99th percentiles of a list of durations.
+    '''
+    if not seconds:
+        return {'p50': None, 'p90': None, 'p99': None}
+    ordered = sorted(seconds)
+    last = len(ordered) - 1
+    return dict(('p%d' % (fraction * 100),
+                 round(ordered[int(round(fraction * last))], 4))
+                for fraction in (0.5, 0.9, 0.99))
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+def _stats_since(server, before):
+    after = server.snapshot()
+    return dict((key, after[key] - before[key]) for key in after)
+
+
+def _context():
+    site_user = get_action('get_site_user')(
+        {'model': model, 'ignore_auth': True}, {})
+    return {'model': model, 'session': model.Session,
+            'user': site_user['name'], 'ignore_auth': True}
+
+
+def run_job(harvester, source_id, server, imports=None):
+    '''
+    Runs one harvest job of a source.
+
+    :param harvester: Harvester of the source type.
+    :param source_id: ID of the harvest source.
+    :param server: FakeRemoteServer the source harvests.
+    :param imports: Import at most this many objects, None for all.
+    :returns: The report of the job.
+    '''
+    from ckanext.harvest.model import (HarvestJob, HarvestObject,
+                                       HarvestGatherError)
+
+    job_dict = get_action('harvest_job_create')(_context(),
+                                                {'source_id': source_id})
+    job = HarvestJob.get(job_dict['id'])
+    job.gather_started = datetime.datetime.utcnow()
+    job.status = u'Running'
+    job.save()
+
+    before = server.snapshot()
+    started = time.time()
+    object_ids = harvester.gather_stage(job)
+    gather_seconds = time.time() - started
+    job.gather_finished = datetime.datetime.utcnow()
+    job.save()
+    gather_errors = [error.message for error
+                     in model.Session.query(HarvestGatherError)
+                     .filter(HarvestGatherError.harvest_job_id == job.id)]
+    report = {
+        'job_id': job.id,
+        'gather': dict(_stats_since(server, before),
+                       ok=object_ids is not None,
+                       seconds=round(gather_seconds, 2),
+                       objects=len(object_ids or []),
+                       datasets_per_second=_rate(len(object_ids or []),
+                                                 gather_seconds),
+                       errors=gather_errors),
+        'memory': {'after_gather_mib': max_rss_mib()},
+    }
+
+    before = server.snapshot()
+    results = {'imported': 0, 'unchanged': 0, 'failed': 0}
+    latencies = []
+    started = time.time()
+    for object_id in (object_ids or [])[:imports]:
+        harvest_object = HarvestObject.get(object_id)
+        object_started = time.time()
+        result = False
+        if harvester.fetch_stage(harvest_object):
+            result = harvester.import_stage(harvest_object)
+        latencies.append(time.time() - object_started)
+        if result == 'unchanged':
+            results['unchanged'] += 1
+        elif result:
+            results['imported'] += 1
+        else:
+            results['failed'] += 1
+    import_seconds = time.time() - started
+    report['import'] = dict(results, objects=len(latencies),
+                            seconds=round(import_seconds, 2),
+                            objects_per_second=_rate(len(latencies),
+                                                     import_seconds),
+                            remote=_stats_since(server, before),
+                            **latency_percentiles(latencies))
+    report['memory']['after_import_mib'] = max_rss_mib()
+
+    job.status = u'Finished'
+    job.finished = datetime.datetime.utcnow()
+    job.save()
+    return report
+
+
+def run_load_test(harvester, scenario, jobs=2, imports=None,
+                  source_config=None, keep=False):
+    '''
+    Runs harvest jobs of a temporary source against a fake remote.
+
+    :param harvester: Harvester of the type of source to test.
+    :param scenario: fakeremote.Scenario of the remote.
+    :param jobs: Number of jobs to run one after the other.
+    :param imports: Import at most this many objects per job, None for all.
+    :param source_config: Config of the source, a dictionary.
+    :param keep: Keep the source, its jobs and its datasets.
+    :returns: The report, a dictionary.
+    '''
+    server = start_fake_remote(scenario)
+    name = u'sintef-loadtest-%s' % int(time.time())
+    source = get_action('harvest_source_create')(_context(), {
+        'name': name,
+        'title': u'Load test %s' % name,
+        'url': server.url,
+        'source_type': harvester.info()['name'],
+        'config': json.dumps(source_config or {}),
+    })
+    log.info('Load test of source %s against %s', source['id'], server.url)
+
+    report = {'scenario': scenario.as_dict(), 'source_id': source['id'],
+              'source_config': source_config or {}, 'jobs': []}
+    started = time.time()
+    try:
+        for number in range(jobs):
+            job_report = run_job(harvester, source['id'], server, imports)
+            report['jobs'].append(job_report)
+            log.info('Load test job %s of %s: %s objects gathered in %s s',
+                     number + 1, jobs, job_report['gather']['objects'],
+                     job_report['gather']['seconds'])
+    finally:
+        report['seconds'] = round(time.time() - started, 2)
+        report['remote'] = server.snapshot()
+        server.shutdown()
+        if not keep:
+            _remove_source(source['id'])
+
+    # A gather that ended without errors got through the injected errors
+    recovered = [index for index, job_report in enumerate(report['jobs'])
+                 if job_report['gather']['ok'] and
+                 not job_report['gather']['errors']]
+    report['recovery'] = {
+        'recovered': bool(recovered),
+        'jobs_until_error_free_gather': recovered[0] + 1 if recovered
+                                        else None,
+    }
+    report['memory'] = {'max_rss_mib': max_rss_mib()}
+    return report
+
+
+def _remove_source(source_id):
+    context = _context()
+    try:
+        get_action('harvest_source_clear')(dict(context), {'id': source_id})
+        get_action('dataset_purge')(dict(context), {'id': source_id})
+    except Exception, e:
+        log.warn('Could not remove load test source %s: %r', source_id, e)
@@ -0,0 +1,115 @@
+'''
+Measures the time the import stage spends on the tags and resources of
+datasets, with the Normalizer and with a straightforward normalization of
+each record on its own: every keyword cleaned with regular expressions,
+tags deduplicated by scanning the list, and formats matched against each
+entry of the format table in turn.
+
+The datasets are synthetic Data Norge datasets, whose keywords sometimes
+hold several terms separated by commas.
+
+Usage::
+
+    python -m ckanext.sintef.benchmarks.normalization [--records N] [--default-tags N]
+'''
+import re
+import time
+import random
+import optparse
+
+from ckanext.sintef.benchmarks.synthetic import datanorge_dataset
+from ckanext.sintef.harvesters import normalize
+from ckanext.sintef.harvesters.normalize import Normalizer, FORMATS
+
+
+def make_pkg_dicts(count, seed):
+    '''
+    Returns synthetic Data Norge datasets with their resources, as the import
+    stage has them before normalization.
+    '''
+    rng = random.Random(seed)
+    pkg_dicts = []
+    for index in xrange(count):
+        pkg_dict = datanorge_dataset(index, rng)
+        pkg_dict['tags'] = []
+        pkg_dict['resources'] = [{'url': resource['accessURL'],
+                                  'name': u'Fil',
+                                  'format': resource['format']}
+                                 for resource in pkg_dict['distribution']]
+        pkg_dicts.append(pkg_dict)
+    return pkg_dicts
+
+
+def naive_normalize(pkg_dict, default_tags):
+    tags = pkg_dict['tags']
+    for keyword in list(pkg_dict['keyword']) + list(default_tags):
+        for term in re.split(r'[,;]', keyword):
+            name = re.compile(r'[^\w \-.]+', re.UNICODE).sub(u' ', term)
+            name = re.compile(r'\s+', re.UNICODE).sub(u' ', name).strip(u' -.')
+            name = name[:normalize.MAX_TAG_LENGTH].rstrip(u' -.')
+            if len(name) < normalize.MIN_TAG_LENGTH:
+                continue
+            if name.lower() not in [tag['name'].lower() for tag in tags]:
+                tags.append({'name': name})
+
+    resources = []
+    for resource in pkg_dict['resources']:
+        if resource['url'] in [other['url'] for other in resources]:
+            continue
+        key = resource['format'].strip().lower()
+        for spelling, (name, mimetype) in FORMATS.items():
+            if spelling == key:
+                resource['format'] = name
+                if mimetype:
+                    resource['mimetype'] = mimetype
+                break
+        resources.append(resource)
+    pkg_dict['resources'] = resources
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--records', type='int', default=100000,
+                      help='Number of synthetic datasets [default: %default]')
+    parser.add_option('--default-tags', type='int', default=5,
+                      help='Number of default tags of the source '
+                           '[default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the random generator [default: %default]')
+    options, args = parser.parse_args(args)
+
+    default_tags = [u'Standard, tagg %s' % index
+                    for index in range(options.default_tags)]
+
+    pkg_dicts = make_pkg_dicts(options.records, options.seed)
+    started = time.time()
+    for pkg_dict in pkg_dicts:
+        naive_normalize(pkg_dict, default_tags)
+    naive_seconds = time.time() - started
+    expected = [[tag['name'] for tag in pkg_dict['tags']]
+                for pkg_dict in pkg_dicts]
+    del pkg_dicts
+
+    pkg_dicts = make_pkg_dicts(options.records, options.seed)
+    normalize._tag_cache.clear()
+    normalize._format_cache.clear()
+    started = time.time()
+    normalizer = Normalizer(default_tags)
+    normalizer.normalize_batch(pkg_dicts, lambda pkg_dict: pkg_dict['keyword'])
+    batch_seconds = time.time() - started
+    found = [[tag['name'] for tag in pkg_dict['tags']]
+             for pkg_dict in pkg_dicts]
+    if found != expected:
+        raise AssertionError('The Normalizer made other tags')
+
+    print 'Records:      %d' % options.records
+    print 'Tags:         %d' % sum(len(names) for names in found)
+    print 'Per record:   %8.2f s (%6.1f us per record)' % (
+        naive_seconds, naive_seconds * 1e6 / options.records)
+    print 'Normalizer:   %8.2f s (%6.1f us per record)' % (
+        batch_seconds, batch_seconds * 1e6 / options.records)
+    print 'Speedup:      %8.1fx' % (naive_seconds / batch_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Synthetic remote records shaped like the ones returned by Geonorge and Data
+Norge, for use in benchmarks.
+'''
+import random
+
+ORGANIZATIONS = [u'Kartverket', u'Statens vegvesen', u'Norges geologiske '
+                 u'unders\xf8kelse', u'Milj\xf8direktoratet', u'Kystverket',
+                 u'Oslo kommune', u'Trondheim kommune', u'Avinor']
+THEMES = [u'Samferdsel', u'Basis geodata', u'Natur', u'Plan', u'Kyst og fiskeri',
+          u'Energi', u'Geologi', u'Forurensning']
+FORMATS = [u'application/json', u'JSON', u'text/csv', u'CSV', u'csv',
+           u'application/xml', u'XML', u'text/html', u'SOSI', u'GML',
+           u'application/vnd.google-earth.kml+xml', u'ZIP']
+
+
+def geonorge_uuid(index):
+    return u'%08x-0000-4000-8000-%012x' % (index, index)
+
+
+def geonorge_search_result(index, rng=random):
+    '''
+    Returns a dictionary shaped like one of the 'Results' of a Geonorge
+    search.
+    '''
+    uuid = geonorge_uuid(index)
+    organization = rng.choice(ORGANIZATIONS)
+    return {
+        u'Uuid': uuid,
+        u'Title': u'Datasett nummer %s for %s' % (index, organization),
+        u'Abstract': u'Beskrivelse av datasett %s. ' % index * 8,
+        u'Type': u'dataset',
+        u'Theme': rng.choice(THEMES),
+        u'Organization': organization,
+        u'OrganizationLogo': u'https://register.geonorge.no/logo/%s.png' %
+                             organization.replace(u' ', u'-'),
+        u'IsOpenData': rng.random() < 0.7,
+        u'ShowDetailsUrl': u'https://kartkatalog.geonorge.no/metadata/uuid/%s'
+                           % uuid,
+        u'ThumbnailUrl': u'https://kartkatalog.geonorge.no/thumbnails/%s.png'
+                         % uuid,
+        u'DistributionProtocol': rng.choice([u'GEONORGE:DOWNLOAD',
+                                             u'WWW:DOWNLOAD-1.0-http--download',
+                                             u'OGC:WMS']),
+        u'DistributionUrl': u'https://nedlasting.geonorge.no/api/download/%s'
+                            % uuid,
+        u'DatasetServices': [],
+        u'IsOpenDataString': u'',
+    }
+
+
+def datanorge_dataset(index, rng=random):
+    '''
+    Returns a dictionary shaped like one of the 'datasets' of the Data Norge
+    DCAT catalogue.
+    '''
+    organization = rng.choice(ORGANIZATIONS)
+    url = u'https://data.norge.no/node/%s' % index
+    keywords = rng.sample(THEMES, 3)
+    if rng.random() < 0.2:
+        keywords.append(u'%s, %s' % (rng.choice(THEMES), rng.choice(THEMES)))
+    return {
+        u'id': url,
+        u'title': u'Datasett nummer %s for %s' % (index, organization),
+        u'description': [{u'language': u'nb',
+                          u'value': u'Beskrivelse av datasett %s. ' % index * 8}],
+        u'landingPage': url,
+        u'identifier': url,
+        u'issued': u'2016-01-01',
+        u'modified': u'2016-%02d-%02d' % (rng.randint(1, 12),
+                                          rng.randint(1, 28)),
+        u'publisher': {u'name': organization,
+                       u'mbox': u'post@example.no'},
+        u'keyword': keywords,
+        u'distribution': [
+            {u'accessURL': u'%s/download/%s' % (url, i),
+             u'format': rng.choice(FORMATS),
+             u'description': [{u'language': u'nb',
+                               u'value': u'Fil %s' % i}]}
+            for i in range(rng.randint(1, 3))],
+    }
@@ -0,0 +1,616 @@
+import sys
+import datetime
+
+from ckan.lib.cli import CkanCommand
+
+
+class SintefCommand(CkanCommand):
+    '''Tools for the Geonorge and Data Norge harvesters
+
+    Usage:
+
+      sintef plan {source-id} [--force-all] [--import-seconds=N] [--json]
+        - Estimates the remote requests, HarvestObjects, imports and wall
+          time of the next harvest job of a source, without running it and
+          without writing anything. Only the first page of each search is
+          requested.
+
+      sintef profile {job-id}
+        - Turns profiling on for a harvest job that has not run yet. Its
+          gather and import stages save pstats and collapsed stacks in the
+          profile directory of the job.
+
+      sintef profile-summary [{source-id|job-id} ...] [--limit=N]
+                             [--sort=KEY] [--collapsed=FILE]
+        - Prints the top functions by cumulative time across all profiled
+          jobs, or only those of the given sources and jobs. With
+          --collapsed, the collapsed stacks of the same jobs are added up and
+          written to FILE, ready for flamegraph.pl.
+
+      sintef snapshot-export {job-id} {path}
+        - Writes the datasets gathered by a harvest job to a snapshot file.
+          A source with "snapshot": "{path}" in its config gathers from the
+          file instead of the remote.
+
+      sintef snapshot-info {path}
+        - Prints what a snapshot file contains.
+
+      sintef remote-health [{remote-url}] [--reset]
+        - Prints the circuit breaker state of the remotes, with the last
+          decision made and why. With --reset, the breaker of the given
+          remote is closed again.
+
+      sintef progress [{job-id}] [--watch=SECONDS]
+        - Prints the rate, the time per object and the estimated completion
+          time of each running harvest job, or of the given job. With
+          --watch, the figures are printed again every SECONDS seconds until
+          interrupted.
+
+      sintef identity-index [{source-id} ...] [--rebuild]
+        - Prints how many identifiers and datasets each source has claimed
+          in the cross-source identity index. With --rebuild, the datasets
+          the given sources, or all sources, have imported are claimed
+          first, and those already claimed by another source are printed.
+
+      sintef quarantine [{source-id}] [--limit=N] [--clear]
+        - Prints how many invalid records each source has in quarantine,
+          or the latest records in quarantine of a source with the reasons
+          they are invalid. With --clear, the records in quarantine of the
+          source are removed.
+
+      sintef frequency [{source-id} ...] [--apply] [--json]
+        - Prints how often the given sources, or every active Geonorge and
+          Data Norge source, should be harvested, from the changes found by
+          their last finished jobs. With --apply, the next job of each
+          source is scheduled as recommended.
+
+      sintef shard-consumer
+        - Runs shards of the sharded gather jobs of Geonorge sources, for
+          the messages of the shard queue. Run as many as there should be
+          helpers, next to the gather and fetch consumers of
+          ckanext-harvest.
+
+      sintef loadtest {geonorge|datanorge} [--records=N] [--latency=S]
+                      [--distribution=D] [--error-rate=F]
+                      [--duplicate-rate=F] [--body-rate=B] [--seed=N]
+                      [--jobs=N] [--imports=N] [--source-config=JSON]
+                      [--report=FILE] [--keep]
+        - Runs harvest jobs of a temporary source against a fake remote
+          with a synthetic catalogue, which can be made slow and
+          unreliable, and prints a JSON report of the throughput, memory and
+          error recovery of each job. Do not run it against a production
+          instance.
+
+    The commands should be run from the ckanext-sintef directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster sintef plan {source-id} --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(SintefCommand, self).__init__(name)
+
+        self.parser.add_option('--force-all', dest='force_all',
+            action='store_true', default=False,
+            help='Plan a job that requests all datasets')
+
+        self.parser.add_option('--import-seconds', dest='import_seconds',
+            type='float', default=None,
+            help='Seconds one import takes. By default this is measured from '
+                 'the last finished job of the source')
+
+        self.parser.add_option('--json', dest='json', action='store_true',
+            default=False, help='Print the result as JSON')
+
+        self.parser.add_option('--limit', dest='limit', type='int', default=30,
+            help='Number of functions or records to print')
+
+        self.parser.add_option('--sort', dest='sort', default='cumulative',
+            help='Key to sort the functions by, as in pstats')
+
+        self.parser.add_option('--collapsed', dest='collapsed', default=None,
+            help='File to write the added up collapsed stacks to')
+
+        self.parser.add_option('--reset', dest='reset', action='store_true',
+            default=False, help='Close the circuit breaker of the remote')
+
+        self.parser.add_option('--watch', dest='watch', type='float',
+            default=None, help='Seconds between two printouts')
+
+        self.parser.add_option('--rebuild', dest='rebuild',
+            action='store_true', default=False,
+            help='Claim the identifiers of the imported datasets')
+
+        self.parser.add_option('--clear', dest='clear', action='store_true',
+            default=False, help='Remove the records in quarantine')
+
+        self.parser.add_option('--apply', dest='apply', action='store_true',
+            default=False, help='Schedule the next jobs as recommended')
+
+        from ckanext.sintef.benchmarks.fakeremote import add_scenario_options
+        add_scenario_options(self.parser)
+
+        self.parser.add_option('--jobs', dest='jobs', type='int', default=2,
+            help='Number of load test jobs to run')
+
+        self.parser.add_option('--imports', dest='imports', type='int',
+            default=None, help='Import at most this many objects per job')
+
+        self.parser.add_option('--source-config', dest='source_config',
+            default=None, help='Config of the load test source, as JSON')
+
+        self.parser.add_option('--report', dest='report', default=None,
+            help='File to write the load test report to')
+
+        self.parser.add_option('--keep', dest='keep', action='store_true',
+            default=False, help='Keep the load test source and its datasets')
+
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'plan':
+            self.plan()
+        elif cmd == 'profile':
+            self.profile()
+        elif cmd == 'profile-summary':
+            self.profile_summary()
+        elif cmd == 'snapshot-export':
+            self.snapshot_export()
+        elif cmd == 'snapshot-info':
+            self.snapshot_info()
+        elif cmd == 'remote-health':
+            self.remote_health()
+        elif cmd == 'progress':
+            self.progress()
+        elif cmd == 'identity-index':
+            self.identity_index()
+        elif cmd == 'quarantine':
+            self.quarantine()
+        elif cmd == 'frequency':
+            self.frequency()
+        elif cmd == 'shard-consumer':
+            self.shard_consumer()
+        elif cmd == 'loadtest':
+            self.loadtest()
+        else:
+            print 'Command %s not recognized' % cmd
+
+
+    def _get_source(self, source_id_or_name):
+        from ckan import model
+        from ckanext.harvest.model import HarvestSource
+
+        source = HarvestSource.get(source_id_or_name)
+        if not source:
+            package = model.Package.get(source_id_or_name)
+            if package:
+                source = HarvestSource.get(package.id)
+        if not source:
+            print 'Harvest source %s does not exist' % source_id_or_name
+            sys.exit(1)
+        return source
+
+
+    def _get_harvester(self, source):
+        from ckan.plugins import PluginImplementations
+        from ckanext.harvest.interfaces import IHarvester
+
+        for harvester in PluginImplementations(IHarvester):
+            if harvester.info()['name'] == source.type:
+                return harvester
+        print 'No harvester for source type %s is enabled' % source.type
+        sys.exit(1)
+
+
+    def plan(self):
+        from ckan.lib.helpers import json
+
+        if len(self.args) < 2:
+            print 'Please provide a harvest source id'
+            sys.exit(1)
+
+        source = self._get_source(self.args[1])
+        harvester = self._get_harvester(source)
+        if not hasattr(harvester, 'plan_harvest'):
+            print 'Harvest jobs of source type %s can not be planned' % \
+                source.type
+            sys.exit(1)
+
+        plan = harvester.plan_harvest(source, force_all=self.options.force_all)
+        plan = plan.as_dict(import_seconds=self.options.import_seconds)
+
+        if self.options.json:
+            print json.dumps(plan, indent=2)
+            return
+
+        # Estimates that are only lower bounds are marked with '>='
+        bound = '' if plan['exact'] else '>= '
+        print 'Source:              %s (%s, %s)' % (plan['source_title'],
+                                                    plan['source_id'],
+                                                    plan['source_type'])
+        print 'Mode:                %s' % plan['mode']
+        print 'Searches:            %s' % len(plan['queries'])
+        for query in plan['queries']:
+            terms = ', '.join('%s=%s' % (key, value) for key, value
+                              in sorted(query['terms'].items()))
+            print '    %s: %s%s hits, %s%s pages' % (
+                terms or 'all datasets',
+                '' if query['exact'] else '>= ', query['hits'],
+                '' if query['exact'] else '>= ', query['pages'])
+        print 'Search requests:     %s%s' % (bound, plan['search_requests'])
+        print 'Getdata requests:    %s%s' % (bound, plan['getdata_requests'])
+        print 'Remote requests:     %s%s' % (bound, plan['remote_requests'])
+        print 'HarvestObjects:      %s%s' % (bound, plan['harvest_objects'])
+        print 'Imports:             %s%s' % (bound, plan['imports'])
+        print 'Gather time:         %s%s (%.2f s per request)' % (
+            bound, _format_seconds(plan['gather_seconds']),
+            plan['mean_request_seconds'])
+        print 'Import time:         %s%s (%.2f s per import)' % (
+            bound, _format_seconds(plan['total_import_seconds']),
+            plan['import_seconds'])
+        print 'Projected wall time: %s%s' % (
+            bound, _format_seconds(plan['total_seconds']))
+        if plan['mode'] == 'incremental':
+            print
+            print 'Only changed datasets get HarvestObjects in incremental ' \
+                  'jobs, so these are upper bounds.'
+
+
+    def profile(self):
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.sintef.harvesters.profiling import enable_job_profiling
+
+        if len(self.args) < 2:
+            print 'Please provide a harvest job id'
+            sys.exit(1)
+
+        job = HarvestJob.get(self.args[1])
+        if not job:
+            print 'Harvest job %s does not exist' % self.args[1]
+            sys.exit(1)
+        if job.status not in ('New', 'Running'):
+            print 'Harvest job %s has already finished' % job.id
+            sys.exit(1)
+
+        job_dir = enable_job_profiling(job.source_id, job.id)
+        print 'Profiling harvest job %s, results are saved in %s' % (job.id,
+                                                                     job_dir)
+
+
+    def profile_summary(self):
+        import pstats
+        from ckanext.sintef.harvesters.profiling import (find_profile_files,
+                                                         merge_collapsed,
+                                                         get_profile_dir)
+
+        ids = self.args[1:]
+        paths = find_profile_files('.pstats', ids)
+        if not paths:
+            print 'No profiles found in %s' % get_profile_dir()
+            sys.exit(1)
+
+        print 'Profiles: %s files' % len(paths)
+        stats = pstats.Stats(*paths)
+        stats.sort_stats(self.options.sort).print_stats(self.options.limit)
+
+        if self.options.collapsed:
+            with open(self.options.collapsed, 'w') as out:
+                count = merge_collapsed(find_profile_files('.collapsed', ids),
+                                        out)
+            print 'Wrote %s stacks to %s' % (count, self.options.collapsed)
+
+
+    def snapshot_export(self):
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.sintef.harvesters.snapshot import export_job_snapshot
+
+        if len(self.args) < 3:
+            print 'Please provide a harvest job id and the path of the file'
+            sys.exit(1)
+
+        job = HarvestJob.get(self.args[1])
+        if not job:
+            print 'Harvest job %s does not exist' % self.args[1]
+            sys.exit(1)
+
+        count = export_job_snapshot(job, self.args[2])
+        print 'Wrote %s datasets of harvest job %s to %s' % (count, job.id,
+                                                             self.args[2])
+
+
+    def snapshot_info(self):
+        from ckanext.sintef.harvesters.snapshot import (SnapshotReader,
+                                                        SnapshotError)
+
+        if len(self.args) < 2:
+            print 'Please provide the path of a snapshot file'
+            sys.exit(1)
+
+        try:
+            reader = SnapshotReader(self.args[1])
+        except SnapshotError, e:
+            print e
+            sys.exit(1)
+        try:
+            for key in sorted(reader.meta):
+                print '%-12s %s' % (key + ':', reader.meta[key])
+            if len(reader):
+                print 'First:       %s' % reader[0].guid
+                print 'Last:        %s' % reader[-1].guid
+        finally:
+            reader.close()
+
+
+    def remote_health(self):
+        from ckanext.sintef.harvesters.health import DbHealthStore
+
+        store = DbHealthStore()
+        remote = self.args[1].rstrip('/') if len(self.args) > 1 else None
+
+        if self.options.reset:
+            if not remote:
+                print 'Please provide the URL of the remote to reset'
+                sys.exit(1)
+            store.reset(remote)
+            print 'Circuit breaker of %s closed' % remote
+            return
+
+        states = store.all()
+        if remote:
+            states = [state for state in states if state['remote'] == remote]
+        if not states:
+            print 'No remote health recorded yet'
+            return
+        for state in states:
+            print state['remote']
+            print '    State:          %s (%s failures)' % (state['state'],
+                                                           state['failures'])
+            print '    Last failure:   %s' % state['last_failure']
+            print '    Last success:   %s' % state['last_success']
+            print '    Full fallback:  %s' % state['last_full_fallback']
+            print '    Reason:         %s' % state['reason']
+            print '    Decision:       %s' % state['decision']
+
+
+    def progress(self):
+        import time
+        from ckan import model
+        from ckanext.sintef.harvesters.progress import get_progress
+
+        job_ids = self.args[1:2] or None
+        while True:
+            summaries = get_progress(job_ids)
+            if not summaries:
+                print 'No running harvest jobs'
+            for summary in summaries:
+                _print_progress(summary)
+            if not self.options.watch:
+                break
+            try:
+                time.sleep(self.options.watch)
+            except KeyboardInterrupt:
+                break
+            # Read the counters written since the last printout
+            model.Session.remove()
+            print
+
+
+    def identity_index(self):
+        from ckan import model
+        from ckan.plugins import PluginImplementations
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.harvest.model import HarvestSource
+        from ckanext.sintef.harvesters.identity import (IdentityIndex,
+                                                        DbIdentityStore)
+
+        store = DbIdentityStore()
+        if self.options.rebuild:
+            if len(self.args) > 1:
+                sources = [self._get_source(source_id)
+                           for source_id in self.args[1:]]
+            else:
+                # The oldest sources claim their datasets first
+                sources = model.Session.query(HarvestSource) \
+                    .filter(HarvestSource.active == True) \
+                    .order_by(HarvestSource.created).all()
+            harvesters = dict((harvester.info()['name'], harvester)
+                              for harvester
+                              in PluginImplementations(IHarvester))
+            index = IdentityIndex(store)
+            for source in sources:
+                harvester = harvesters.get(source.type)
+                if not hasattr(harvester, 'index_identities'):
+                    continue
+                claimed, duplicates = harvester.index_identities(source,
+                                                                 index)
+                print '%s: %s datasets claimed, %s already claimed by ' \
+                      'another source' % (source.id, claimed, len(duplicates))
+                for package_id, claim in duplicates:
+                    print '    %s is %s of source %s (%s)' % (
+                        package_id, claim['package_id'], claim['source_id'],
+                        claim['identifier'])
+            print
+
+        counts = store.counts()
+        if not counts:
+            print 'No identifiers claimed yet'
+            return
+        for source_id, (identifiers, packages) in sorted(counts.items()):
+            print '%s: %s identifiers of %s datasets' % (source_id,
+                                                        identifiers, packages)
+
+
+    def quarantine(self):
+        from ckanext.sintef.harvesters.validation import DbQuarantineStore
+
+        store = DbQuarantineStore()
+        if len(self.args) < 2:
+            counts = store.counts()
+            if not counts:
+                print 'No records in quarantine'
+            for source_id, count in sorted(counts.items()):
+                print '%s: %s records in quarantine' % (source_id, count)
+            return
+
+        source = self._get_source(self.args[1])
+        if self.options.clear:
+            count = store.clear(source.id)
+            print 'Removed %s records in quarantine of %s' % (count, source.id)
+            return
+
+        entries = store.latest(source.id, self.options.limit)
+        if not entries:
+            print 'No records of %s in quarantine' % source.id
+        for entry in entries:
+            print '%s  %-6s  %s' % (entry['created'].strftime('%Y-%m-%d %H:%M'),
+                                    entry['stage'], entry['guid'])
+            print '    Job:     %s' % entry['job_id']
+            print '    Reason:  %s' % entry['reason']
+
+
+    def frequency(self):
+        from ckan import model
+        from ckan.lib.helpers import json
+        from ckanext.harvest.model import HarvestSource
+        from ckanext.sintef.harvesters.config import get_source_config
+        from ckanext.sintef.harvesters.frequency import (source_recommendation,
+                                                         schedule_next_run)
+        from ckanext.sintef.logic.action import SOURCE_TYPES
+
+        if len(self.args) > 1:
+            sources = [self._get_source(source_id)
+                       for source_id in self.args[1:]]
+        else:
+            sources = model.Session.query(HarvestSource) \
+                .filter(HarvestSource.active == True) \
+                .filter(HarvestSource.type.in_(SOURCE_TYPES)) \
+                .order_by(HarvestSource.created).all()
+        if not sources:
+            print 'No active Geonorge or Data Norge sources'
+            return
+
+        recommendations = []
+        for source in sources:
+            recommendation = source_recommendation(
+                source, get_source_config(source.config, source.id))
+            if self.options.apply:
+                schedule_next_run(source, recommendation)
+            recommendations.append(recommendation)
+
+        if self.options.json:
+            print json.dumps(recommendations, indent=2,
+                             default=lambda value: value.isoformat())
+            return
+        for recommendation in recommendations:
+            print recommendation['source_id']
+            print '    Changes:        %s in %s jobs over %s hours ' \
+                  '(%s per hour), %s jobs without changes' % (
+                      recommendation['changed'], recommendation['jobs'],
+                      recommendation['hours'],
+                      recommendation['changes_per_hour'],
+                      recommendation['empty_jobs'])
+            print '    Changed share:  %.1f%% of the objects' % (
+                100 * recommendation['change_fraction'])
+            print '    Interval:       %s hours (%s, now %s)' % (
+                recommendation['interval_hours'],
+                recommendation['frequency'],
+                recommendation['current_frequency'])
+            print '    Next job:       %s%s' % (
+                recommendation['next_run'] or '-',
+                ' (scheduled)' if self.options.apply and
+                recommendation['next_run'] else '')
+            print '    Reason:         %s' % recommendation['reason']
+
+
+    def shard_consumer(self):
+        from ckan.plugins import PluginImplementations
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.sintef.harvesters.sharding import consume_shards
+
+        harvesters = [harvester for harvester
+                      in PluginImplementations(IHarvester)
+                      if harvester.info()['name'] == 'geonorge']
+        if not harvesters:
+            print 'No harvester for source type geonorge is enabled'
+            sys.exit(1)
+        consume_shards(harvesters[0].run_gather_helper)
+
+
+    def loadtest(self):
+        from ckan.plugins import PluginImplementations
+        from ckan.lib.helpers import json
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.sintef.benchmarks.fakeremote import scenario_from_options
+        from ckanext.sintef.benchmarks.loadtest import run_load_test
+
+        if len(self.args) < 2 or self.args[1] not in ('geonorge',
+                                                      'datanorge'):
+            print 'Please provide the type of source to test: geonorge or ' \
+                  'datanorge'
+            sys.exit(1)
+
+        harvesters = [harvester for harvester
+                      in PluginImplementations(IHarvester)
+                      if harvester.info()['name'] == self.args[1]]
+        if not harvesters:
+            print 'No harvester for source type %s is enabled' % self.args[1]
+            sys.exit(1)
+        try:
+            scenario = scenario_from_options(self.args[1], self.options)
+            source_config = json.loads(self.options.source_config or '{}')
+        except ValueError, e:
+            print e
+            sys.exit(1)
+
+        report = run_load_test(harvesters[0], scenario,
+                               jobs=self.options.jobs,
+                               imports=self.options.imports,
+                               source_config=source_config,
+                               keep=self.options.keep)
+        if self.options.report:
+            with open(self.options.report, 'w') as out:
+                json.dump(report, out, indent=2)
+            print 'Wrote the load test report to %s' % self.options.report
+        else:
+            print json.dumps(report, indent=2)
+
+
+def _format_latency(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 1:
+        return '%d ms' % round(seconds * 1000)
+    return '%g s' % seconds
+
+
+def _print_progress(summary):
+    print 'Job %s (source %s, %s)' % (summary['job_id'], summary['source_id'],
+                                      summary['status'])
+    for stage in ('gather', 'import'):
+        figures = summary['stages'].get(stage)
+        if not figures:
+            print '    %-7s not started' % stage
+            continue
+        rate = figures['rate']
+        print '    %-7s %8d done %6d errors %8s/s   p50 %s, p90 %s, p99 %s   ' \
+              '(%d workers)' % (
+                  stage, figures['count'], figures['errors'],
+                  '%.1f' % rate if rate is not None else '-',
+                  _format_latency(figures['p50']),
+                  _format_latency(figures['p90']),
+                  _format_latency(figures['p99']), figures['workers'])
+    if summary['total'] is not None:
+        print '    Remaining: %s of %s, estimated completion: %s UTC' % (
+            summary['remaining'], summary['total'], summary['eta'] or '-')
+
+
+def _format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
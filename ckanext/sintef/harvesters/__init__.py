@@ -1,2 +1,45 @@
-from ckanext.sintef.harvesters.datanorgeharvester import DataNorgeHarvester
-from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+'''
+The Geonorge and Data Norge harvesters.
+
+The geonorge_harvester and datanorge_harvester entry points load the module
+of their harvester only, so a CKAN process with one of the plugins enabled
+does not load the other harvester and what it depends on. The harvesters
+can still be imported from this package, which loads their module on first
+use.
+'''
+import sys
+import types
+import importlib
+
+# Harvesters that can be imported from this package, and their modules
+_HARVESTERS = {
+    'DataNorgeHarvester': 'ckanext.sintef.harvesters.datanorgeharvester',
+    'GeonorgeHarvester': 'ckanext.sintef.harvesters.geonorgeharvester',
+}
+
+
+class _HarvestersPackage(types.ModuleType):
+    '''
+    This package, loading the harvesters when they are first used.
+    '''
+
+    def __getattr__(self, name):
+        if name not in _HARVESTERS:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        harvester = getattr(importlib.import_module(_HARVESTERS[name]), name)
+        setattr(self, name, harvester)
+        return harvester
+
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_HARVESTERS))
+
+
+_package = _HarvestersPackage(__name__, __doc__)
+_package.__dict__.update(
+    (key, value) for key, value in globals().items() if key != '_package')
+# The globals of the module replaced in sys.modules are cleared when it is
+# garbage collected, so it is kept
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -0,0 +1,1410 @@
+'''
+Base class of the SINTEF harvesters.
+
+The Geonorge and Data Norge harvesters share the whole harvest engine: the
+config handling, the HTTP transport, the gather stage with its incremental
+search, full fallback and circuit breaker, the writing of HarvestObjects,
+the prefetching of metadata documents in the fetch stage, and the import
+stage with the organizations and the metadata provenance.
+A harvester for another catalogue only has to say how to search the remote
+and how to map one of its datasets to a CKAN package:
+
+    _search_modified(base_url, harvest_job, since, stats)
+        Yields the GatherRecords of the datasets modified since a date.
+    _search_everything(base_url, harvest_job, stats)
+        Yields the GatherRecords of every dataset of the source.
+    _map_package_dict(package_dict, harvest_object)
+        Turns the remote dataset into a CKAN package dictionary.
+    _get_organization(package_dict)
+        Returns the organization to create for the dataset.
+    _get_document_url(base_url, guid)
+        Returns the URL of the full metadata document of a dataset, if the
+        search results are not the whole record.
+'''
+import urllib2
+import httplib
+import datetime
+import socket
+import time
+import logging
+
+from sqlalchemy import exists
+
+from ckan import model
+from ckan.logic import ValidationError, get_action
+from ckan.lib.helpers import json
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError
+from ckanext.harvest.harvesters.base import HarvesterBase
+
+from ckanext.sintef.harvesters.records import IdSet
+from ckanext.sintef.harvesters.delta import DeltaUpdateMixin
+from ckanext.sintef.harvesters.config import (ThreadLocalConfigMixin,
+                                               get_source_config)
+from ckanext.sintef.harvesters.health import get_remote_health
+from ckanext.sintef.harvesters.organizations import upsert_organization
+from ckanext.sintef.harvesters.identity import (IdentityIndex,
+                                                dataset_identifiers)
+from ckanext.sintef.harvesters.snapshot import (read_snapshot_records,
+                                                SnapshotError)
+from ckanext.sintef.harvesters.scheduling import (ImportScheduler,
+                                                  parse_modified)
+from ckanext.sintef.harvesters.profiling import (profiled, job_of_job,
+                                                  job_of_object)
+from ckanext.sintef.harvesters.progress import progress_tracker
+from ckanext.sintef.harvesters.budget import (GatherBudget,
+                                              GatherBudgetExhausted,
+                                              DbCheckpointStore,
+                                              CHECKPOINT_PARTIAL,
+                                              CHECKPOINT_CONTINUED,
+                                              CHECKPOINT_COMPLETE,
+                                              MODE_MODIFIED, MODE_EVERYTHING)
+from ckanext.sintef.harvesters.validation import Quarantine
+from ckanext.sintef.harvesters.frequency import (source_recommendation,
+                                                 schedule_next_run)
+from ckanext.sintef.harvesters.prefetch import (get_prefetcher, add_document,
+                                                has_document, DEFAULT_WINDOW,
+                                                DbPrefetchStore)
+from ckanext.sintef.logs import log_event, event_aggregator
+
+log = logging.getLogger(__name__)
+
+
+# Seconds to wait for a remote to send more of a response
+REQUEST_TIMEOUT = 60
+
+# Responses in a row that can not be read before a search is given up
+MAX_MALFORMED_RESPONSES = 3
+
+
+class SintefHarvesterBase(ThreadLocalConfigMixin, DeltaUpdateMixin,
+                          HarvesterBase):
+    '''
+    Harvest engine shared by the SINTEF harvesters.
+    '''
+
+    # Options of the config that are a string or a list of strings
+    LIST_OPTIONS = ('organizations', 'themes', 'default_tags')
+
+    # Options of the config that are booleans
+    BOOL_OPTIONS = ('create_orgs', 'force_all', 'circuit_breaker',
+                    'delta_update', 'adaptive_frequency', 'profile')
+
+    # Options of the config that are positive integers
+    POSITIVE_INT_OPTIONS = ('gather_seconds', 'gather_requests',
+                            'min_interval_hours', 'max_interval_hours',
+                            'target_changes')
+
+    # Options of the config that take one of a few values
+    CHOICE_OPTIONS = {'cross_source_duplicates': ('skip', 'merge', 'import')}
+
+    # Name of the remote catalogue in messages
+    REMOTE_NAME = None
+
+    # Fields the harvester needs in the records of the remote, a
+    # validation.RecordSchema
+    RECORD_SCHEMA = None
+
+    # Key of the modified date in the records and metadata documents of the
+    # remote
+    MODIFIED_KEY = None
+
+
+    def _set_config(self, config_str, source_id=None):
+        '''
+        When creating a harvester, the user has the option of entering further
+        configuration in a form. This method sets 'config' for the current
+        thread to the configuration of the source. The configuration is only
+        decoded the first time it is seen by this process, and is shared, so
+        it can not be changed.
+
+        :param config_str: Config string coming from the form.
+        :param source_id: ID of the harvest source the config belongs to.
+        :returns: A SourceConfig containing any user configuration.
+        '''
+        self.config = get_source_config(config_str, source_id)
+        return self.config
+
+
+    @property
+    def gather_budget(self):
+        '''
+        The GatherBudget of the gather stage running in this thread, or None.
+        '''
+        return getattr(self._get_config_local(), 'gather_budget', None)
+
+
+    @gather_budget.setter
+    def gather_budget(self, value):
+        self._get_config_local().gather_budget = value
+
+
+    @property
+    def gather_quarantine(self):
+        '''
+        The Quarantine of the gather stage running in this thread, or None.
+        '''
+        return getattr(self._get_config_local(), 'gather_quarantine', None)
+
+
+    @gather_quarantine.setter
+    def gather_quarantine(self, value):
+        self._get_config_local().gather_quarantine = value
+
+
+    @property
+    def gather_listed(self):
+        '''
+        When the listing the gather stage running in this thread searched
+        was fetched, if it searched a listing fetched before, or None.
+        '''
+        return getattr(self._get_config_local(), 'gather_listed', None)
+
+
+    @gather_listed.setter
+    def gather_listed(self, value):
+        self._get_config_local().gather_listed = value
+
+
+    def _valid_record(self, pkg_dict, guid_key):
+        '''
+        Checks a record of the remote against RECORD_SCHEMA as it is
+        gathered, and puts it in quarantine if it is not valid.
+
+        :param pkg_dict: The decoded record.
+        :param guid_key: Key of the identifier of the record.
+        :returns: True if the record is valid.
+        '''
+        if self.RECORD_SCHEMA is None:
+            return True
+        reasons = self.RECORD_SCHEMA.validate(pkg_dict)
+        if not reasons:
+            return True
+        guid = pkg_dict.get(guid_key) if isinstance(pkg_dict, dict) else None
+        quarantine = self.gather_quarantine
+        if quarantine is not None:
+            quarantine.put('gather', guid, reasons, pkg_dict)
+        log_event(log, logging.WARNING, 'gather.quarantined',
+                  job_id=quarantine and quarantine.job_id,
+                  source_id=quarantine and quarantine.source_id, guid=guid,
+                  reasons=reasons)
+        return False
+
+
+    def _quarantine_response(self, url, reason, content, malformed):
+        '''
+        Puts a response of the remote that can not be read in quarantine, so
+        that the search can go on without it.
+
+        :param url: URL of the request.
+        :param reason: Why the response can not be read.
+        :param content: The response, if it was read.
+        :param malformed: Responses in a row that could not be read, with
+                          this one.
+        :raises SearchError: If too many responses in a row could not be
+                             read.
+        '''
+        if malformed >= MAX_MALFORMED_RESPONSES:
+            raise SearchError('%s responses in a row from remote %s could not '
+                              'be read, the last one: %s url %r' %
+                              (malformed, self.REMOTE_NAME, reason, url))
+        quarantine = self.gather_quarantine
+        if quarantine is not None:
+            quarantine.put_response(url, reason, content)
+        log_event(log, logging.WARNING, 'gather.response_quarantined',
+                  job_id=quarantine and quarantine.job_id,
+                  source_id=quarantine and quarantine.source_id, url=url,
+                  reason=reason)
+
+
+    def _checkpoint(self, position):
+        '''
+        Records the position of the searches before the next page is
+        requested, so that a gather that runs out of budget can be continued
+        from there. See GatherBudget.checkpoint.
+        '''
+        budget = self.gather_budget
+        if budget is not None:
+            budget.checkpoint(position)
+
+
+    def _resume_position(self):
+        '''
+        Returns the position to continue the searches from, or None to start
+        from the beginning.
+        '''
+        budget = self.gather_budget
+        if budget is None:
+            return None
+        return budget.resume_position
+
+
+    def validate_config(self, config):
+        '''
+        Harvesters can provide this method to validate the configuration
+        entered in the form. It should return a single string, which will be
+        stored in the database.  Exceptions raised will be shown in the form's
+        error messages.
+
+        :param harvest_object_id: Config string coming from the form
+        :returns: A string with the validated configuration options
+        '''
+        if not config:
+            return config
+
+        config_obj = json.loads(config)
+
+        # Check if the filters and tags are strings or lists of strings
+        for element in self.LIST_OPTIONS:
+            if element not in config_obj:
+                continue
+            if not isinstance(config_obj[element], list):
+                if not isinstance(config_obj[element], basestring):
+                    raise ValueError('%s must be a string '
+                            'or a list of strings, %s is neither' %
+                            (element, config_obj[element]))
+            else:
+                for item in config_obj[element]:
+                    if not isinstance(item, basestring):
+                        raise ValueError('%s must be a string '
+                                'or a list of strings, %s is neither' %
+                                (element, item))
+
+        # Check if the options that switch something on or off are booleans
+        for element in self.BOOL_OPTIONS:
+            if element in config_obj and not isinstance(config_obj[element], bool):
+                    raise ValueError('%s must be a boolean, either True or '
+                                     'False' % element)
+
+        # Check if the sizes and counts are positive integers
+        for element in self.POSITIVE_INT_OPTIONS:
+            if element in config_obj and \
+                    (not isinstance(config_obj[element], int) or
+                     isinstance(config_obj[element], bool) or
+                     config_obj[element] < 1):
+                raise ValueError('%s must be a positive integer' % element)
+
+        # Check if the options with a few possible values have one of them
+        for element, choices in self.CHOICE_OPTIONS.items():
+            if element in config_obj and config_obj[element] not in choices:
+                raise ValueError('%s must be one of %s' %
+                                 (element, ', '.join(choices)))
+
+        # Check if 'snapshot' is the path of a file
+        if 'snapshot' in config_obj and not isinstance(config_obj['snapshot'], basestring):
+                raise ValueError('snapshot must be the path of a snapshot file')
+
+        return json.dumps(config_obj)
+
+
+    @classmethod
+    def _last_error_free_job(cls, harvest_job):
+        '''
+        The harvester uses this method to get the latest job that was completed
+        without any errors occuring. The date and time of this job is useful
+        when trying to find datasets that were updated after the last successful
+        job.
+
+        :param harvest_job: HarvestJob object.
+        :returns: The last fully completed job of the harvester.
+        '''
+        return cls._last_error_free_job_of_source(harvest_job.source,
+                                                  harvest_job.id)
+
+
+    @classmethod
+    def _last_error_free_job_of_source(cls, harvest_source, exclude_job_id=None):
+        '''
+        Gets the latest job of a harvest source that was completed without any
+        errors occuring.
+
+        :param harvest_source: HarvestSource object.
+        :param exclude_job_id: ID of a job that should not be considered,
+                               usually the job that is running.
+        :returns: The last fully completed job of the harvest source.
+        '''
+        # look for jobs with no gather errors
+        jobs = \
+            model.Session.query(HarvestJob) \
+                 .filter(HarvestJob.source == harvest_source) \
+                 .filter(HarvestJob.gather_started != None) \
+                 .filter(HarvestJob.status == 'Finished') \
+                 .filter(HarvestJob.id != exclude_job_id) \
+                 .filter(
+                     ~exists().where(
+                         HarvestGatherError.harvest_job_id == HarvestJob.id)) \
+                 .order_by(HarvestJob.gather_started.desc())
+        # that gathered every dataset, not only until their budget ran out
+        incomplete_job_ids = \
+            DbCheckpointStore(create=False).incomplete_job_ids(
+                harvest_source.id)
+        if incomplete_job_ids:
+            jobs = jobs.filter(~HarvestJob.id.in_(incomplete_job_ids))
+        # now check them until we find one with no fetch/import errors
+        # (looping rather than doing sql, in case there are lots of objects
+        # and lots of jobs)
+
+        for job in jobs:
+            for obj in job.objects:
+                if obj.current is False and \
+                        obj.report_status != 'not modified':
+                    # unsuccessful, so go onto the next job
+                    break
+            else:
+                return job
+
+
+    def _open_url(self, url):
+        '''
+        Opens an HTTP-request towards the API of the remote, without reading
+        the response.
+
+        :param url: String containing the URL to request content from.
+        :returns: The HTTP response, or None if the server answered with an
+                  HTTP error other than 404.
+        :raises GatherBudgetExhausted: If the gather stage running in this
+                                       thread has used up its budget.
+        '''
+        budget = self.gather_budget
+        if budget is not None:
+            budget.charge_request()
+        try:
+            http_request = urllib2.Request(url=url)
+            return urllib2.urlopen(http_request,
+                                   timeout=REQUEST_TIMEOUT)
+
+        except urllib2.HTTPError, e:
+            if e.getcode() == 404:
+                raise ContentNotFoundError('HTTP error: %s' % e.code)
+            else:
+                return None
+        except urllib2.URLError, e:
+            raise ContentFetchError('URL error: %s' % e.reason)
+        except httplib.HTTPException, e:
+            raise ContentFetchError('HTTP Exception: %s' % e)
+        except socket.error, e:
+            raise ContentFetchError('HTTP socket error: %s' % e)
+        except Exception, e:
+            raise ContentFetchError('HTTP general exception: %s' % e)
+
+
+    def _get_content(self, url):
+        '''
+        This methods takes care of any HTTP-request that is made towards the
+        API of the remote.
+
+        :param url: String containing the URL to request content from.
+        :returns: The content from an HTTP-request.
+        '''
+        http_response = self._open_url(url)
+        if http_response is None:
+            return None
+        try:
+            return http_response.read()
+        except (socket.error, httplib.HTTPException), e:
+            raise ContentFetchError('HTTP socket error: %s' % e)
+        finally:
+            http_response.close()
+
+
+    def get_metadata_provenance_for_just_this_harvest(self, harvest_object, reharvest=False):
+        '''
+        This method provides metadata provenance to be used in the 'extras'
+        fields in the datasets that get imported.
+
+        :param: HarvestObject object.
+        :returns: A dictionary containing the harvest source URL and title.
+        '''
+        provenance = {
+                         'activity_occurred': datetime.datetime.utcnow().isoformat(),
+                         'activity': 'harvest',
+                         'harvest_source_url': harvest_object.source.url,
+                         'harvest_source_title': harvest_object.source.title,
+                         'harvest_source_type': harvest_object.source.type,
+                         'harvested_guid': harvest_object.guid
+                     }
+        if reharvest: provenance['activity'] = 'reharvest'
+        return provenance
+
+
+    def get_metadata_provenance(self, harvest_object, harvested_provenance=None):
+        '''Returns the metadata_provenance for a dataset, which is the details
+        of this harvest added onto any existing metadata_provenance value in
+        the dataset. This should be stored in the metadata_provenance extra
+        when harvesting.
+        Provenance is a record of harvests, imports and perhaps other
+        activities of production too, as suggested by W3C PROV.
+        This helps keep track when a dataset is created in site A, imported
+        into site B, harvested into site C and from there is harvested into
+        site D. The metadata_provence will be a list of four dicts with the
+        details: [A, B, C, D].
+        '''
+        reharvest = True
+        if isinstance(harvested_provenance, basestring):
+            harvested_provenance = json.loads(harvested_provenance)
+        elif harvested_provenance is None:
+            harvested_provenance = []
+            reharvest = False
+        metadata_provenance = harvested_provenance + \
+            [self.get_metadata_provenance_for_just_this_harvest(
+                harvest_object, reharvest
+             )]
+        return json.dumps(metadata_provenance)
+
+
+    @classmethod
+    def _changes_searched_from(cls, last_error_free_job):
+        '''
+        Returns the time the searches of the last error-free job started.
+        For a job that completed the searches of partially gathered jobs,
+        this is when the first of them started, and for a job that searched
+        a shared listing, when the listing was fetched, if that was earlier.
+        '''
+        checkpoint = DbCheckpointStore(create=False).get(
+            last_error_free_job.id)
+        if checkpoint is not None and checkpoint['chain_started']:
+            return checkpoint['chain_started']
+        return last_error_free_job.gather_started
+
+
+    def _get_changes_since(self, last_error_free_job):
+        '''
+        Returns the date to search for modified datasets from, given the last
+        error-free job.
+        '''
+        last_time = self._changes_searched_from(last_error_free_job)
+        # Note: SOLR works in UTC, and gather_started is also UTC, so
+        # this should work as long as local and remote clocks are
+        # relatively accurate. Going back a little earlier, just in case.
+        return (last_time - datetime.timedelta(hours=1)).isoformat()
+
+
+    def _search_modified(self, base_url, harvest_job, since, stats):
+        '''
+        Yields the GatherRecords of the datasets of the source that were
+        modified since 'since'.
+
+        :param stats: Dictionary for figures about the search, such as
+                      'bytes_downloaded' and 'bytes_kept'.
+        :raises SearchError: If the remote can not be searched.
+        '''
+        raise NotImplementedError
+
+
+    def _search_everything(self, base_url, harvest_job, stats):
+        '''
+        Yields the GatherRecords of every dataset of the source.
+
+        :raises SearchError: If the remote can not be searched.
+        '''
+        raise NotImplementedError
+
+
+    @profiled('gather', job_of_job)
+    def gather_stage(self, harvest_job):
+        '''
+        The gather stage will receive a HarvestJob object and will be
+        responsible for:
+            - gathering all the necessary objects to fetch on a later.
+              stage (e.g. for a CSW server, perform a GetRecords request)
+            - creating the necessary HarvestObjects in the database, specifying
+              the guid and a reference to its job. The HarvestObjects need a
+              reference date with the last modified date for the resource, this
+              may need to be set in a different stage depending on the type of
+              source.
+            - creating and storing any suitable HarvestGatherErrors that may
+              occur.
+            - returning a list with all the ids of the created HarvestObjects.
+            - to abort the harvest, create a HarvestGatherError and raise an
+              exception. Any created HarvestObjects will be deleted.
+
+        :param harvest_job: HarvestJob object
+        :returns: A list of HarvestObject ids
+        '''
+        log.debug('In %s gather_stage (%s)', self.__class__.__name__,
+                  harvest_job.source.url)
+        toolkit.requires_ckan_version(min_version='2.0')
+        get_all_packages = True
+
+        self._set_config(harvest_job.source.config,
+                         harvest_job.source.id)
+
+        # Get source URL
+        base_url = harvest_job.source.url.rstrip('/')
+
+        quarantine = self.gather_quarantine = Quarantine(
+            harvest_job.id, harvest_job.source_id)
+        self.gather_listed = None
+
+        stats = {}
+        # HarvestObjects are made while the search pages are still being
+        # downloaded
+        package_ids = IdSet()
+        object_ids = []
+        scheduler = ImportScheduler(harvest_job.source_id)
+        health = get_remote_health(self.config)
+        checkpoints = DbCheckpointStore()
+        budget = self.gather_budget = GatherBudget.from_config(self.config)
+        # Set when the budget runs out before every dataset is gathered
+        partial = None
+
+        try:
+            allowed, reason = health.allow_request(base_url)
+            if not allowed:
+                self._save_gather_error('Harvest job postponed: %s' % reason,
+                                        harvest_job)
+                return None
+
+            # Ideally we can request from the remote only those datasets
+            # modified since the last completely successful harvest.
+            last_error_free_job = self._last_error_free_job(harvest_job)
+            get_changes_since = None
+
+            # A job that ran out of budget is continued where it stopped,
+            # with the same searches
+            checkpoint = self._continued_checkpoint(harvest_job, checkpoints)
+            if checkpoint is not None:
+                get_all_packages = checkpoint['mode'] == MODE_EVERYTHING
+                get_changes_since = checkpoint['since']
+                budget.resume_position = checkpoint['position']
+                chain_started = checkpoint['chain_started']
+                log.info('Continuing the searches of partially gathered job '
+                         '%s from %r', checkpoint['job_id'],
+                         checkpoint['position'])
+            else:
+                chain_started = harvest_job.gather_started or \
+                    datetime.datetime.utcnow()
+
+            # Snapshots are always gathered in full
+            if (checkpoint is None and last_error_free_job and
+                    not self.config.get_bool('force_all') and
+                    not self.config.get('snapshot')):
+                get_all_packages = False
+                get_changes_since = \
+                    self._get_changes_since(last_error_free_job)
+
+            if not get_all_packages:
+                # Request only the datasets modified since
+                log.info('Searching for datasets modified since: %s UTC',
+                         get_changes_since)
+
+                try:
+                    self._create_harvest_objects(
+                        self._search_modified(base_url, harvest_job,
+                                              get_changes_since, stats),
+                        harvest_job, package_ids, object_ids, scheduler)
+
+                except SearchError, e:
+                    log.info('Searching for datasets changed since last time '
+                             'gave an error: %s', e)
+                    health.record_failure(base_url, e)
+                    allowed, reason = health.allow_full_fallback(base_url)
+                    if not allowed:
+                        self._delete_harvest_objects(object_ids)
+                        self._save_gather_error(
+                            'Searching for changed datasets failed, and the '
+                            '%s' % reason, harvest_job)
+                        return None
+                    get_all_packages = True
+                    # The full search starts from the beginning
+                    budget.start_over()
+                    checkpoint = None
+                    chain_started = harvest_job.gather_started or \
+                        datetime.datetime.utcnow()
+                except GatherBudgetExhausted, e:
+                    partial = '%s' % e
+                    health.record_success(base_url)
+                else:
+                    health.record_success(base_url)
+
+                if not get_all_packages and not object_ids and not partial:
+                    log.info('No datasets have been updated on the remote '
+                             '%s instance since %s', self.REMOTE_NAME,
+                             get_changes_since)
+                    self._complete_checkpoint(
+                        harvest_job, checkpoint, checkpoints,
+                        self._searched_from(chain_started), MODE_MODIFIED,
+                        get_changes_since)
+                    return None
+
+            # Fall-back option - request all the datasets from the remote
+            if get_all_packages:
+                # Request all remote packages
+                try:
+                    if self.config.get('snapshot'):
+                        records = self._read_snapshot()
+                    else:
+                        records = self._search_everything(base_url,
+                                                          harvest_job, stats)
+                    self._create_harvest_objects(
+                        records, harvest_job, package_ids, object_ids,
+                        scheduler)
+                except SearchError, e:
+                    log.info('Searching for all datasets gave an error: %s', e)
+                    health.record_failure(base_url, e)
+                    self._delete_harvest_objects(object_ids)
+                    self._save_gather_error(
+                        'Unable to search remote %s for datasets:%s url:%s' %
+                        (self.REMOTE_NAME, e, base_url), harvest_job)
+                    return None
+                except GatherBudgetExhausted, e:
+                    partial = '%s' % e
+                health.record_success(base_url)
+
+            if quarantine.responses:
+                # The next job searches for the datasets of the responses
+                # again
+                self._save_gather_error(
+                    '%s responses of remote %s could not be read and were '
+                    'skipped, see the quarantine of the source' %
+                    (quarantine.responses, self.REMOTE_NAME), harvest_job)
+
+            if stats.get('bytes_downloaded'):
+                log.info('Downloaded %s bytes from %s, kept %s bytes (%.1f%%) '
+                         'for %s wanted datasets', stats['bytes_downloaded'],
+                         base_url, stats['bytes_kept'],
+                         100.0 * stats['bytes_kept'] /
+                         stats['bytes_downloaded'], len(object_ids))
+
+            if partial is not None:
+                # The datasets gathered so far are imported, the next job
+                # gathers the rest
+                checkpoints.put({
+                    'job_id': harvest_job.id,
+                    'source_id': harvest_job.source_id,
+                    'state': CHECKPOINT_PARTIAL,
+                    'mode': MODE_EVERYTHING if get_all_packages
+                            else MODE_MODIFIED,
+                    'since': None if get_all_packages else get_changes_since,
+                    'position': budget.position,
+                    'config_digest': self.config.digest,
+                    'chain_started': self._searched_from(chain_started),
+                })
+                log_event(log, logging.INFO, 'gather.partial',
+                          job_id=harvest_job.id,
+                          source_id=harvest_job.source_id, reason=partial,
+                          objects=len(object_ids),
+                          requests=budget.request_count,
+                          position=budget.position)
+                if not object_ids:
+                    return []
+            else:
+                self._complete_checkpoint(
+                    harvest_job, checkpoint, checkpoints,
+                    self._searched_from(chain_started),
+                    MODE_EVERYTHING if get_all_packages else MODE_MODIFIED,
+                    None if get_all_packages else get_changes_since)
+
+            if not object_ids:
+                self._save_gather_error(
+                    'No datasets found at %s: %s' % (self.REMOTE_NAME,
+                                                     base_url), harvest_job)
+                return None
+
+            progress_tracker.set_total(harvest_job.id, harvest_job.source_id,
+                                       len(object_ids))
+            event_aggregator.flush(harvest_job.id)
+            log_event(log, logging.INFO, 'gather.completed',
+                      job_id=harvest_job.id, source_id=harvest_job.source_id,
+                      objects=len(object_ids), full=get_all_packages,
+                      partial=partial is not None,
+                      quarantined=quarantine.count,
+                      import_order=scheduler.counts())
+
+            # New and changed datasets are imported first
+            ordered_ids = scheduler.ordered_ids()
+            self._queue_documents(harvest_job, ordered_ids)
+            return ordered_ids
+        except Exception, e:
+            self._save_gather_error('%r' % e.message, harvest_job)
+        finally:
+            self.gather_budget = None
+            self.gather_quarantine = None
+            self.gather_listed = None
+            if self.config.get_bool('adaptive_frequency'):
+                self._schedule_next_run(harvest_job)
+
+
+    def _schedule_next_run(self, harvest_job):
+        '''
+        Schedules the next job of the source of a job from the changes found
+        by its last jobs, see frequency.
+        '''
+        try:
+            recommendation = source_recommendation(harvest_job.source,
+                                                   self.config)
+            schedule_next_run(harvest_job.source, recommendation,
+                              harvest_job.gather_started or
+                              datetime.datetime.utcnow())
+        except Exception, e:
+            log.error('Could not schedule the next job of source %s: %s',
+                      harvest_job.source_id, e)
+
+
+    def _continued_checkpoint(self, harvest_job, checkpoints):
+        '''
+        Returns the checkpoint of the partially gathered job of the source
+        that this job continues, or None if there is none. The checkpoint is
+        marked as continued, so no other job continues it.
+        '''
+        checkpoint = checkpoints.latest_partial(harvest_job.source_id)
+        if checkpoint is None or checkpoint['job_id'] == harvest_job.id:
+            return None
+        checkpoints.set_state(checkpoint['job_id'], CHECKPOINT_CONTINUED)
+        if checkpoint['config_digest'] != self.config.digest:
+            log.info('The config of the source has changed since job %s was '
+                     'partially gathered, searching from the beginning',
+                     checkpoint['job_id'])
+            return None
+        return checkpoint
+
+
+    def _searched_from(self, chain_started):
+        '''
+        Returns when the searches of the gather stage started: when the
+        first of the jobs they are continued from started, or when the
+        listing they searched was fetched, whichever is earlier.
+        '''
+        listed = self.gather_listed
+        if listed is not None and listed < chain_started:
+            return listed
+        return chain_started
+
+
+    def _complete_checkpoint(self, harvest_job, checkpoint, checkpoints,
+                             searched_from, mode, since):
+        '''
+        Records that a job completed its searches, if they started before
+        the job did: with the first of the partially gathered jobs it
+        continued, or when the shared listing it searched was fetched. The
+        next job searches for changes from then.
+        '''
+        started = harvest_job.gather_started
+        if checkpoint is None and (started is None or searched_from >= started):
+            return
+        if checkpoint is not None:
+            mode = checkpoint['mode']
+            since = checkpoint['since']
+        checkpoints.put({
+            'job_id': harvest_job.id,
+            'source_id': harvest_job.source_id,
+            'state': CHECKPOINT_COMPLETE,
+            'mode': mode,
+            'since': since,
+            'position': None,
+            'config_digest': self.config.digest,
+            'chain_started': searched_from,
+        })
+
+
+    def _create_harvest_objects(self, records, harvest_job, package_ids,
+                                object_ids, scheduler):
+        '''
+        Creates a HarvestObject for each GatherRecord as soon as it is found.
+
+        :param records: Iterable of GatherRecords.
+        :param harvest_job: HarvestJob object
+        :param package_ids: IdSet of the GUIDs that already have a
+                            HarvestObject in this job.
+        :param object_ids: List the IDs of the new HarvestObjects are added to.
+        :param scheduler: ImportScheduler the new HarvestObjects are added to.
+        '''
+        last = time.time()
+        for record in records:
+            if not package_ids.add(record.guid):
+                # Probably due to datasets being changed at the same time
+                # as when the harvester was paging through
+                event_aggregator.count(log, 'gather.duplicate',
+                                       harvest_job.id, harvest_job.source_id,
+                                       guid=record.guid)
+                continue
+
+            # Create and save the harvest object. The content is the JSON
+            # kept from the search, so it is not encoded again.
+            modified = scheduler.modified(record)
+            obj = HarvestObject(guid=record.guid,
+                                job=harvest_job,
+                                content=record.content,
+                                metadata_modified_date=modified)
+            if has_document(record.raw):
+                # The search requested its metadata document already, so it
+                # is not prefetched
+                obj.fetch_finished = datetime.datetime.utcnow()
+            obj.save()
+            object_ids.append(obj.id)
+            scheduler.add(obj.id, record, modified)
+            event_aggregator.count(log, 'gather.object_created',
+                                   harvest_job.id, harvest_job.source_id,
+                                   guid=record.guid, object_id=obj.id)
+
+            # The time since the last object includes the search
+            now = time.time()
+            progress_tracker.record(harvest_job.id, harvest_job.source_id,
+                                    'gather', now - last)
+            last = now
+
+
+    def _read_snapshot(self):
+        '''
+        Yields the GatherRecords of the snapshot file set in the config.
+        '''
+        try:
+            for record in read_snapshot_records(self.config['snapshot']):
+                yield record
+        except SnapshotError, e:
+            raise SearchError('%s' % e)
+
+
+    def _delete_harvest_objects(self, object_ids):
+        '''
+        Deletes the HarvestObjects made by a gather stage that is aborted.
+        '''
+        if not object_ids:
+            return
+        model.Session.query(HarvestObject) \
+             .filter(HarvestObject.id.in_(object_ids)) \
+             .delete(synchronize_session=False)
+        model.Session.commit()
+        del object_ids[:]
+
+
+    def _fetches_documents(self):
+        '''
+        Returns True if the fetch stage adds the full metadata document of
+        each dataset to the content of its HarvestObject, see
+        _get_document_url.
+        '''
+        return False
+
+
+    def _get_document_url(self, base_url, guid):
+        '''
+        Returns the URL of the full metadata document of a dataset, which
+        the fetch stage adds to the content of its HarvestObject, or None if
+        the search result is the whole record.
+        '''
+        return None
+
+
+    def _get_prefetch_store(self):
+        return DbPrefetchStore()
+
+
+    def _queue_documents(self, harvest_job, object_ids):
+        '''
+        Queues the objects of a job for the prefetching of their documents,
+        in the order they are imported in.
+        '''
+        if not self._fetches_documents():
+            return
+        try:
+            self._get_prefetch_store().add(harvest_job.source_id,
+                                           harvest_job.id, object_ids)
+        except Exception, e:
+            # Each fetch stage then requests the document of its own object
+            log.warning('Could not queue the objects of job %s for '
+                        'prefetching: %s', harvest_job.id, e)
+
+
+    def _fetch_document(self, url):
+        '''
+        Requests the full metadata document of a dataset. Called by the
+        threads of the prefetcher.
+
+        :returns: The document, as JSON text.
+        :raises ContentFetchError: If the document can not be requested.
+        :raises MalformedContentError: If the response is not a JSON object.
+        '''
+        content = self._get_content(url)
+        if content is None:
+            raise ContentFetchError('HTTP error from %s' % url)
+        try:
+            document = content.decode('utf-8')
+            if not isinstance(json.loads(document), dict):
+                raise ValueError('the response is not an object')
+        except ValueError, e:
+            raise MalformedContentError('Response from remote %s was not a '
+                                        'metadata document: %s' %
+                                        (self.REMOTE_NAME, e),
+                                        content.decode('utf-8', 'replace'))
+        return document
+
+
+    def _get_document_modified(self, document):
+        '''
+        Returns the modified date of a metadata document, or None.
+
+        :param document: The document, as JSON text.
+        '''
+        if self.MODIFIED_KEY is None:
+            return None
+        try:
+            return parse_modified(json.loads(document).get(self.MODIFIED_KEY))
+        except (ValueError, AttributeError):
+            return None
+
+
+    def _add_document(self, values, content, document):
+        '''
+        Adds the values a HarvestObject gets with its metadata document to
+        'values': the content with the document, and the modified date of
+        the document, if it has one.
+
+        :returns: The values.
+        '''
+        values['content'] = add_document(content, document)
+        modified = self._get_document_modified(document)
+        if modified is not None:
+            values['metadata_modified_date'] = modified
+        return values
+
+
+    @profiled('fetch', job_of_object)
+    def fetch_stage(self, harvest_object):
+        '''
+        The fetch stage will receive a HarvestObject object and will be
+        responsible for:
+            - getting the contents of the remote object (e.g. for a CSW
+              server, perform a GetRecordById request).
+            - saving the content in the provided HarvestObject.
+            - creating and storing any suitable HarvestObjectErrors that may
+              occur.
+            - returning True if everything is ok (ie the object should now
+              be imported), "unchanged" if the object didn't need harvesting
+              after all (ie no error, but don't continue to import stage) or
+              False if there were errors.
+
+        The search results are the content of the HarvestObjects already.
+        Only harvesters whose search results are not the whole record add
+        the full metadata document of the dataset here, see prefetch.
+
+        :param harvest_object: HarvestObject object
+        :returns: True if the object can be imported, False if its document
+                  could not be requested.
+        '''
+        self._set_config(harvest_object.job.source.config,
+                         harvest_object.job.source_id)
+        base_url = harvest_object.source.url.rstrip('/')
+        url = self._get_document_url(base_url, harvest_object.guid)
+        if url is None:
+            return True
+
+        prefetcher = get_prefetcher(harvest_object.harvest_job_id,
+                                    self._fetch_document,
+                                    self.config.get_int('prefetch_window',
+                                                    DEFAULT_WINDOW))
+        self._prefetch(prefetcher, harvest_object, base_url)
+        if has_document(harvest_object.content):
+            return True
+
+        try:
+            document = prefetcher.get(url)
+        except ContentFetchError, e:
+            if isinstance(e, MalformedContentError):
+                Quarantine(harvest_object.harvest_job_id,
+                           harvest_object.job.source_id).put(
+                    'fetch', harvest_object.guid, ['%s' % e], e.content)
+            self._save_object_error('Could not get the metadata document of '
+                                    'dataset %s from %s: %s' %
+                                    (harvest_object.guid, url, e),
+                                    harvest_object, 'Fetch')
+            return False
+        values = self._add_document({}, harvest_object.content, document)
+        for key, value in values.iteritems():
+            setattr(harvest_object, key, value)
+        harvest_object.save()
+        return True
+
+
+    def _prefetch(self, prefetcher, harvest_object, base_url):
+        '''
+        Writes the documents the prefetcher has received into the content of
+        their HarvestObjects, and requests the documents of the next objects
+        of the job that are waiting to be fetched, in import order, as many
+        as fit in the window.
+        '''
+        store = self._get_prefetch_store()
+        completed = prefetcher.completed()
+        if completed:
+            documents = dict((object_id, document)
+                             for object_id, document, error in completed)
+            fetch_finished = datetime.datetime.utcnow()
+            values_by_id = {}
+            for object_id, content in \
+                    store.contents(documents.keys()).iteritems():
+                values = {'fetch_finished': fetch_finished}
+                # Objects whose request failed request it again in their own
+                # fetch stage
+                if documents[object_id] is not None and \
+                        not has_document(content):
+                    values = self._add_document(values, content,
+                                                documents[object_id])
+                values_by_id[object_id] = values
+            store.update(values_by_id)
+
+        free = prefetcher.free
+        if free <= 0:
+            return
+        for object_id, guid in store.claim(harvest_object.harvest_job_id,
+                                           free):
+            prefetcher.request(object_id,
+                               self._get_document_url(base_url, guid))
+
+
+    def _map_package_dict(self, package_dict, harvest_object):
+        '''
+        Turns the dictionary of a remote dataset into a CKAN package
+        dictionary, with 'owner_org' set to the name of the local
+        organization of its publisher.
+        '''
+        raise NotImplementedError
+
+
+    def _get_organization(self, package_dict):
+        '''
+        Returns the dictionary of the organization to create for a dataset
+        if it does not exist yet, or None if the dataset has no publisher.
+        '''
+        if not package_dict.get('owner_org'):
+            return None
+        return {'name': package_dict['owner_org']}
+
+
+    def _get_identifiers(self, package_dict):
+        '''
+        Returns the external identifiers of a dataset for the identity
+        index, given its CKAN package dictionary. Identifiers can be UUIDs,
+        URLs or any other strings, and lists of them.
+        '''
+        return [package_dict.get('id'), package_dict.get('url')]
+
+
+    def _check_identity(self, package_dict, harvest_object, base_context):
+        '''
+        Claims the identifiers of a dataset in the identity index.
+
+        :returns: None if the dataset is to be imported, or the result of
+                  the import stage if another source has harvested it
+                  already, as set by 'cross_source_duplicates' in the config.
+        '''
+        policy = self.config.get('cross_source_duplicates', 'skip')
+        if policy == 'import':
+            return None
+
+        def package_exists(package_id):
+            package = model.Package.get(package_id)
+            return package is not None and package.state != 'deleted'
+
+        source_id = harvest_object.job.source_id
+        identifiers = dataset_identifiers(self._get_identifiers(package_dict))
+        claim = IdentityIndex().claim(identifiers, package_dict['id'],
+                                      source_id, package_exists)
+        if claim is None or claim['source_id'] == source_id:
+            return None
+
+        event_aggregator.count(log, 'import.duplicate',
+                               harvest_object.harvest_job_id, source_id,
+                               guid=harvest_object.guid,
+                               package_id=claim['package_id'],
+                               identifier=claim['identifier'])
+        if policy == 'merge':
+            return self._merge_into(claim['package_id'], package_dict,
+                                    base_context)
+        return 'unchanged'
+
+
+    def _merge_into(self, package_id, package_dict, base_context):
+        '''
+        Adds the resources of a dataset that a package harvested by another
+        source does not have yet to that package.
+        '''
+        existing = get_action('package_show')(base_context.copy(),
+                                              {'id': package_id})
+        resources = existing.get('resources') or []
+        urls = set(resource.get('url') for resource in resources)
+        new_resources = [resource for resource
+                         in package_dict.get('resources') or []
+                         if resource.get('url') not in urls]
+        if not new_resources:
+            return 'unchanged'
+        get_action('package_patch')(base_context.copy(),
+                                    {'id': package_id,
+                                     'resources': resources + new_resources})
+        return True
+
+
+    def index_identities(self, harvest_source, index=None):
+        '''
+        Claims the identifiers of the datasets a source has imported in the
+        identity index, e.g. for those imported before the index existed.
+        Datasets that another source has claimed already are left out.
+
+        :param harvest_source: HarvestSource object
+        :param index: IdentityIndex to claim the identifiers in.
+        :returns: A tuple (claimed, duplicates), where 'claimed' is the number
+                  of datasets whose identifiers were claimed, and 'duplicates'
+                  a list of tuples (package ID, claim of the other package).
+        '''
+        index = index or IdentityIndex()
+        self._set_config(harvest_source.config, harvest_source.id)
+        objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_source_id == harvest_source.id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.package_id != None)
+        claimed = 0
+        duplicates = []
+        for harvest_object in objects.yield_per(100):
+            try:
+                package_dict = self._map_package_dict(
+                    json.loads(harvest_object.content), harvest_object)
+            except Exception, e:
+                log.warning('Could not map HarvestObject %s: %s',
+                            harvest_object.id, e)
+                continue
+            identifiers = dataset_identifiers(
+                self._get_identifiers(package_dict))
+            claim = index.claim(identifiers, harvest_object.package_id,
+                                harvest_source.id)
+            if claim is None:
+                claimed += 1
+            else:
+                duplicates.append((harvest_object.package_id, claim))
+        return claimed, duplicates
+
+
+    def _organization_imported(self, org, created, package_dict):
+        '''
+        Called with the organization of each imported dataset.
+
+        :param created: True if the organization was created by this import.
+        '''
+        pass
+
+
+    def _set_owner_org(self, package_dict, harvest_object, base_context):
+        '''
+        Sets the owner organization of a package, creating the organization
+        of its publisher if 'create_orgs' is set in the config, and using the
+        organization of the harvest source otherwise.
+        '''
+        # Local harvest source organization
+        source_dataset = \
+            get_action('package_show')(base_context.copy(),
+                                       {'id': harvest_object.source.id})
+        local_org = source_dataset.get('owner_org')
+
+        create_orgs = self.config.get_bool('create_orgs', True)
+
+        if not create_orgs:
+            # Assign dataset to the source organization
+            package_dict['owner_org'] = local_org
+            return
+
+        validated_org = None
+        new_org = self._get_organization(package_dict)
+        if new_org:
+            try:
+                org, created = upsert_organization(base_context, new_org)
+                self._organization_imported(org, created, package_dict)
+                validated_org = org['id']
+            except (RemoteResourceError, ValidationError):
+                log.error('Could not get remote org %s', new_org['name'])
+
+        package_dict['owner_org'] = validated_org or local_org
+
+
+    def _set_provenance(self, package_dict, harvest_object, base_context):
+        '''
+        Adds the metadata provenance of this harvest to the extras of a
+        package, after that of the earlier harvests of the dataset.
+        '''
+        if not 'extras' in package_dict:
+            package_dict['extras'] = []
+
+        data_dict = {'id': package_dict['id']}
+        preexisting_provenance = None
+        try:
+            preexisting_package_dict = \
+                get_action('package_show')(base_context.copy(), data_dict)
+            user_prompted = False
+            keep_modifications = None
+
+            for extra in preexisting_package_dict['extras']:
+                if extra.get('key') == 'metadata_provenance':
+                    preexisting_provenance = extra.get('value')
+                else:
+                    if not user_prompted:
+                        keep_modifications = raw_input(
+                            'Dataset with ID %s is already imported, but '
+                            'contains user modifications. Do you wish to '
+                            'keep the modifications to this dataset? '
+                            '[y/n] '
+                            % package_dict.get('id', None)
+                        )
+                        user_prompted = True
+                    if keep_modifications == 'y':
+                        package_dict['extras'].append(extra)
+                        log.info('Keeping user modifications for dataset '
+                                 'with ID %s', package_dict.get('id', None))
+                    else:
+                        log.info('User modifications were discarded for '
+                                 'dataset with ID %s.',
+                                 package_dict.get('id', None))
+        except Exception as e:
+            pass
+
+        metadata_provenance = self.get_metadata_provenance(
+            harvest_object, preexisting_provenance)
+        package_dict['extras'].append({'key': 'metadata_provenance',
+                                       'value': metadata_provenance})
+
+
+    @profiled('import', job_of_object)
+    def import_stage(self, harvest_object):
+        '''
+        The import stage will receive a HarvestObject object and will be
+        responsible for:
+            - performing any necessary action with the fetched object (e.g.
+              create, update or delete a package).
+              Note: if this stage creates or updates a package, a reference
+              to the package should be added to the HarvestObject.
+            - setting the HarvestObject.package (if there is one)
+            - setting the HarvestObject.current for this harvest:
+               - True if successfully created/updated
+               - False if successfully deleted
+            - setting HarvestObject.current to False for previous harvest
+              objects of this harvest source if the action was successful.
+            - creating and storing any suitable HarvestObjectErrors that may
+              occur.
+            - creating the HarvestObject - Package relation (if necessary)
+            - returning True if the action was done, "unchanged" if the object
+              didn't need harvesting after all or False if there were errors.
+
+        NB You can run this stage repeatedly using 'paster harvest import'.
+
+        :param harvest_object: HarvestObject object
+        :returns: True if the action was done, "unchanged" if the object didn't
+                  need harvesting after all or False if there were errors.
+        '''
+        started = time.time()
+        result = self._import_object(harvest_object)
+        if harvest_object:
+            progress_tracker.record(harvest_object.harvest_job_id,
+                                    harvest_object.job.source_id, 'import',
+                                    time.time() - started, result is not False)
+        return result
+
+
+    def _import_object(self, harvest_object):
+        '''
+        Imports a HarvestObject, see import_stage.
+        '''
+        log.debug('In %s import_stage', self.__class__.__name__)
+
+        base_context = {'model': model, 'session': model.Session,
+                        'user': self._get_user_name()}
+        if not harvest_object:
+            log.error('No harvest object received')
+            return False
+
+        if harvest_object.content is None:
+            self._save_object_error('Empty content for object %s' %
+                                    harvest_object.id,
+                                    harvest_object, 'Import')
+            return False
+
+        self._set_config(harvest_object.job.source.config,
+                         harvest_object.job.source_id)
+
+        try:
+            package_dict = json.loads(harvest_object.content)
+            if package_dict.get('type') == 'harvest':
+                log.warn('Remote dataset is a harvest source, ignoring...')
+                return True
+
+            # Objects gathered before records were validated, and snapshots,
+            # may hold invalid records
+            reasons = self.RECORD_SCHEMA.validate(package_dict) \
+                if self.RECORD_SCHEMA is not None else []
+            if reasons:
+                Quarantine(harvest_object.harvest_job_id,
+                           harvest_object.job.source_id).put(
+                    'import', harvest_object.guid, reasons,
+                    harvest_object.content)
+                self._save_object_error('Invalid record with GUID %s: %s' %
+                                        (harvest_object.guid,
+                                         '; '.join(reasons)),
+                                        harvest_object, 'Import')
+                log_event(log, logging.ERROR, 'import.quarantined',
+                          job_id=harvest_object.harvest_job_id,
+                          source_id=harvest_object.job.source_id,
+                          object_id=harvest_object.id,
+                          guid=harvest_object.guid, reasons=reasons)
+                return False
+
+            package_dict = self._map_package_dict(package_dict,
+                                                  harvest_object)
+            # Datasets harvested by another source already are not imported
+            # again
+            result = self._check_identity(package_dict, harvest_object,
+                                          base_context)
+            if result is not None:
+                return result
+
+            self._set_owner_org(package_dict, harvest_object, base_context)
+            self._set_provenance(package_dict, harvest_object, base_context)
+
+            result = self._create_or_update_package(
+                package_dict, harvest_object, package_dict_form='package_show')
+
+            if result is True or result == 'unchanged':
+                event_aggregator.count(
+                    log, 'import.unchanged' if result == 'unchanged'
+                    else 'import.imported', harvest_object.harvest_job_id,
+                    harvest_object.job.source_id, guid=harvest_object.guid,
+                    package_id=package_dict.get('id'))
+            else:
+                log_event(log, logging.ERROR, 'import.failed',
+                          job_id=harvest_object.harvest_job_id,
+                          source_id=harvest_object.job.source_id,
+                          object_id=harvest_object.id,
+                          guid=harvest_object.guid,
+                          package_id=package_dict.get('id'))
+
+            return result
+        except ValidationError, e:
+            self._save_object_error('Invalid package with GUID %s: %r' %
+                                    (harvest_object.guid, e.error_dict),
+                                    harvest_object, 'Import')
+            log_event(log, logging.ERROR, 'import.invalid',
+                      job_id=harvest_object.harvest_job_id,
+                      source_id=harvest_object.job.source_id,
+                      object_id=harvest_object.id, guid=harvest_object.guid,
+                      errors=e.error_dict)
+        except Exception, e:
+            self._save_object_error('%s' % e, harvest_object, 'Import')
+            log_event(log, logging.ERROR, 'import.failed', exc_info=True,
+                      job_id=harvest_object.harvest_job_id,
+                      source_id=harvest_object.job.source_id,
+                      object_id=harvest_object.id, guid=harvest_object.guid,
+                      error='%s' % e)
+        return False
+
+
+class SearchError(Exception):
+    pass
+
+class RemoteResourceError(Exception):
+    pass
+
+class ContentFetchError(Exception):
+    pass
+
+class ContentNotFoundError(ContentFetchError):
+    pass
+
+class MalformedContentError(ContentFetchError):
+    def __init__(self, message, content=None):
+        ContentFetchError.__init__(self, message)
+        self.content = content
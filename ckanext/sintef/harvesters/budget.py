@@ -0,0 +1,278 @@
+'''
+Time and request budgets of gather stages.
+
+A gather of a source with many searches, or of a slow remote, can hold a
+gather consumer for hours and keep every other source waiting. With
+"gather_seconds" and/or "gather_requests" in the source config, or
+ckanext.sintef.gather_seconds and ckanext.sintef.gather_requests in the CKAN
+config, a gather stops once it has used up its budget. The HarvestObjects
+created so far are kept and imported as usual, and the job is recorded as
+partially gathered in the 'sintef_gather_checkpoint' table, with the
+position in the searches where it stopped. The next job of the source
+continues the searches from there, with the same search for modified
+datasets, instead of starting a new one.
+
+The searches tell the budget where they are before each page they request,
+with GatherBudget.checkpoint(). A budget only stops a gather that has made
+progress since it started, so a search that does not checkpoint, like a
+sharded gather, runs to the end whatever its budget, and a gather that can
+not get past its first page with the budget it has is not stopped forever.
+
+Partially gathered jobs are not used as the last error-free job of their
+source. The job that completes the searches is, from the time the first job
+of the searches started.
+'''
+import time
+import datetime
+import threading
+
+from pylons import config
+
+from ckan import model
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# States of the checkpoint of a job
+CHECKPOINT_PARTIAL = u'partial'
+CHECKPOINT_CONTINUED = u'continued'
+CHECKPOINT_COMPLETE = u'complete'
+
+# The searches a job does
+MODE_MODIFIED = u'modified'
+MODE_EVERYTHING = u'everything'
+
+
+class GatherBudgetExhausted(Exception):
+    pass
+
+
+class GatherBudget(object):
+    '''
+    The time and requests a gather stage may use.
+
+    :param seconds: Seconds the gather may run, or None for no limit.
+    :param requests: Requests the gather may send to the remote, or None for
+                     no limit.
+    :param resume_position: Position to continue the searches from, from the
+                            checkpoint of an earlier job.
+    '''
+
+    def __init__(self, seconds=None, requests=None, resume_position=None):
+        self.seconds = seconds
+        self.requests = requests
+        self.resume_position = resume_position
+        self.position = None
+        self.request_count = 0
+        self.started = time.time()
+
+
+    @classmethod
+    def from_config(cls, source_config):
+        '''
+        Returns the budget of a gather of a source, with the limits of the
+        source config, or else those of the CKAN config.
+        '''
+        seconds = source_config.get_int('gather_seconds') or \
+            int(config.get('ckanext.sintef.gather_seconds', 0))
+        requests = source_config.get_int('gather_requests') or \
+            int(config.get('ckanext.sintef.gather_requests', 0))
+        return cls(seconds or None, requests or None)
+
+
+    def exhausted(self):
+        '''
+        Returns why the budget is used up, or None if it is not.
+        '''
+        if self.requests is not None and self.request_count >= self.requests:
+            return 'used its %s requests' % self.requests
+        if self.seconds is not None and \
+                time.time() - self.started >= self.seconds:
+            return 'ran for its %s seconds' % self.seconds
+        return None
+
+
+    def checkpoint(self, position):
+        '''
+        Records where the searches are, before they request the next page.
+        Everything found before this position has been gathered.
+
+        :param position: Dictionary that can be encoded as JSON.
+        '''
+        self.position = position
+
+
+    def start_over(self):
+        '''
+        Forgets the position of the searches, when other searches are done
+        from the beginning instead.
+        '''
+        self.resume_position = None
+        self.position = None
+
+
+    def charge_request(self):
+        '''
+        Counts a request to the remote.
+
+        :raises GatherBudgetExhausted: If the budget is used up and the
+                                       searches have made progress since the
+                                       gather started.
+        '''
+        if self.position is not None and \
+                self.position != self.resume_position:
+            reason = self.exhausted()
+            if reason is not None:
+                raise GatherBudgetExhausted(reason)
+        self.request_count += 1
+
+
+class DbCheckpointStore(object):
+    '''
+    Keeps the checkpoints of gathers in the 'sintef_gather_checkpoint'
+    table.
+
+    :param create: Create the tables of the SINTEF harvesters if they do not
+                   exist yet. Without it, the store only reads, and finds no
+                   checkpoints while the table does not exist, e.g. when a
+                   harvest is only planned.
+    '''
+
+    def __init__(self, create=True):
+        from ckanext.sintef import model as sintef_model
+        if create:
+            sintef_model.setup()
+        self.table = sintef_model.gather_checkpoint_table
+        self._exists = True if create else None
+
+
+    @property
+    def session(self):
+        return model.Session
+
+
+    @property
+    def exists(self):
+        '''
+        True if the table exists.
+        '''
+        if self._exists is None:
+            self._exists = self.table.exists()
+        return self._exists
+
+
+    def _decode(self, row):
+        checkpoint = dict(row)
+        checkpoint['position'] = json.loads(row['position'] or 'null')
+        return checkpoint
+
+
+    def latest_partial(self, source_id):
+        '''
+        Returns the checkpoint of the last partially gathered job of a
+        source that has not been continued, or None.
+        '''
+        table = self.table
+        row = self.session.execute(table.select().where(
+            (table.c.source_id == source_id) &
+            (table.c.state == CHECKPOINT_PARTIAL))
+            .order_by(table.c.created.desc()).limit(1)).first()
+        if row is None:
+            return None
+        return self._decode(row)
+
+
+    def get(self, job_id):
+        if not self.exists:
+            return None
+        table = self.table
+        row = self.session.execute(
+            table.select().where(table.c.job_id == job_id)).first()
+        if row is None:
+            return None
+        return self._decode(row)
+
+
+    def put(self, checkpoint):
+        table = self.table
+        values = dict(checkpoint,
+                      position=json.dumps(checkpoint.get('position')),
+                      created=datetime.datetime.utcnow())
+        result = self.session.execute(table.update().where(
+            table.c.job_id == checkpoint['job_id']).values(**values))
+        if result.rowcount == 0:
+            self.session.execute(table.insert().values(**values))
+        self.session.commit()
+
+
+    def set_state(self, job_id, state):
+        table = self.table
+        self.session.execute(table.update().where(
+            table.c.job_id == job_id).values(state=state))
+        self.session.commit()
+
+
+    def incomplete_job_ids(self, source_id):
+        '''
+        Returns the IDs of the jobs of a source that only gathered part of
+        the datasets.
+        '''
+        if not self.exists:
+            return []
+        table = self.table
+        rows = self.session.execute(
+            table.select().where((table.c.source_id == source_id) &
+                                 (table.c.state != CHECKPOINT_COMPLETE)))
+        return [row['job_id'] for row in rows.fetchall()]
+
+
+class MemoryCheckpointStore(object):
+    '''
+    Keeps the checkpoints of gathers in memory, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self._checkpoints = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+
+    def latest_partial(self, source_id):
+        self._lock.acquire()
+        try:
+            found = [checkpoint for checkpoint in self._checkpoints.values()
+                     if checkpoint['source_id'] == source_id and
+                     checkpoint['state'] == CHECKPOINT_PARTIAL]
+        finally:
+            self._lock.release()
+        if not found:
+            return None
+        return dict(max(found, key=lambda checkpoint: checkpoint['order']))
+
+
+    def get(self, job_id):
+        checkpoint = self._checkpoints.get(job_id)
+        return dict(checkpoint) if checkpoint is not None else None
+
+
+    def put(self, checkpoint):
+        self._lock.acquire()
+        try:
+            self._counter += 1
+            self._checkpoints[checkpoint['job_id']] = dict(
+                checkpoint, order=self._counter)
+        finally:
+            self._lock.release()
+
+
+    def set_state(self, job_id, state):
+        if job_id in self._checkpoints:
+            self._checkpoints[job_id]['state'] = state
+
+
+    def incomplete_job_ids(self, source_id):
+        return [job_id for job_id, checkpoint in self._checkpoints.items()
+                if checkpoint['source_id'] == source_id and
+                checkpoint['state'] != CHECKPOINT_COMPLETE]
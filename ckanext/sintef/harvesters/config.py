@@ -0,0 +1,173 @@
+'''
+Decoded configs of harvest sources, shared by every stage and thread.
+
+The config string of a source is decoded once per process, and the result is
+reused for as long as the string does not change. A SourceConfig can not be
+changed, so import workers running at the same time can share it.
+'''
+import hashlib
+import threading
+from collections import Mapping
+
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Number of decoded configs kept per process
+CACHE_SIZE = 256
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return SourceConfig(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class SourceConfig(Mapping):
+    '''
+    Immutable config of a harvest source. It is read like a dictionary, with
+    lists turned into tuples. Options that are a string or a list of strings
+    are also available normalized, with get_list(), and booleans and
+    integers are read with get_bool() and get_int(), which return the
+    default for a value of another type.
+
+    :param config_dict: The decoded config.
+    :param source_id: ID of the harvest source.
+    :param digest: SHA-1 of the config string.
+    '''
+
+    def __init__(self, config_dict=None, source_id=None, digest=None):
+        self.source_id = source_id
+        self.digest = digest
+        self._data = {}
+        self._lists = {}
+        self._derived = {}
+        for key, value in (config_dict or {}).iteritems():
+            self._data[key] = _freeze(value)
+            if isinstance(value, basestring):
+                self._lists[key] = (value,)
+            elif isinstance(value, list) and \
+                    all(isinstance(item, basestring) for item in value):
+                self._lists[key] = tuple(value)
+        self._frozen = True
+
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+
+    def __iter__(self):
+        return iter(self._data)
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __repr__(self):
+        return 'SourceConfig(%r, source_id=%r)' % (self._data, self.source_id)
+
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('SourceConfig can not be changed')
+        object.__setattr__(self, name, value)
+
+
+    def get_list(self, key, default=None):
+        '''
+        Returns an option that is a string or a list of strings as a tuple.
+        '''
+        return self._lists.get(key, default)
+
+
+    def get_bool(self, key, default=False):
+        value = self._data.get(key, default)
+        if not isinstance(value, bool):
+            return default
+        return value
+
+
+    def get_int(self, key, default=None):
+        value = self._data.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            return default
+        return value
+
+
+    def derived(self, name, factory):
+        '''
+        Returns an object made from this config by 'factory', such as the
+        filters of a source. The object is made once and shared, so it must
+        not be changed either.
+
+        :param name: Name the object is kept under.
+        :param factory: Callable that takes this config.
+        '''
+        try:
+            return self._derived[name]
+        except KeyError:
+            # Two threads may both make it, but only one is kept
+            return self._derived.setdefault(name, factory(self))
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_source_config(config_str, source_id=None):
+    '''
+    Returns the SourceConfig of a config string, decoding it only if it has
+    not been decoded before in this process.
+
+    :param config_str: Config string of the harvest source.
+    :param source_id: ID of the harvest source.
+    :raises ValueError: If the config string is not valid JSON.
+    '''
+    config_str = config_str or ''
+    if isinstance(config_str, unicode):
+        encoded = config_str.encode('utf-8')
+    else:
+        encoded = config_str
+    key = (source_id, hashlib.sha1(encoded).hexdigest())
+
+    config = _cache.get(key)
+    if config is not None:
+        return config
+
+    config_dict = json.loads(config_str) if config_str else {}
+    config = SourceConfig(config_dict, source_id, key[1])
+    log.debug('Using config: %r', config)
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        config = _cache.setdefault(key, config)
+    return config
+
+
+class ThreadLocalConfigMixin(object):
+    '''
+    Mixin for harvesters that keeps the config set by _set_config separate
+    for each thread, since the plugin object is shared by all of them.
+    '''
+
+    @property
+    def config(self):
+        return getattr(self._get_config_local(), 'config', None)
+
+
+    @config.setter
+    def config(self, value):
+        self._get_config_local().config = value
+
+
+    def _get_config_local(self):
+        try:
+            return self.__dict__['_config_local']
+        except KeyError:
+            return self.__dict__.setdefault('_config_local',
+                                            threading.local())
@@ -0,0 +1,210 @@
+'''
+Delta updates of harvested packages.
+
+When a harvested dataset exists locally already, the package made by the
+import stage is compared with the stored one, and only the fields that
+differ are written with package_patch. Resources are matched by URL and
+keep their IDs. A reharvest of a dataset that has not changed writes
+nothing.
+
+The resource actions of CKAN update the whole package internally, so a
+single package_patch is used even when only resources changed.
+'''
+from sqlalchemy import update, bindparam
+
+from ckan import model
+from ckan.logic import NotFound, get_action
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Package fields the harvesters manage. Fields that are computed by CKAN,
+# like 'isopen' or 'metadata_modified', are never compared.
+PACKAGE_FIELDS = ('title', 'notes', 'url', 'owner_org', 'license_id',
+                  'version', 'author', 'author_email', 'maintainer',
+                  'maintainer_email')
+
+RESOURCE_FIELDS = ('url', 'name', 'format', 'mimetype', 'description')
+
+# Extras that change on every harvest and are only worth writing together
+# with a real change.
+VOLATILE_EXTRAS = ('metadata_provenance',)
+
+
+def _normalize(value):
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _tag_name(tag):
+    if isinstance(tag, dict):
+        return tag.get('name')
+    return tag
+
+
+class PackageDelta(object):
+    '''
+    Difference between a package made by the import stage and the stored
+    package with the same ID.
+
+    :param fields: Dictionary of the top-level fields that changed, with
+                   their new values.
+    :param resources: The new list of resources, with the IDs of the stored
+                      resources they replace.
+    :param resources_changed: True if a resource was added, removed, moved
+                              or changed.
+    '''
+
+    def __init__(self, fields, resources, resources_changed):
+        self.fields = fields
+        self.resources = resources
+        self.resources_changed = resources_changed
+
+
+    @property
+    def changed(self):
+        return bool(self.fields or self.resources_changed)
+
+
+def diff_resources(new_resources, old_resources):
+    '''
+    Matches new resources with stored ones by URL, and returns the new list
+    of resources, and whether it differs from the stored one.
+    '''
+    unmatched = {}
+    for old_resource in old_resources:
+        unmatched.setdefault(_normalize(old_resource.get('url')),
+                             []).append(old_resource)
+
+    resources = []
+    changed = False
+    for new_resource in new_resources:
+        resource = dict(new_resource)
+        candidates = unmatched.get(_normalize(new_resource.get('url')))
+        if not candidates:
+            changed = True
+            resources.append(resource)
+            continue
+
+        old_resource = candidates.pop(0)
+        resource['id'] = old_resource['id']
+        for field in RESOURCE_FIELDS:
+            if _normalize(new_resource.get(field)) != \
+                    _normalize(old_resource.get(field)):
+                changed = True
+        resources.append(resource)
+
+    # Removed or moved resources
+    if [resource.get('id') for resource in resources] != \
+            [resource['id'] for resource in old_resources]:
+        changed = True
+
+    return resources, changed
+
+
+def diff_package(new, old):
+    '''
+    Compares a package made by the import stage with the stored package.
+
+    :param new: Package dictionary made by the import stage.
+    :param old: Package dictionary returned by package_show.
+    :returns: A PackageDelta.
+    '''
+    fields = {}
+    for field in PACKAGE_FIELDS:
+        if field in new and \
+                _normalize(new[field]) != _normalize(old.get(field)):
+            fields[field] = new[field]
+
+    new_tags = set(_tag_name(tag) for tag in new.get('tags', []))
+    old_tags = set(_tag_name(tag) for tag in old.get('tags', []))
+    if new_tags != old_tags:
+        fields['tags'] = [{'name': name} for name in sorted(new_tags)]
+
+    new_extras = dict((extra['key'], extra['value'])
+                      for extra in new.get('extras', []))
+    old_extras = dict((extra['key'], extra['value'])
+                      for extra in old.get('extras', []))
+    for key in VOLATILE_EXTRAS:
+        new_extras.pop(key, None)
+        old_extras.pop(key, None)
+
+    resources, resources_changed = diff_resources(new.get('resources', []),
+                                                  old.get('resources', []))
+
+    if fields or resources_changed or new_extras != old_extras:
+        # Volatile extras are written along with the real changes
+        fields['extras'] = new.get('extras', [])
+    return PackageDelta(fields, resources, resources_changed)
+
+
+def apply_package_delta(context, package_id, delta):
+    '''
+    Writes a PackageDelta with a single package_patch.
+
+    :param context: Context for the action.
+    :param package_id: ID of the stored package.
+    :param delta: A PackageDelta.
+    :returns: The updated package dictionary.
+    '''
+    data_dict = dict(delta.fields, id=package_id)
+    if delta.resources_changed:
+        data_dict['resources'] = delta.resources
+    return get_action('package_patch')(context.copy(), data_dict)
+
+
+class DeltaUpdateMixin(object):
+    '''
+    Mixin for harvesters that replaces the full package_update of existing
+    packages in HarvesterBase._create_or_update_package with a delta update.
+    Set 'delta_update' to false in the source config to turn it off.
+    '''
+
+    def _create_or_update_package(self, package_dict, harvest_object,
+                                  package_dict_form='rest'):
+        if not self.config.get_bool('delta_update', True):
+            return super(DeltaUpdateMixin, self)._create_or_update_package(
+                package_dict, harvest_object, package_dict_form)
+
+        context = {'model': model, 'session': model.Session,
+                   'user': self._get_user_name(), 'ignore_auth': True}
+        try:
+            existing_package_dict = get_action('package_show')(
+                context.copy(), {'id': package_dict['id']})
+        except NotFound:
+            # New packages are created as usual
+            return super(DeltaUpdateMixin, self)._create_or_update_package(
+                package_dict, harvest_object, package_dict_form)
+
+        delta = diff_package(package_dict, existing_package_dict)
+        if not delta.changed:
+            return 'unchanged'
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Package with GUID %s exists and needs to be updated: '
+                      'fields %s, resources changed: %s', harvest_object.guid,
+                      sorted(delta.fields.keys()), delta.resources_changed)
+        new_package = apply_package_delta(context,
+                                          existing_package_dict['id'], delta)
+
+        # Flag the other objects linking to this package as not current
+        # anymore
+        from ckanext.harvest.model import harvest_object_table
+        conn = model.Session.connection()
+        u = update(harvest_object_table) \
+            .where(harvest_object_table.c.package_id ==
+                   bindparam('b_package_id')) \
+            .values(current=False)
+        conn.execute(u, b_package_id=new_package['id'])
+
+        # Flag this as the current harvest object
+        harvest_object.package_id = new_package['id']
+        harvest_object.current = True
+        harvest_object.save()
+
+        model.Session.commit()
+        return True
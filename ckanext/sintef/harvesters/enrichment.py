@@ -0,0 +1,217 @@
+'''
+Background enrichment of organizations created by the harvesters.
+
+Organizations are created by the import stage without anything that would
+require extra remote requests. Details such as the logo are looked up later
+by a worker thread, so that importing a dataset never has to wait for them.
+
+The queue lives in memory: each process looks up each organization once, and
+the organizations still queued when a process stops are not looked up. An
+organization that has no logo yet is queued again by the next process that
+imports one of its datasets, so its lookup is only put off until then.
+'''
+import re
+import time
+import socket
+import httplib
+import urllib2
+import urlparse
+import threading
+import Queue
+
+from ckan import model
+from ckan.logic import NotFound, ValidationError, get_action
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Upper limits for fetching the page a logo is scraped from. The logo is
+# part of the page header, so there is no need to read the whole page.
+LOGO_FETCH_TIMEOUT = 5
+LOGO_FETCH_MAX_BYTES = 256 * 1024
+LOGO_FETCH_CHUNK_SIZE = 16 * 1024
+
+_LOGO_DIV_RE = re.compile(r'<div\b[^>]*\bclass\s*=\s*["\'][^"\']*\blogo\b',
+                          re.IGNORECASE)
+_IMG_SRC_RE = re.compile(r'<img\b[^>]*\bsrc\s*=\s*["\']([^"\']+)["\']',
+                         re.IGNORECASE)
+
+
+def find_logo_url(html, base_url=None):
+    '''
+    Finds the source of the first image inside the first 'div' element with
+    the class 'logo'. Only the markup around that element is looked at, the
+    rest of the page is never parsed.
+
+    :param html: String containing (the start of) an HTML page.
+    :param base_url: URL of the page, used to resolve relative sources.
+    :returns: The URL of the logo, or None if no logo was found.
+    '''
+    div_match = _LOGO_DIV_RE.search(html)
+    if not div_match:
+        return None
+
+    div_end = html.find('</div>', div_match.end())
+    if div_end == -1:
+        div_end = len(html)
+
+    img_match = _IMG_SRC_RE.search(html, div_match.end(), div_end)
+    if not img_match:
+        return None
+
+    img_source = img_match.group(1).strip()
+    if base_url:
+        img_source = urlparse.urljoin(base_url, img_source)
+    return img_source
+
+
+def _response_socket(http_response):
+    '''
+    Returns the socket a urllib2 response is read from, or None if the
+    response has been read to the end.
+    '''
+    obj = http_response
+    for _ in range(5):
+        if obj is None or hasattr(obj, 'settimeout'):
+            return obj
+        obj = getattr(obj, '_sock', None) or getattr(obj, 'fp', None)
+    return None
+
+
+def fetch_logo_url(page_url, timeout=LOGO_FETCH_TIMEOUT,
+                   max_bytes=LOGO_FETCH_MAX_BYTES):
+    '''
+    Downloads at most 'max_bytes' of the page at 'page_url', spending at most
+    'timeout' seconds on it, and returns the URL of the logo on that page.
+
+    :param page_url: String containing the URL of the page.
+    :param timeout: Time limit in seconds for the whole download.
+    :param max_bytes: Maximum number of bytes read from the page.
+    :returns: The URL of the logo, or None if no logo was found.
+    '''
+    deadline = time.time() + timeout
+    chunks = []
+    read_bytes = 0
+    try:
+        http_response = urllib2.urlopen(urllib2.Request(url=page_url),
+                                        timeout=timeout)
+        try:
+            while read_bytes < max_bytes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # A read that blocks ends at the deadline too
+                sock = _response_socket(http_response)
+                if sock is not None:
+                    sock.settimeout(remaining)
+                chunk = http_response.read(
+                    min(LOGO_FETCH_CHUNK_SIZE, max_bytes - read_bytes))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                read_bytes += len(chunk)
+        finally:
+            http_response.close()
+    except (urllib2.URLError, httplib.HTTPException, socket.error,
+            ValueError), e:
+        log.debug('Could not fetch %s to look for a logo: %s', page_url, e)
+        if not chunks:
+            return None
+
+    return find_logo_url(''.join(chunks), page_url)
+
+
+class LogoEnrichmentQueue(object):
+    '''
+    Queue of organizations whose logo should be looked up. Every organization
+    is only looked up once per process, no matter how many datasets ask for
+    it. Lookups are done by a single daemon thread, which patches the
+    'image_url' of the organization when a logo is found.
+    '''
+
+    def __init__(self, timeout=LOGO_FETCH_TIMEOUT,
+                 max_bytes=LOGO_FETCH_MAX_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._queue = Queue.Queue()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._worker = None
+
+
+    def enqueue(self, organization_name, page_url, user_name):
+        '''
+        Adds an organization to the queue, unless it has been added before.
+
+        :param organization_name: Name of the local organization.
+        :param page_url: URL of a remote page that shows the logo.
+        :param user_name: Name of the user that patches the organization.
+        :returns: True if the organization was added to the queue.
+        '''
+        if not organization_name or not page_url:
+            return False
+
+        self._lock.acquire()
+        try:
+            if organization_name in self._seen:
+                return False
+            self._seen.add(organization_name)
+            self._start_worker()
+        finally:
+            self._lock.release()
+
+        self._queue.put((organization_name, page_url, user_name))
+        return True
+
+
+    def join(self):
+        '''
+        Blocks until every organization in the queue has been handled.
+        '''
+        self._queue.join()
+
+
+    def _start_worker(self):
+        if self._worker is not None and self._worker.isAlive():
+            return
+        self._worker = threading.Thread(target=self._run,
+                                        name='sintef-logo-enrichment')
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def _run(self):
+        while True:
+            organization_name, page_url, user_name = self._queue.get()
+            try:
+                self._enrich(organization_name, page_url, user_name)
+            except Exception, e:
+                log.error('Logo enrichment of organization %s failed: %s',
+                          organization_name, e)
+            finally:
+                model.Session.remove()
+                self._queue.task_done()
+
+
+    def _enrich(self, organization_name, page_url, user_name):
+        image_url = fetch_logo_url(page_url, self.timeout, self.max_bytes)
+        if not image_url:
+            log.debug('No logo was found for organization %s.',
+                      organization_name)
+            return
+
+        context = {'model': model, 'session': model.Session,
+                   'user': user_name, 'ignore_auth': True}
+        try:
+            get_action('organization_patch')(context,
+                                             {'id': organization_name,
+                                              'image_url': image_url})
+            log.debug('Logo of organization %s set to %s',
+                      organization_name, image_url)
+        except (NotFound, ValidationError), e:
+            log.info('Could not set the logo of organization %s: %s',
+                     organization_name, e)
+
+
+logo_queue = LogoEnrichmentQueue()
@@ -0,0 +1,141 @@
+'''
+Filters of the datasets found in a remote catalogue.
+
+The filters of a source are built once per gather stage. Each dataset is
+first checked against its raw JSON, which throws away most unwanted datasets
+without decoding them, and then against the decoded dictionary.
+'''
+import re
+
+from ckan.lib.helpers import json
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def raw_forms(value):
+    '''
+    Returns the forms a string can take inside the raw JSON of a dataset,
+    encoded as UTF-8. JSON lets a server escape any character, so the forms
+    of the common encoders are listed.
+
+    :param value: The string, as decoded from JSON.
+    :returns: A list of byte strings.
+    '''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    escaped = json.dumps(value)[1:-1]
+    forms = [escaped,
+             re.sub(r'\\u([0-9a-f]{4})',
+                    lambda match: '\\u' + match.group(1).upper(), escaped),
+             json.dumps(value, ensure_ascii=False)[1:-1]]
+
+    result = []
+    for form in forms:
+        if isinstance(form, unicode):
+            form = form.encode('utf-8')
+        for variant in (form, form.replace('/', '\\/')):
+            if variant not in result:
+                result.append(variant)
+    return result
+
+
+class DatanorgeFilter(object):
+    '''
+    The 'organizations' and 'themes' filters of a Data Norge source.
+
+    :param organizations: Name or list of names of the wanted publishers, or
+                          None to keep datasets of every publisher.
+    :param themes: Keyword or list of keywords of which a dataset must have
+                   at least one, or None to keep datasets with any keyword.
+    '''
+
+    def __init__(self, organizations=None, themes=None):
+        organizations = _as_list(organizations)
+        themes = _as_list(themes)
+        self.organizations = None
+        self.themes = None
+        self._organization_forms = None
+        self._theme_forms = None
+
+        if organizations is not None:
+            self.organizations = frozenset(organizations)
+            self._organization_forms = \
+                tuple(self._raw_forms_of(organizations))
+        if themes is not None:
+            self.themes = frozenset(themes)
+            self._theme_forms = tuple(self._raw_forms_of(themes))
+
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Builds the filter from the config of a source.
+        '''
+        return cls(config.get('organizations', None),
+                   config.get('themes', None))
+
+
+    @staticmethod
+    def _raw_forms_of(values):
+        forms = []
+        for value in values:
+            for form in raw_forms(value):
+                # Quoted, so that a name is not found inside a longer one
+                form = '"%s"' % form
+                if form not in forms:
+                    forms.append(form)
+        return forms
+
+
+    @property
+    def active(self):
+        return self.organizations is not None or self.themes is not None
+
+
+    def might_match(self, raw):
+        '''
+        Checks the raw JSON of a dataset. False means the dataset is certainly
+        unwanted, True means it has to be decoded and checked with matches().
+
+        :param raw: UTF-8 encoded JSON of one dataset.
+        '''
+        if self._organization_forms is not None:
+            for form in self._organization_forms:
+                if form in raw:
+                    break
+            else:
+                return False
+        if self._theme_forms is not None:
+            for form in self._theme_forms:
+                if form in raw:
+                    break
+            else:
+                return False
+        return True
+
+
+    def matches(self, pkg_dict):
+        '''
+        Checks a decoded dataset against the filters.
+
+        :param pkg_dict: Dictionary containing dataset metadata.
+        :returns: True if the dataset passes the filters.
+        '''
+        if self.organizations is not None:
+            publisher = pkg_dict.get('publisher') or {}
+            # If this organization is unwanted, skip the dataset.
+            if publisher.get('name') not in self.organizations:
+                return False
+
+        if self.themes is not None:
+            # If none of the themes match, skip the dataset.
+            if self.themes.isdisjoint(pkg_dict.get('keyword') or []):
+                return False
+
+        return True
@@ -0,0 +1,243 @@
+'''
+Adaptive harvest frequency of sources, from the changes their jobs found.
+
+Some remotes change every hour, others once a year, and a source harvested
+more often than its remote changes spends remote and local capacity on jobs
+that find nothing. The finished jobs of a source tell how fast its remote
+changes. For each job, the objects it imported are counted, with those that
+were added, updated or deleted, i.e. not "unchanged", and the newest
+DateMetadataUpdated of its objects is compared with the start of the job.
+
+The rate of change of the source is the number of changed datasets found by
+its last jobs, divided by the hours since the job before them. The next
+harvest is due when "target_changes" datasets are expected to have changed,
+within "min_interval_hours" and "max_interval_hours" of the source config.
+The defaults of these options are set in the CKAN config:
+
+    ckanext.sintef.min_interval_hours = 1
+    ckanext.sintef.max_interval_hours = 720
+    ckanext.sintef.target_changes = 1
+    ckanext.sintef.frequency_jobs = 10
+
+A source with "adaptive_frequency": true in its config schedules its next
+job this way at the end of each gather stage. The recommendation of any
+source is returned by the sintef_harvest_frequency action and printed by
+"paster sintef frequency".
+'''
+import datetime
+
+from pylons import config
+from sqlalchemy import func, case
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MIN_INTERVAL_HOURS = 1
+DEFAULT_MAX_INTERVAL_HOURS = 720
+DEFAULT_TARGET_CHANGES = 1
+DEFAULT_FREQUENCY_JOBS = 10
+
+# Report statuses of the HarvestObjects of datasets that had changed
+CHANGED_STATUSES = (u'added', u'updated', u'deleted')
+
+# Frequencies of ckanext-harvest, and their hours, longest first. ALWAYS is
+# left out: a source with it gets a new job as soon as the last one ends, so
+# an interval shorter than a day is only kept in the next run.
+HARVEST_FREQUENCIES = ((u'MONTHLY', 720), (u'BIWEEKLY', 336),
+                       (u'WEEKLY', 168), (u'DAILY', 24))
+
+
+def _hours(delta):
+    return (delta.days * 86400 + delta.seconds) / 3600.0
+
+
+def job_changes(source_id, jobs=None):
+    '''
+    Returns the changes found by the last finished jobs of a source, oldest
+    first.
+
+    :param source_id: ID of the harvest source.
+    :param jobs: Number of jobs, by default ckanext.sintef.frequency_jobs.
+    :returns: A list of dictionaries with the 'job_id', 'gather_started',
+              'interval_hours' since the job before, 'objects', 'changed'
+              objects, 'change_fraction' and 'newest_change_lag_hours', the
+              hours between the newest change and the start of the job. The
+              oldest job of the list has no interval.
+    '''
+    if jobs is None:
+        jobs = int(config.get('ckanext.sintef.frequency_jobs',
+                              DEFAULT_FREQUENCY_JOBS))
+    # The job before the last ones tells when their first interval started
+    recent = model.Session.query(HarvestJob) \
+        .filter(HarvestJob.source_id == source_id) \
+        .filter(HarvestJob.status == u'Finished') \
+        .filter(HarvestJob.gather_started != None) \
+        .order_by(HarvestJob.gather_started.desc()) \
+        .limit(jobs + 1).all()
+    recent.reverse()
+    if not recent:
+        return []
+
+    counts = {}
+    rows = model.Session.query(
+        HarvestObject.harvest_job_id, func.count(HarvestObject.id),
+        func.sum(case([(HarvestObject.report_status.in_(CHANGED_STATUSES),
+                        1)], else_=0)),
+        func.max(HarvestObject.metadata_modified_date)) \
+        .filter(HarvestObject.harvest_job_id.in_([job.id for job in recent])) \
+        .group_by(HarvestObject.harvest_job_id).all()
+    for job_id, objects, changed, newest in rows:
+        counts[job_id] = (objects, int(changed or 0), newest)
+
+    changes = []
+    previous = None
+    for job in recent:
+        objects, changed, newest = counts.get(job.id, (0, 0, None))
+        changes.append({
+            'job_id': job.id,
+            'gather_started': job.gather_started,
+            'interval_hours': _hours(job.gather_started -
+                                     previous.gather_started)
+                              if previous is not None else None,
+            'objects': objects,
+            'changed': changed,
+            'change_fraction': float(changed) / objects if objects else 0.0,
+            'newest_change_lag_hours': _hours(job.gather_started - newest)
+                                       if newest is not None else None,
+        })
+        previous = job
+    return changes
+
+
+def harvest_frequency(interval_hours):
+    '''
+    Returns the longest frequency of ckanext-harvest that is not longer than
+    an interval, or DAILY for an interval shorter than a day.
+    '''
+    for frequency, hours in HARVEST_FREQUENCIES:
+        if hours <= interval_hours:
+            return frequency
+    return HARVEST_FREQUENCIES[-1][0]
+
+
+def recommend_interval(changes, min_hours, max_hours, target_changes):
+    '''
+    Recommends the hours until the next job of a source.
+
+    :param changes: The changes found by its last jobs, see job_changes.
+    :param min_hours: Shortest interval to recommend.
+    :param max_hours: Longest interval to recommend.
+    :param target_changes: Changed datasets a job should find.
+    :returns: A dictionary with the recommended 'interval_hours' and
+              'frequency', None if there are too few jobs, the 'reason', and
+              the 'changes_per_hour', 'change_fraction' and 'empty_jobs' of
+              the jobs.
+    '''
+    observed = [job for job in changes if job['interval_hours'] is not None]
+    hours = sum(job['interval_hours'] for job in observed)
+    changed = sum(job['changed'] for job in observed)
+    objects = sum(job['objects'] for job in observed)
+    lags = [job['newest_change_lag_hours'] for job in observed
+            if job['changed'] and job['newest_change_lag_hours'] is not None]
+    recommendation = {
+        'jobs': len(observed),
+        'hours': round(hours, 2),
+        'changed': changed,
+        'changes_per_hour': round(float(changed) / hours, 4) if hours
+                            else None,
+        'change_fraction': round(float(changed) / objects, 4) if objects
+                           else 0.0,
+        'empty_jobs': len([job for job in observed if not job['changed']]),
+        'max_newest_change_lag_hours': round(max(lags), 2) if lags else None,
+        'interval_hours': None,
+        'frequency': None,
+    }
+
+    if not observed or hours <= 0:
+        recommendation['reason'] = 'Too few finished jobs to tell how ' \
+                                   'often the source changes'
+        return recommendation
+
+    if not changed:
+        interval = max_hours
+        reason = 'No changed datasets in the last %s jobs over %.1f hours' % (
+            len(observed), hours)
+    else:
+        interval = float(target_changes) * hours / changed
+        reason = '%s changed datasets in the last %s jobs over %.1f hours, ' \
+                 '%s expected in %.1f hours' % (changed, len(observed), hours,
+                                                target_changes, interval)
+        if interval < min_hours:
+            interval = min_hours
+            reason += ', raised to the shortest interval'
+        elif interval > max_hours:
+            interval = max_hours
+            reason += ', lowered to the longest interval'
+
+    recommendation['interval_hours'] = round(interval, 2)
+    recommendation['frequency'] = harvest_frequency(interval)
+    recommendation['reason'] = reason
+    return recommendation
+
+
+def source_recommendation(harvest_source, source_config):
+    '''
+    Recommends the hours until the next job of a source, with the bounds of
+    its config, or else those of the CKAN config. See recommend_interval.
+    '''
+    min_hours = source_config.get_int('min_interval_hours') or \
+        float(config.get('ckanext.sintef.min_interval_hours',
+                         DEFAULT_MIN_INTERVAL_HOURS))
+    max_hours = source_config.get_int('max_interval_hours') or \
+        float(config.get('ckanext.sintef.max_interval_hours',
+                         DEFAULT_MAX_INTERVAL_HOURS))
+    target_changes = source_config.get_int('target_changes') or \
+        float(config.get('ckanext.sintef.target_changes',
+                         DEFAULT_TARGET_CHANGES))
+    changes = job_changes(harvest_source.id)
+    recommendation = recommend_interval(changes, min_hours,
+                                        max(min_hours, max_hours),
+                                        target_changes)
+    recommendation['source_id'] = harvest_source.id
+    recommendation['current_frequency'] = harvest_source.frequency
+    last = changes[-1]['gather_started'] if changes else None
+    recommendation['next_run'] = None
+    if last is not None and recommendation['interval_hours'] is not None:
+        recommendation['next_run'] = last + datetime.timedelta(
+            hours=recommendation['interval_hours'])
+    return recommendation
+
+
+def schedule_next_run(harvest_source, recommendation, started=None):
+    '''
+    Schedules the next job of a source as recommended. Its frequency is set
+    to the longest one of ckanext-harvest that is not longer than the
+    recommended interval, which is used if the next run is not scheduled
+    again. An interval shorter than a day is only kept in the next run,
+    the frequency is set to DAILY.
+
+    :param harvest_source: HarvestSource object.
+    :param recommendation: See source_recommendation.
+    :param started: When the interval starts, by default at the start of the
+                    last finished job of the source.
+    :returns: When the next job is due, or None if nothing was scheduled.
+    '''
+    if recommendation['interval_hours'] is None:
+        return None
+    if started is None:
+        next_run = recommendation['next_run']
+    else:
+        next_run = started + datetime.timedelta(
+            hours=recommendation['interval_hours'])
+    harvest_source.frequency = recommendation['frequency']
+    harvest_source.next_run = next_run
+    harvest_source.save()
+    log.info('Next job of source %s scheduled at %s UTC (%s): %s',
+             harvest_source.id, next_run, recommendation['frequency'],
+             recommendation['reason'])
+    return next_run
@@ -0,0 +1,323 @@
+'''
+Health of the remotes harvested from, with a circuit breaker.
+
+When the incremental search of a job fails, the harvesters fall back to
+searching for every dataset of the remote, which is the most expensive job
+there is. During an outage of the remote this would happen on every job. The
+tracker remembers the recent failures of each remote:
+
+    closed     The remote is healthy, and jobs run as usual. At most one full
+               fallback is made per remote within 'full_fallback_interval'.
+    open       The remote failed 'failure_threshold' times in a row. Jobs are
+               postponed, without any request to the remote, until
+               'cooldown' seconds have passed.
+    half_open  The cooldown has passed, and the next job tries the remote
+               with an incremental search. If it succeeds the breaker
+               closes, otherwise it opens again. No full fallback is made.
+
+Every decision is saved with its reason, and logged. Failures are counted
+with a single update of the stored count, so that the failures recorded by
+several gather consumers at the same time all count.
+'''
+import datetime
+import threading
+
+from pylons import config
+from sqlalchemy.exc import IntegrityError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+STATE_CLOSED = u'closed'
+STATE_OPEN = u'open'
+STATE_HALF_OPEN = u'half_open'
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN = 1800
+DEFAULT_FULL_FALLBACK_INTERVAL = 6 * 3600
+
+
+def _default_state(remote):
+    return {'remote': remote, 'state': STATE_CLOSED, 'failures': 0,
+            'last_failure': None, 'last_success': None, 'opened': None,
+            'last_full_fallback': None, 'reason': None, 'decision': None}
+
+
+class RemoteHealth(object):
+    '''
+    Circuit breaker for the remotes of the harvesters.
+
+    :param store: DbHealthStore or MemoryHealthStore.
+    :param failure_threshold: Failures in a row that open the breaker.
+    :param cooldown: Seconds the breaker stays open.
+    :param full_fallback_interval: Seconds between two full fallbacks to the
+                                   same remote.
+    '''
+
+    def __init__(self, store, failure_threshold=None, cooldown=None,
+                 full_fallback_interval=None, now=datetime.datetime.utcnow):
+        self.store = store
+        self.failure_threshold = failure_threshold or int(config.get(
+            'ckanext.sintef.breaker_failures', DEFAULT_FAILURE_THRESHOLD))
+        self.cooldown = datetime.timedelta(seconds=cooldown or int(config.get(
+            'ckanext.sintef.breaker_cooldown', DEFAULT_COOLDOWN)))
+        self.full_fallback_interval = datetime.timedelta(
+            seconds=full_fallback_interval or int(config.get(
+                'ckanext.sintef.full_fallback_interval',
+                DEFAULT_FULL_FALLBACK_INTERVAL)))
+        self.now = now
+
+
+    def _decide(self, state, decision, with_failures=True):
+        state['decision'] = decision
+        self.store.put(state, with_failures)
+        log.info('Remote %s: %s', state['remote'], decision)
+        return decision
+
+
+    def allow_request(self, remote):
+        '''
+        Checks whether a job may make requests to the remote.
+
+        :returns: A tuple (allowed, reason), where 'reason' tells why the
+                  job is postponed.
+        '''
+        state = self.store.get(remote)
+        if state['state'] != STATE_OPEN:
+            return True, None
+
+        retry_at = state['opened'] + self.cooldown
+        if self.now() < retry_at:
+            return False, ('the remote failed %s times in a row, last at %s '
+                           'UTC: %s. Postponed until %s UTC' %
+                           (state['failures'], state['last_failure'],
+                            state['reason'], retry_at.replace(microsecond=0)))
+
+        state['state'] = STATE_HALF_OPEN
+        self._decide(state, 'cooldown over, trying the remote again')
+        return True, None
+
+
+    def allow_full_fallback(self, remote):
+        '''
+        Checks whether a job whose incremental search failed may search for
+        every dataset of the remote, and records it if so.
+
+        :returns: A tuple (allowed, reason), where 'reason' tells why the
+                  fallback is postponed.
+        '''
+        state = self.store.get(remote)
+        now = self.now()
+        if state['state'] != STATE_CLOSED:
+            reason = self._decide(state, 'full fallback postponed, the remote '
+                                  'is unhealthy after %s failures: %s' %
+                                  (state['failures'], state['reason']))
+            return False, reason
+
+        last = state['last_full_fallback']
+        if last is not None and now - last < self.full_fallback_interval:
+            reason = self._decide(state, 'full fallback postponed, one was '
+                                  'already made at %s UTC' %
+                                  last.replace(microsecond=0))
+            return False, reason
+
+        state['last_full_fallback'] = now
+        self._decide(state, 'full fallback after: %s' % state['reason'])
+        return True, None
+
+
+    def record_failure(self, remote, reason):
+        '''
+        Records a failed search on the remote.
+        '''
+        now = self.now()
+        state = self.store.add_failure(remote, u'%s' % reason, now)
+        if state['state'] == STATE_HALF_OPEN or \
+                (state['state'] == STATE_CLOSED and
+                 state['failures'] >= self.failure_threshold):
+            state['state'] = STATE_OPEN
+            state['opened'] = now
+            # The count may have grown since, and is kept
+            self._decide(state, 'breaker opened after %s failures' %
+                         state['failures'], with_failures=False)
+
+
+    def record_success(self, remote):
+        '''
+        Records a successful search on the remote, which closes the breaker.
+        '''
+        state = self.store.get(remote)
+        was_closed = state['state'] == STATE_CLOSED and not state['failures']
+        state['state'] = STATE_CLOSED
+        state['failures'] = 0
+        state['last_success'] = self.now()
+        if was_closed:
+            self.store.put(state)
+        else:
+            self._decide(state, 'remote is healthy again')
+
+
+class DisabledHealth(object):
+    '''
+    Stands in for RemoteHealth on sources with "circuit_breaker": false.
+    '''
+
+    def allow_request(self, remote):
+        return True, None
+
+
+    def allow_full_fallback(self, remote):
+        return True, None
+
+
+    def record_failure(self, remote, reason):
+        pass
+
+
+    def record_success(self, remote):
+        pass
+
+
+def get_remote_health(source_config):
+    '''
+    Returns the health tracker to use for a source.
+    '''
+    if not source_config.get_bool('circuit_breaker', True) or \
+            source_config.get('snapshot'):
+        return DisabledHealth()
+    return RemoteHealth(DbHealthStore())
+
+
+class DbHealthStore(object):
+    '''
+    Keeps the health of the remotes in the 'sintef_remote_health' table,
+    shared by every gather consumer.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.remote_health_table
+
+
+    @property
+    def session(self):
+        from ckan import model
+        return model.Session
+
+
+    def get(self, remote):
+        table = self.table
+        row = self.session.execute(
+            table.select().where(table.c.remote == remote)).first()
+        state = _default_state(remote)
+        if row is not None:
+            for key in state:
+                state[key] = row[key]
+        return state
+
+
+    def put(self, state, with_failures=True):
+        '''
+        Saves the state of a remote.
+
+        :param with_failures: False to keep the stored count of failures.
+        '''
+        table = self.table
+        values = dict(state, updated=datetime.datetime.utcnow())
+        if not with_failures:
+            del values['failures']
+        result = self.session.execute(table.update().where(
+            table.c.remote == state['remote']).values(**values))
+        if result.rowcount == 0:
+            self.session.execute(table.insert().values(**values))
+        self.session.commit()
+
+
+    def add_failure(self, remote, reason, now):
+        '''
+        Counts a failure of a remote, in the database, and returns the state
+        of the remote after it.
+        '''
+        table = self.table
+        values = {'failures': table.c.failures + 1, 'last_failure': now,
+                  'reason': reason, 'updated': datetime.datetime.utcnow()}
+        update = table.update().where(table.c.remote == remote) \
+            .values(**values)
+        result = self.session.execute(update)
+        if result.rowcount == 0:
+            state = dict(_default_state(remote), failures=1,
+                         last_failure=now, reason=reason,
+                         updated=values['updated'])
+            try:
+                self.session.execute(table.insert().values(**state))
+            except IntegrityError:
+                # Inserted by another gather consumer in the meantime
+                self.session.rollback()
+                self.session.execute(update)
+        self.session.commit()
+        return self.get(remote)
+
+
+    def all(self):
+        table = self.table
+        rows = self.session.execute(
+            table.select().order_by(table.c.remote)).fetchall()
+        return [dict((key, row[key]) for key in _default_state(None))
+                for row in rows]
+
+
+    def reset(self, remote):
+        table = self.table
+        self.session.execute(table.delete().where(table.c.remote == remote))
+        self.session.commit()
+
+
+class MemoryHealthStore(object):
+    '''
+    Keeps the health of the remotes in memory, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, remote):
+        self._lock.acquire()
+        try:
+            return dict(self._states.get(remote) or _default_state(remote))
+        finally:
+            self._lock.release()
+
+
+    def put(self, state, with_failures=True):
+        self._lock.acquire()
+        try:
+            state = dict(state)
+            if not with_failures and state['remote'] in self._states:
+                state['failures'] = self._states[state['remote']]['failures']
+            self._states[state['remote']] = state
+        finally:
+            self._lock.release()
+
+
+    def add_failure(self, remote, reason, now):
+        self._lock.acquire()
+        try:
+            state = self._states.setdefault(remote, _default_state(remote))
+            state['failures'] += 1
+            state['last_failure'] = now
+            state['reason'] = reason
+            return dict(state)
+        finally:
+            self._lock.release()
+
+
+    def all(self):
+        return [self._states[remote] for remote in sorted(self._states)]
+
+
+    def reset(self, remote):
+        self._states.pop(remote, None)
@@ -0,0 +1,248 @@
+'''
+Identity index of the datasets harvested by every source.
+
+The same dataset can be harvested from more than one remote: many Geonorge
+datasets are also in the Data Norge DCAT catalogue. Each harvester names
+its datasets by its own identifier, the UUID for Geonorge and the URL for
+Data Norge, so without an index the dataset is imported twice.
+
+The index maps every external identifier of a dataset, in a normalized form,
+to the local package it was imported as and the source that imported it:
+
+    uuid:<uuid>           A UUID, also when it is part of a URL
+    url:<host/path>       A URL, without the scheme and trailing slash
+    id:<value>            Any other identifier
+
+The identifiers of a dataset are claimed by its source before it is
+imported, with a single lookup by primary key. A dataset with an identifier
+claimed by another source for a package that still exists was already
+harvested elsewhere, and is skipped, or merged into that package, as set by
+"cross_source_duplicates" in the source config. Claims are added as
+datasets are imported, and "paster sintef identity-index --rebuild" adds the
+datasets imported before the index existed.
+'''
+import re
+import datetime
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+
+import logging
+log = logging.getLogger(__name__)
+
+
+_UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                      r'[0-9a-f]{12}', re.IGNORECASE)
+_URL_RE = re.compile(r'^[a-z][a-z0-9+.-]*://', re.IGNORECASE)
+
+
+def normalize_identifiers(value):
+    '''
+    Returns the normalized identifiers of an external identifier, as a list.
+    A URL holding a UUID has both.
+    '''
+    if not value or not isinstance(value, basestring):
+        return []
+    value = value.strip()
+    identifiers = []
+    match = _UUID_RE.search(value)
+    if match:
+        identifiers.append(u'uuid:' + match.group(0).lower())
+    if _URL_RE.match(value):
+        rest = _URL_RE.sub(u'', value).rstrip(u'/')
+        host, _, path = rest.partition(u'/')
+        if host.lower().startswith(u'www.'):
+            host = host[4:]
+        identifiers.append(u'url:%s/%s' % (host.lower(), path))
+    elif not match:
+        identifiers.append(u'id:' + value)
+    return identifiers
+
+
+def dataset_identifiers(values):
+    '''
+    Returns the normalized identifiers of a dataset given its external
+    identifiers, without duplicates and in order.
+    '''
+    identifiers = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            candidates = value
+        else:
+            candidates = (value,)
+        for candidate in candidates:
+            for identifier in normalize_identifiers(candidate):
+                if identifier not in identifiers:
+                    identifiers.append(identifier)
+    return identifiers
+
+
+class IdentityIndex(object):
+    '''
+    Claims the identifiers of datasets for the sources that import them.
+
+    :param store: DbIdentityStore or MemoryIdentityStore.
+    '''
+
+    def __init__(self, store=None):
+        self.store = store or DbIdentityStore()
+
+
+    def claim(self, identifiers, package_id, source_id, package_exists=None):
+        '''
+        Claims the identifiers of a dataset for a package of a source,
+        unless another package that exists has claimed one of them already.
+
+        :param identifiers: Normalized identifiers, see dataset_identifiers.
+        :param package_id: ID of the package the dataset is imported as.
+        :param source_id: ID of the harvest source importing it.
+        :param package_exists: Callable telling whether a package ID still
+                               exists. Claims of packages that do not are
+                               taken over.
+        :returns: None if the identifiers are claimed for the package, or
+                  the claim of the other package, a dictionary with
+                  'identifier', 'package_id' and 'source_id'.
+        '''
+        if not identifiers:
+            return None
+        own = 0
+        for claim in self.store.get(identifiers):
+            if claim['package_id'] == package_id:
+                own += 1
+                continue
+            if package_exists is not None and \
+                    not package_exists(claim['package_id']):
+                log.debug('Package %s of %s does not exist anymore, its '
+                          'identifiers are taken over', claim['package_id'],
+                          claim['identifier'])
+                continue
+            return claim
+        # Datasets imported before usually have all their claims already
+        if own < len(identifiers):
+            self.store.put(identifiers, package_id, source_id)
+        return None
+
+
+    def lookup(self, identifiers):
+        '''
+        Returns the claim of the first of the identifiers that is claimed,
+        or None.
+        '''
+        claims = self.store.get(identifiers)
+        return claims[0] if claims else None
+
+
+class DbIdentityStore(object):
+    '''
+    Keeps the identity index in the 'sintef_dataset_identity' table. Claims
+    are written with a connection of their own, so a failing import does not
+    roll them back and they do not wait for the import to commit.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.dataset_identity_table
+
+
+    def get(self, identifiers):
+        '''
+        Returns the claims of the identifiers, in the order of the
+        identifiers.
+        '''
+        table = self.table
+        rows = model.Session.execute(table.select().where(
+            table.c.identifier.in_(list(identifiers)))).fetchall()
+        claims = dict((row['identifier'], dict(row)) for row in rows)
+        return [claims[identifier] for identifier in identifiers
+                if identifier in claims]
+
+
+    def put(self, identifiers, package_id, source_id):
+        table = self.table
+        now = datetime.datetime.utcnow()
+        connection = model.meta.engine.connect()
+        try:
+            for identifier in identifiers:
+                values = {'package_id': package_id, 'source_id': source_id,
+                          'updated': now}
+                result = connection.execute(table.update().where(
+                    table.c.identifier == identifier).values(**values))
+                if result.rowcount:
+                    continue
+                try:
+                    connection.execute(table.insert().values(
+                        identifier=identifier, **values))
+                except IntegrityError:
+                    # Claimed by another worker in the meantime, the first
+                    # claim is kept
+                    log.debug('Identifier %s was claimed by another worker',
+                              identifier)
+        finally:
+            connection.close()
+
+
+    def forget(self, package_id):
+        table = self.table
+        model.Session.execute(
+            table.delete().where(table.c.package_id == package_id))
+        model.Session.commit()
+
+
+    def counts(self):
+        '''
+        Returns the number of identifiers and of packages of each source.
+        '''
+        table = self.table
+        rows = model.Session.execute(table.select()).fetchall()
+        counts = {}
+        for row in rows:
+            identifiers, packages = counts.get(row['source_id'], (0, set()))
+            packages.add(row['package_id'])
+            counts[row['source_id']] = (identifiers + 1, packages)
+        return dict((source_id, (identifiers, len(packages)))
+                    for source_id, (identifiers, packages)
+                    in counts.iteritems())
+
+
+class MemoryIdentityStore(object):
+    '''
+    Keeps the identity index in memory, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self._claims = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, identifiers):
+        self._lock.acquire()
+        try:
+            return [dict(self._claims[identifier])
+                    for identifier in identifiers
+                    if identifier in self._claims]
+        finally:
+            self._lock.release()
+
+
+    def put(self, identifiers, package_id, source_id):
+        self._lock.acquire()
+        try:
+            for identifier in identifiers:
+                self._claims[identifier] = {'identifier': identifier,
+                                            'package_id': package_id,
+                                            'source_id': source_id}
+        finally:
+            self._lock.release()
+
+
+    def forget(self, package_id):
+        self._lock.acquire()
+        try:
+            for identifier, claim in self._claims.items():
+                if claim['package_id'] == package_id:
+                    del self._claims[identifier]
+        finally:
+            self._lock.release()
@@ -0,0 +1,212 @@
+'''
+Splitting of JSON arrays into the raw JSON text of their items.
+
+Remote catalogues return large pages of datasets in one JSON document. The
+splitter finds the items of one array in such a document without decoding
+them, so that each item can be looked at, and thrown away if unwanted,
+before it is decoded.
+
+The items can also be read straight from a socket, one at a time, so that
+the whole document is never held in memory.
+'''
+import re
+
+# Bytes read from a socket at a time
+CHUNK_SIZE = 65536
+
+_STRUCTURE_RE = re.compile(r'[][{}",:]')
+_STRING_RE = re.compile(r'["\\]')
+
+# Phases of the splitter
+_SEEK_KEY = 0
+_SEEK_ARRAY = 1
+_IN_ARRAY = 2
+_DONE = 3
+
+
+class RawArraySplitter(object):
+    '''
+    Incremental splitter of one JSON array into the raw JSON of its items.
+
+    Feed it the document in chunks of any size, and it returns the items
+    that were completed by each chunk. Only the structure of the document is
+    followed, the items themselves are not validated.
+
+    :param key: Name of the member of the top-level object that holds the
+                array, or None if the document is the array itself.
+    '''
+
+    def __init__(self, key=None):
+        self.key = key
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._string_start = None
+        self._last_string = None
+        self._phase = _SEEK_KEY if key is not None else _SEEK_ARRAY
+        self._array_depth = None
+        self._item_start = None
+
+
+    @property
+    def done(self):
+        '''
+        True once the end of the array has been found.
+        '''
+        return self._phase == _DONE
+
+
+    def feed(self, chunk):
+        '''
+        Adds the next chunk of the document.
+
+        :param chunk: String containing the next part of the document.
+        :returns: A list with the raw JSON of every item completed by the
+                  chunk.
+        '''
+        if self._phase == _DONE:
+            return []
+        self._buffer += chunk
+        items = []
+        buf = self._buffer
+        pos = self._pos
+
+        while True:
+            if self._in_string:
+                match = _STRING_RE.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(buf):
+                        # The escaped character is in the next chunk
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                if self._depth == 1 and self._phase == _SEEK_KEY:
+                    self._last_string = buf[self._string_start:match.start()]
+                continue
+
+            match = _STRUCTURE_RE.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._phase == _SEEK_ARRAY and \
+                        (self.key is None or self._depth == 2):
+                    self._phase = _IN_ARRAY
+                    self._array_depth = self._depth
+                    self._item_start = pos
+            elif char in '}]':
+                if self._phase == _IN_ARRAY and \
+                        self._depth == self._array_depth:
+                    self._add_item(buf, pos - 1, items)
+                    self._phase = _DONE
+                    break
+                self._depth -= 1
+                if self._depth < 0:
+                    raise ValueError('Unbalanced JSON document')
+            elif char == ',':
+                if self._phase == _IN_ARRAY and \
+                        self._depth == self._array_depth:
+                    self._add_item(buf, pos - 1, items)
+                    self._item_start = pos
+                elif self._phase == _SEEK_ARRAY and self.key is not None:
+                    # The key was followed by something else than an array
+                    self._phase = _SEEK_KEY
+            elif char == ':':
+                if self._phase == _SEEK_KEY and self._depth == 1 and \
+                        self._last_string == self.key:
+                    self._phase = _SEEK_ARRAY
+                self._last_string = None
+
+        # Drop everything before the item that is being read
+        keep_from = pos
+        if self._in_string:
+            keep_from = min(keep_from, self._string_start - 1)
+        if self._phase == _IN_ARRAY:
+            keep_from = min(keep_from, self._item_start)
+        self._buffer = buf[keep_from:]
+        self._pos = pos - keep_from
+        if self._in_string:
+            self._string_start -= keep_from
+        if self._phase == _IN_ARRAY:
+            self._item_start -= keep_from
+        return items
+
+
+    def close(self):
+        '''
+        Checks that the document did not end in the middle of the array.
+        '''
+        if self._phase in (_IN_ARRAY, ) or self._in_string:
+            raise ValueError('JSON document ended in the middle of the array')
+
+
+    def _add_item(self, buf, end, items):
+        item = buf[self._item_start:end].strip()
+        if item:
+            items.append(item)
+
+
+def iter_raw_items(content, key=None):
+    '''
+    Yields the raw JSON of each item of an array in a JSON document that is
+    held in memory.
+
+    :param content: String containing the JSON document.
+    :param key: Name of the member of the top-level object that holds the
+                array, or None if the document is the array itself.
+    '''
+    splitter = RawArraySplitter(key)
+    for item in splitter.feed(content):
+        yield item
+    splitter.close()
+
+
+def iter_raw_items_from_file(fileobj, key=None, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the raw JSON of each item of an array in a JSON document that is
+    read from a file-like object, such as an HTTP response. Items are
+    yielded as soon as they have been read.
+
+    :param fileobj: File-like object to read the document from.
+    :param key: Name of the member of the top-level object that holds the
+                array, or None if the document is the array itself.
+    :param chunk_size: Number of bytes read at a time.
+    '''
+    splitter = RawArraySplitter(key)
+    while not splitter.done:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        for item in splitter.feed(chunk):
+            yield item
+    splitter.close()
+
+
+class CountingReader(object):
+    '''
+    Wraps a file-like object and counts the bytes read from it.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
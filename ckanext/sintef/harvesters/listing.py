@@ -0,0 +1,208 @@
+'''
+Remote listings shared by the harvest sources of the same remote.
+
+Several sources can harvest the same Geonorge instance with different
+filters. In shared-listing mode the first source to gather pages through
+every dataset of the remote once, the listing is saved in a file, and each
+source evaluates its own filters against the file until it is older than the
+window. The number of requests to a remote then depends on the number of
+remotes, not on the number of sources.
+
+A listing does not have the datasets created after it was fetched. A job
+that searched a listing records when the fetch of the listing started as the
+time its searches started, so that the next job searches for changes from
+then, and not only from the start of the job.
+
+Only filters on fields that are part of each search result can be evaluated
+locally. Sources with other filters, like free text, search on their own.
+'''
+import os
+import time
+import fcntl
+import datetime
+import hashlib
+import tempfile
+
+from pylons import config
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.records import GatherRecord
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Seconds a listing is used for before it is fetched again
+DEFAULT_WINDOW = 3600
+
+# Search parameters of Geonorge, and the field of a search result each one
+# is evaluated against
+GEONORGE_FIELDS = {
+    'type': 'Type',
+    'organization': 'Organization',
+    'theme': 'Theme',
+    'uuid': 'Uuid',
+}
+
+
+def get_listing_dir():
+    '''
+    Returns the directory the shared listings are saved in.
+    '''
+    listing_dir = config.get('ckanext.sintef.listing_dir')
+    if not listing_dir:
+        listing_dir = os.path.join(config.get('cache_dir') or
+                                   tempfile.gettempdir(), 'sintef_listings')
+    return listing_dir
+
+
+def get_window():
+    return int(config.get('ckanext.sintef.shared_listing_window',
+                          DEFAULT_WINDOW))
+
+
+def can_filter_locally(fq_terms_list, fields=GEONORGE_FIELDS):
+    '''
+    Checks whether every parameter of the searches can be evaluated against
+    a listing.
+    '''
+    for fq_terms in fq_terms_list:
+        for name in fq_terms:
+            if name not in fields:
+                return False
+    return True
+
+
+def _to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if not isinstance(value, unicode):
+        return u'%s' % value
+    return value
+
+
+class SharedListing(object):
+    '''
+    The listing of one remote, saved in a file as one JSON line per dataset:
+    the GatherRecord, followed by the values of the fields filters are
+    evaluated against.
+
+    :param base_url: Base URL of the remote.
+    :param fields: Dictionary from search parameter to result field.
+    :param listing_dir: Directory of the file.
+    :param window: Seconds the file is used for.
+
+    After a search, 'fetched' holds the time the listing that was searched
+    was fetched, in UTC.
+    '''
+
+    def __init__(self, base_url, fields=GEONORGE_FIELDS, listing_dir=None,
+                 window=None):
+        self.base_url = base_url
+        self.fields = fields
+        self.listing_dir = listing_dir or get_listing_dir()
+        self.window = window if window is not None else get_window()
+        name = hashlib.sha1(base_url.encode('utf-8') if
+                            isinstance(base_url, unicode) else
+                            base_url).hexdigest()
+        self.path = os.path.join(self.listing_dir, name + '.jsonl')
+        self.fetched = None
+
+
+    def _is_fresh(self):
+        try:
+            with open(self.path) as f:
+                header = json.loads(f.readline())
+        except (IOError, ValueError):
+            return False
+        return header.get('base_url') == self.base_url and \
+            time.time() - header.get('fetched', 0) < self.window
+
+
+    def _write(self, records, fetched):
+        if not os.path.isdir(self.listing_dir):
+            os.makedirs(self.listing_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.listing_dir)
+        count = 0
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'base_url': self.base_url,
+                                    'fetched': fetched}) + '\n')
+                for record in records:
+                    pkg_dict = json.loads(record.raw)
+                    values = dict((name, pkg_dict.get(field))
+                                  for name, field in self.fields.iteritems())
+                    f.write(json.dumps(record.as_list() + [values]) + '\n')
+                    count += 1
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return count
+
+
+    def ensure(self, fetch):
+        '''
+        Makes sure the file holds a listing that is younger than the window.
+        Only one process fetches a listing at a time, the others wait for it
+        and use it.
+
+        :param fetch: Callable that returns the GatherRecords of every dataset
+                      of the remote.
+        '''
+        if self._is_fresh():
+            return
+        if not os.path.isdir(self.listing_dir):
+            os.makedirs(self.listing_dir)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self._is_fresh():
+                    return
+                # Datasets changed while the listing is fetched may be
+                # missing from it, so it counts as fetched when it started
+                started = time.time()
+                count = self._write(fetch(), started)
+                log.info('Fetched the shared listing of %s: %s datasets in '
+                         '%.1f s', self.base_url, count, time.time() - started)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def filter(self, fq_terms_list):
+        '''
+        Yields the GatherRecords of the listing that match any of the
+        searches in 'fq_terms_list', that is all the parameters of at least
+        one of them.
+        '''
+        searches = []
+        for fq_terms in fq_terms_list:
+            searches.append([(name, _to_text(value))
+                             for name, value in fq_terms.iteritems()])
+
+        with open(self.path) as f:
+            header = json.loads(f.readline())
+            self.fetched = datetime.datetime.utcfromtimestamp(
+                header['fetched'])
+            for line in f:
+                values = json.loads(line)
+                fields = values.pop()
+                for search in searches:
+                    for name, value in search:
+                        if _to_text(fields.get(name)) != value:
+                            break
+                    else:
+                        yield GatherRecord.from_list(values)
+                        break
+
+
+    def search(self, fetch, fq_terms_list):
+        '''
+        Returns the GatherRecords that match the searches, from a listing
+        that is fetched with 'fetch' if the saved one is too old.
+        '''
+        self.ensure(fetch)
+        return list(self.filter(fq_terms_list))
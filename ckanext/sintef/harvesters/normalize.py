@@ -0,0 +1,235 @@
+'''
+Normalization of the tags and resources of harvested datasets.
+
+Keywords from the remotes are turned into valid CKAN tags: keywords holding
+several terms separated by commas are split, characters CKAN does not accept
+are removed, and tags are deduplicated regardless of case. The formats of
+resources are looked up in a table from the usual mimetypes and extensions
+to one format name, so that a facet shows 'CSV' rather than 'CSV', 'csv'
+and 'text/csv'.
+
+Keywords and formats repeat a lot within a catalogue, so each distinct value
+is only normalized once per process.
+'''
+import re
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Limits of the tag validators of CKAN
+MIN_TAG_LENGTH = 2
+MAX_TAG_LENGTH = 100
+
+# Number of distinct keywords and formats kept normalized per process
+CACHE_SIZE = 10000
+
+_KEYWORD_SEPARATORS_RE = re.compile(r'[,;]')
+_INVALID_TAG_CHARACTERS_RE = re.compile(r'[^\w \-.]+', re.UNICODE)
+_SPACES_RE = re.compile(r'\s+', re.UNICODE)
+
+# Format name and mimetype of the usual spellings of a format, in lower case
+FORMATS = {}
+
+
+def _add_format(name, mimetype, *spellings):
+    for spelling in (name, mimetype) + spellings:
+        if spelling:
+            FORMATS[spelling.lower()] = (name, mimetype)
+
+_add_format(u'CSV', u'text/csv', u'.csv', u'text/comma-separated-values')
+_add_format(u'JSON', u'application/json', u'.json', u'text/json')
+_add_format(u'GeoJSON', u'application/geo+json', u'.geojson',
+            u'application/vnd.geo+json')
+_add_format(u'XML', u'application/xml', u'.xml', u'text/xml')
+_add_format(u'HTML', u'text/html', u'.html', u'.htm', u'webpage')
+_add_format(u'TXT', u'text/plain', u'.txt', u'text')
+_add_format(u'PDF', u'application/pdf', u'.pdf')
+_add_format(u'ZIP', u'application/zip', u'.zip',
+            u'application/x-zip-compressed')
+_add_format(u'XLS', u'application/vnd.ms-excel', u'.xls')
+_add_format(u'XLSX', u'application/vnd.openxmlformats-officedocument.'
+            u'spreadsheetml.sheet', u'.xlsx')
+_add_format(u'KML', u'application/vnd.google-earth.kml+xml', u'.kml')
+_add_format(u'KMZ', u'application/vnd.google-earth.kmz', u'.kmz')
+_add_format(u'GML', u'application/gml+xml', u'.gml')
+_add_format(u'SOSI', None, u'.sos', u'application/x-sosi')
+_add_format(u'SHP', None, u'.shp', u'shape', u'shapefile',
+            u'application/x-shapefile')
+_add_format(u'WMS', None, u'ogc:wms')
+_add_format(u'WFS', None, u'ogc:wfs')
+_add_format(u'RDF', u'application/rdf+xml', u'.rdf')
+
+
+def _to_text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if not isinstance(value, unicode):
+        return u'%s' % value
+    return value
+
+
+_tag_cache = {}
+
+
+def tag_names(keyword):
+    '''
+    Returns the valid CKAN tag names in a keyword, as a tuple. A keyword with
+    commas or semicolons holds a tag for each term, and terms that are too
+    short after removing the characters CKAN does not accept are left out.
+    '''
+    if not keyword:
+        return ()
+    try:
+        return _tag_cache[keyword]
+    except KeyError:
+        pass
+
+    names = []
+    for term in _KEYWORD_SEPARATORS_RE.split(_to_text(keyword)):
+        name = _INVALID_TAG_CHARACTERS_RE.sub(u' ', term)
+        name = _SPACES_RE.sub(u' ', name).strip(u' -.')
+        name = name[:MAX_TAG_LENGTH].rstrip(u' -.')
+        if len(name) >= MIN_TAG_LENGTH:
+            names.append(name)
+    names = tuple(names)
+
+    if len(_tag_cache) >= CACHE_SIZE:
+        _tag_cache.clear()
+    _tag_cache[keyword] = names
+    return names
+
+
+_format_cache = {}
+
+
+def normalize_format(value):
+    '''
+    Returns the format name and mimetype of a format given as a name, a
+    mimetype or an extension. Unknown formats are returned as they are,
+    without a mimetype, unless they look like a mimetype.
+    '''
+    if not value:
+        return None, None
+    try:
+        return _format_cache[value]
+    except KeyError:
+        pass
+
+    text = _to_text(value).strip()
+    key = text.lower()
+    # Parameters like '; charset=utf-8' do not change the format
+    key = key.split(u';', 1)[0].strip()
+    result = FORMATS.get(key)
+    if result is None:
+        if u'/' in key:
+            result = (text, key)
+        else:
+            result = (text, None)
+
+    if len(_format_cache) >= CACHE_SIZE:
+        _format_cache.clear()
+    _format_cache[value] = result
+    return result
+
+
+class Normalizer(object):
+    '''
+    Normalizes the tags and resources of the package dictionaries of a
+    source.
+
+    :param default_tags: Tags every dataset of the source gets.
+    '''
+
+    def __init__(self, default_tags=()):
+        names = []
+        for keyword in default_tags or ():
+            names.extend(tag_names(keyword))
+        self.default_tags = tuple(names)
+
+
+    @classmethod
+    def from_config(cls, source_config):
+        '''
+        Returns the Normalizer of a SourceConfig.
+        '''
+        return cls(source_config.get_list('default_tags', ()))
+
+
+    def tags(self, keywords=(), existing=()):
+        '''
+        Returns the tags for a dataset, as a list of tag dictionaries.
+
+        :param keywords: Keywords of the dataset, as strings.
+        :param existing: Tags the dataset has already, as tag dictionaries
+                         or strings.
+        '''
+        seen = set()
+        tags = []
+
+        def add(keyword):
+            for name in tag_names(keyword):
+                key = name.lower()
+                if key not in seen:
+                    seen.add(key)
+                    tags.append({'name': name})
+
+        for tag in existing:
+            add(tag.get('name') if isinstance(tag, dict) else tag)
+        for keyword in keywords:
+            add(keyword)
+        for name in self.default_tags:
+            add(name)
+        return tags
+
+
+    def resources(self, resources):
+        '''
+        Returns the resources of a dataset with normalized formats and
+        mimetypes. Resources with a URL that an earlier resource has are
+        left out.
+        '''
+        seen = set()
+        normalized = []
+        for resource in resources:
+            url = resource.get('url')
+            if url:
+                if url in seen:
+                    continue
+                seen.add(url)
+            fmt, mimetype = normalize_format(resource.get('format'))
+            if fmt:
+                resource['format'] = fmt
+            if mimetype and not resource.get('mimetype'):
+                resource['mimetype'] = mimetype
+            normalized.append(resource)
+        return normalized
+
+
+    def normalize(self, pkg_dict, keywords=()):
+        '''
+        Normalizes the tags and resources of a package dictionary in place.
+
+        :param pkg_dict: Package dictionary.
+        :param keywords: Keywords of the dataset to add as tags.
+        :returns: The package dictionary.
+        '''
+        pkg_dict['tags'] = self.tags(keywords, pkg_dict.get('tags') or ())
+        pkg_dict['resources'] = self.resources(pkg_dict.get('resources') or
+                                               ())
+        return pkg_dict
+
+
+    def normalize_batch(self, pkg_dicts, get_keywords=None):
+        '''
+        Normalizes a list of package dictionaries in place.
+
+        :param pkg_dicts: Package dictionaries.
+        :param get_keywords: Callable that returns the keywords of a package
+                             dictionary.
+        :returns: The package dictionaries.
+        '''
+        for pkg_dict in pkg_dicts:
+            keywords = get_keywords(pkg_dict) if get_keywords else ()
+            self.normalize(pkg_dict, keywords or ())
+        return pkg_dicts
@@ -0,0 +1,116 @@
+'''
+Creation of the organizations of harvested datasets, safe to run from
+several import workers at the same time.
+
+Two workers importing datasets of the same new organization would both find
+that it does not exist and both try to create it, and the one that loses gets
+a ValidationError. upsert_organization() serializes the creation of each
+organization name with a PostgreSQL advisory lock, and falls back to fetching
+the organization if it was created anyway, e.g. on other databases.
+'''
+import struct
+import hashlib
+
+from ckan import model
+from ckan.logic import NotFound, ValidationError, get_action
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _lock_key(name):
+    '''
+    Returns the advisory lock key of an organization name, a signed 64-bit
+    integer.
+    '''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return struct.unpack('>q', hashlib.sha1('sintef-org:' + name)
+                         .digest()[:8])[0]
+
+
+class _OrganizationLock(object):
+    '''
+    Advisory lock on an organization name, held on its own connection so
+    that it is not released when the session commits. Does nothing on
+    databases other than PostgreSQL.
+    '''
+
+    def __init__(self, name):
+        self.key = _lock_key(name)
+        self._connection = None
+
+
+    def __enter__(self):
+        engine = model.meta.engine
+        if engine.dialect.name != 'postgresql':
+            return self
+        self._connection = engine.connect()
+        self._connection.execute('SELECT pg_advisory_lock(%s)' % self.key)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connection is None:
+            return
+        try:
+            self._connection.execute('SELECT pg_advisory_unlock(%s)' %
+                                     self.key)
+        finally:
+            self._connection.close()
+            self._connection = None
+
+
+def _show(context, name):
+    '''
+    Returns the organization with the name, made active again if it was
+    deleted, or None if there is none.
+    '''
+    try:
+        org = get_action('organization_show')(dict(context), {'id': name})
+    except NotFound:
+        return None
+    if org.get('state') == 'deleted':
+        get_action('organization_patch')(dict(context),
+                                         {'id': org['id'], 'state': 'active'})
+        log.info('Organization %s has been made active again', name)
+    return org
+
+
+def upsert_organization(context, org_dict):
+    '''
+    Returns the organization with the name in 'org_dict', creating it if it
+    does not exist. Only one worker creates an organization, the others wait
+    for it and get the created one.
+
+    :param context: Context for the actions. It is copied for each action.
+    :param org_dict: Dictionary of the organization to create, with at least
+                     'name'.
+    :returns: A tuple (org, created), where 'org' is the organization
+              dictionary and 'created' is True if it was created now.
+    :raises ValidationError: If the organization could not be created.
+    '''
+    name = org_dict['name']
+    org = _show(context, name)
+    if org is not None:
+        return org, False
+
+    with _OrganizationLock(name):
+        # Another worker may have created it while this one waited
+        org = _show(context, name)
+        if org is not None:
+            return org, False
+        try:
+            org = get_action('organization_create')(dict(context),
+                                                    dict(org_dict))
+        except ValidationError:
+            # Without a lock the name can still be taken in the meantime
+            model.Session.rollback()
+            org = _show(context, name)
+            if org is None:
+                raise
+            log.debug('Organization %s was created by another worker', name)
+            return org, False
+
+    log.info('Organization %s has been newly created', name)
+    return org, True
@@ -0,0 +1,125 @@
+'''
+Estimates of the cost of a harvest job, made without running it.
+'''
+from ckan import model
+
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Used when no earlier job of the source tells how long an import takes
+DEFAULT_IMPORT_SECONDS = 0.5
+
+
+class HarvestPlan(object):
+    '''
+    Estimated cost of the next harvest job of a source.
+
+    :param harvest_source: HarvestSource object.
+    :param incremental: Whether the job will only ask for datasets changed
+                        since the last error-free job.
+    '''
+
+    def __init__(self, harvest_source, incremental):
+        self.harvest_source = harvest_source
+        self.incremental = incremental
+        self.queries = []
+        self.search_requests = 0
+        self.getdata_requests = 0
+        self.hits = 0
+        self.exact = True
+        self.request_seconds = []
+
+
+    def add_query(self, terms, hits, pages, exact=True):
+        '''
+        Adds one search of the job.
+
+        :param terms: Dictionary describing the search.
+        :param hits: Number of datasets the search will find.
+        :param pages: Number of requests needed to page through the search.
+        :param exact: False if 'hits' and 'pages' are only lower bounds.
+        '''
+        self.queries.append({'terms': terms, 'hits': hits, 'pages': pages,
+                             'exact': exact})
+        self.search_requests += pages
+        self.hits += hits
+        self.exact = self.exact and exact
+
+
+    @property
+    def remote_requests(self):
+        return self.search_requests + self.getdata_requests
+
+
+    @property
+    def mean_request_seconds(self):
+        if not self.request_seconds:
+            return 0.0
+        return sum(self.request_seconds) / len(self.request_seconds)
+
+
+    def as_dict(self, import_seconds=None):
+        '''
+        Returns the plan as a dictionary, including the projected wall time.
+        Every HarvestObject is counted as one import, which is an upper bound
+        for incremental jobs and for searches that find the same dataset.
+
+        :param import_seconds: Seconds one import takes. By default this is
+                               measured from the last finished job of the
+                               source.
+        '''
+        if import_seconds is None:
+            import_seconds = observed_import_seconds(self.harvest_source)
+        gather_seconds = self.remote_requests * self.mean_request_seconds
+        total_import_seconds = self.hits * import_seconds
+        return {
+            'source_id': self.harvest_source.id,
+            'source_title': self.harvest_source.title,
+            'source_type': self.harvest_source.type,
+            'mode': 'incremental' if self.incremental else 'full',
+            'exact': self.exact,
+            'queries': self.queries,
+            'search_requests': self.search_requests,
+            'getdata_requests': self.getdata_requests,
+            'remote_requests': self.remote_requests,
+            'harvest_objects': self.hits,
+            'imports': self.hits,
+            'mean_request_seconds': self.mean_request_seconds,
+            'import_seconds': import_seconds,
+            'gather_seconds': gather_seconds,
+            'total_import_seconds': total_import_seconds,
+            'total_seconds': gather_seconds + total_import_seconds,
+        }
+
+
+def observed_import_seconds(harvest_source):
+    '''
+    Returns the mean number of seconds one HarvestObject took to fetch and
+    import in the last finished job of the source that had any objects.
+
+    :param harvest_source: HarvestSource object.
+    '''
+    jobs = model.Session.query(HarvestJob) \
+                .filter(HarvestJob.source == harvest_source) \
+                .filter(HarvestJob.status == 'Finished') \
+                .filter(HarvestJob.gather_finished != None) \
+                .order_by(HarvestJob.gather_finished.desc()) \
+                .limit(10)
+    for job in jobs:
+        finished = getattr(job, 'finished', None)
+        if not finished:
+            continue
+        object_count = model.Session.query(HarvestObject) \
+                            .filter(HarvestObject.harvest_job_id == job.id) \
+                            .count()
+        if not object_count:
+            continue
+        duration = finished - job.gather_finished
+        seconds = duration.days * 86400 + duration.seconds + \
+            duration.microseconds / 1000000.0
+        if seconds > 0:
+            return seconds / object_count
+    return DEFAULT_IMPORT_SECONDS
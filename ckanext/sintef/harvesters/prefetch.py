@@ -0,0 +1,484 @@
+'''
+Prefetching of the full metadata documents of HarvestObjects.
+
+The search results of some remotes are only a summary of each dataset.
+Geonorge, for one, has the whole metadata document of a dataset at
+/api/getdata/{uuid}. With "full_metadata" in the config of a source, the
+fetch stage adds that document to the content of each HarvestObject, under
+DOCUMENT_KEY, so that the import stage never has to request anything.
+
+ckanext-harvest calls the fetch stage for one object at a time. Requesting
+the document of each object when its turn comes would make every object
+wait for the remote, so the fetch stage also requests the documents of the
+next objects of the job that are waiting: a Prefetcher keeps at most
+"prefetch_window" requests going in its threads, and the documents it has
+received are written into the content of their HarvestObjects, and marked
+with fetch_finished, before a fetch consumer takes them.
+
+The gather stage puts the objects that need a document in the
+'sintef_prefetch_queue' table, in the order it returns them in, which is the
+order ckanext-harvest imports them in. The fetch stages claim the next
+objects of the queue before they request their documents, so the fetch
+consumers of a job, in any process, never request the same documents. An
+object whose document could not be prefetched requests it again in its own
+fetch stage. Incremental gathers request the document of each dataset to
+see whether it changed, and add it to the content straight away.
+
+The documents are kept in a cache of the process for a while, so that a
+document several sources, or a job that is run again, need is only
+requested once:
+
+    ckanext.sintef.prefetch_cache_size = 1000
+    ckanext.sintef.prefetch_cache_seconds = 3600
+'''
+import time
+import datetime
+import threading
+import Queue
+
+from pylons import config
+
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestObject
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Key of the full metadata document in the content of a HarvestObject
+DOCUMENT_KEY = '_document'
+
+# Requests a prefetcher keeps going at most
+DEFAULT_WINDOW = 8
+
+# Jobs of the process that documents are prefetched for at the same time
+MAX_JOBS = 2
+
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_SECONDS = 3600
+
+_DOCUMENT_MARKER = '"%s":' % DOCUMENT_KEY
+
+
+def add_document(content, document):
+    '''
+    Adds a metadata document to the content of a HarvestObject, without
+    decoding and encoding the content again.
+
+    :param content: The JSON object the HarvestObject was gathered with.
+    :param document: The metadata document, as JSON text.
+    :returns: The content with the document under DOCUMENT_KEY.
+    '''
+    stripped = content.rstrip()
+    if not stripped.endswith('}') or not stripped[:-1].strip(' \t\r\n{'):
+        content_dict = json.loads(content)
+        content_dict[DOCUMENT_KEY] = json.loads(document)
+        return json.dumps(content_dict)
+    return u'%s, "%s": %s}' % (stripped[:-1], DOCUMENT_KEY, document)
+
+
+def has_document(content):
+    '''
+    Checks whether the content of a HarvestObject has its metadata document.
+    '''
+    return content is not None and _DOCUMENT_MARKER in content
+
+
+class DocumentCache(object):
+    '''
+    The documents requested by the process, by URL, for 'seconds' after they
+    were received. The cache is emptied when it is full.
+    '''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, seconds=DEFAULT_CACHE_SECONDS):
+        self.size = size
+        self.seconds = seconds
+        self._documents = {}
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def from_config(cls):
+        return cls(int(config.get('ckanext.sintef.prefetch_cache_size',
+                                  DEFAULT_CACHE_SIZE)),
+                   int(config.get('ckanext.sintef.prefetch_cache_seconds',
+                                  DEFAULT_CACHE_SECONDS)))
+
+
+    def get(self, url):
+        '''
+        Returns the document of a URL, or None if it is not in the cache.
+        '''
+        entry = self._documents.get(url)
+        if entry is None:
+            return None
+        received, document = entry
+        if time.time() - received > self.seconds:
+            return None
+        return document
+
+
+    def put(self, url, document):
+        if not self.size:
+            return
+        with self._lock:
+            if len(self._documents) >= self.size:
+                self._documents.clear()
+            self._documents[url] = (time.time(), document)
+
+
+class Prefetcher(object):
+    '''
+    Requests documents in threads, ahead of the objects that need them.
+
+    :param fetch: Callable that returns the document of a URL. It is called
+                  by the threads of the prefetcher.
+    :param window: Requests that are going at most, which is also the number
+                   of threads, and of the documents kept until they are
+                   collected.
+    :param cache: DocumentCache the documents are looked up in and added to.
+    '''
+
+    def __init__(self, fetch, window=DEFAULT_WINDOW, cache=None):
+        self.fetch = fetch
+        self.window = window
+        self.cache = cache if cache is not None else DocumentCache()
+        self._queue = Queue.Queue()
+        self._workers = []
+        # Keys requested and not collected yet, and their URLs
+        self._pending = {}
+        # URLs being requested, and the results of those that were
+        self._running = set()
+        self._results = {}
+        self._done = threading.Condition(threading.Lock())
+
+
+    @property
+    def free(self):
+        '''
+        Number of documents that can be requested before the window is full.
+        '''
+        return self.window - len(self._pending)
+
+
+    def request(self, key, url):
+        '''
+        Requests a document in the background, unless it is cached.
+
+        :param key: What the document is for, e.g. the ID of a
+                    HarvestObject, returned by completed.
+        :param url: URL of the document.
+        :returns: False if the key was requested already.
+        '''
+        with self._done:
+            if key in self._pending:
+                return False
+            self._pending[key] = url
+            if url in self._running or url in self._results:
+                return True
+            document = self.cache.get(url)
+            if document is not None:
+                self._results[url] = (document, None)
+                return True
+            self._running.add(url)
+            self._start_workers()
+        self._queue.put(url)
+        return True
+
+
+    def completed(self):
+        '''
+        Collects the requested documents that have been received.
+
+        :returns: A list of (key, document, error) of each of them, where
+                  'error' is the exception raised by 'fetch' if the request
+                  failed, and 'document' None.
+        '''
+        done = []
+        with self._done:
+            for key, url in self._pending.items():
+                if url in self._results:
+                    document, error = self._results[url]
+                    done.append((key, document, error))
+                    del self._pending[key]
+            wanted = set(self._pending.values())
+            for url in self._results.keys():
+                if url not in wanted:
+                    del self._results[url]
+        return done
+
+
+    def get(self, url):
+        '''
+        Returns the document of a URL, waiting for it if it is being
+        requested, and requesting it in this thread if it is neither being
+        requested nor cached. A request of the prefetcher that failed is
+        tried again.
+
+        :raises: Whatever 'fetch' raises.
+        '''
+        document = self.cache.get(url)
+        if document is not None:
+            return document
+        with self._done:
+            while url in self._running:
+                self._done.wait()
+            if url in self._results and self._results[url][1] is None:
+                return self._results[url][0]
+        document = self.fetch(url)
+        self.cache.put(url, document)
+        return document
+
+
+    def join(self):
+        '''
+        Blocks until every request that is going has finished.
+        '''
+        with self._done:
+            while self._running:
+                self._done.wait()
+
+
+    def close(self):
+        '''
+        Stops the threads once the requests that are going have finished.
+        '''
+        with self._done:
+            workers = self._workers
+            self._workers = []
+        for _ in workers:
+            self._queue.put(None)
+
+
+    def _start_workers(self):
+        while len(self._workers) < self.window:
+            worker = threading.Thread(target=self._run,
+                                      name='sintef-prefetch-%s' %
+                                      len(self._workers))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+
+    def _run(self):
+        while True:
+            url = self._queue.get()
+            if url is None:
+                return
+            document = error = None
+            try:
+                document = self.fetch(url)
+                self.cache.put(url, document)
+            except Exception, e:
+                log.debug('Prefetching %s failed: %s', url, e)
+                error = e
+            with self._done:
+                self._running.discard(url)
+                self._results[url] = (document, error)
+                self._done.notifyAll()
+
+
+class DbPrefetchStore(object):
+    '''
+    Keeps the objects whose documents are to be prefetched in the
+    'sintef_prefetch_queue' table, and writes the documents into the
+    HarvestObjects.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.prefetch_queue_table
+
+
+    @property
+    def session(self):
+        from ckan import model
+        return model.Session
+
+
+    def add(self, source_id, job_id, object_ids):
+        '''
+        Queues the objects of a job, in the order they are imported in.
+        Objects that have their document already are left out.
+        '''
+        table = self.table
+        # The queues of earlier jobs of the source are no longer needed
+        self.session.execute(table.delete().where(
+            (table.c.source_id == source_id) | (table.c.job_id == job_id)))
+        documented = set(object_id for object_id, in
+                         self.session.query(HarvestObject.id)
+                         .filter(HarvestObject.harvest_job_id == job_id)
+                         .filter(HarvestObject.fetch_finished != None))
+        rows = [{'object_id': object_id, 'job_id': job_id,
+                 'source_id': source_id, 'import_order': index}
+                for index, object_id in enumerate(object_ids)
+                if object_id not in documented]
+        if rows:
+            self.session.execute(table.insert(), rows)
+        self.session.commit()
+
+
+    def claim(self, job_id, limit):
+        '''
+        Claims the next objects of the queue of a job that no fetch stage
+        has claimed, until 'limit' of them are waiting to be fetched.
+
+        :returns: A list of (object_id, guid) of the claimed objects that
+                  are waiting, in import order.
+        '''
+        table = self.table
+        waiting = []
+        while len(waiting) < limit:
+            rows = self.session.execute(
+                table.select().where((table.c.job_id == job_id) &
+                                     (table.c.claimed == None))
+                .order_by(table.c.import_order)
+                .limit(limit - len(waiting))).fetchall()
+            if not rows:
+                break
+            claimed = []
+            for row in rows:
+                # Only one fetch stage can claim an object
+                result = self.session.execute(table.update().where(
+                    (table.c.object_id == row['object_id']) &
+                    (table.c.claimed == None)
+                ).values(claimed=datetime.datetime.utcnow()))
+                if result.rowcount == 1:
+                    claimed.append(row['object_id'])
+            self.session.commit()
+            if not claimed:
+                continue
+            # Objects taken by a fetch consumer meanwhile are skipped
+            guids = dict(self.session.query(HarvestObject.id,
+                                            HarvestObject.guid)
+                         .filter(HarvestObject.id.in_(claimed))
+                         .filter(HarvestObject.state == u'WAITING')
+                         .filter(HarvestObject.fetch_finished == None))
+            waiting.extend((object_id, guids[object_id])
+                           for object_id in claimed if object_id in guids)
+        return waiting
+
+
+    def contents(self, object_ids):
+        '''
+        Returns the content of each of the objects that is waiting, by ID.
+        '''
+        return dict(self.session.query(HarvestObject.id,
+                                       HarvestObject.content)
+                    .filter(HarvestObject.id.in_(list(object_ids)))
+                    .filter(HarvestObject.state == u'WAITING'))
+
+
+    def update(self, values_by_id):
+        '''
+        Sets the values of each of the objects that is still waiting.
+
+        :param values_by_id: Dictionary from object ID to a dictionary of
+                             HarvestObject attributes.
+        '''
+        for object_id, values in values_by_id.iteritems():
+            self.session.query(HarvestObject) \
+                .filter(HarvestObject.id == object_id) \
+                .filter(HarvestObject.state == u'WAITING') \
+                .update(values, synchronize_session=False)
+        self.session.commit()
+
+
+class MemoryPrefetchStore(object):
+    '''
+    Keeps the queue in memory, and works on the HarvestObjects it is given,
+    e.g. in tests.
+
+    :param objects: The HarvestObjects of the jobs.
+    '''
+
+    def __init__(self, objects=()):
+        self.objects = dict((obj.id, obj) for obj in objects)
+        self._queues = {}
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+
+    def add(self, source_id, job_id, object_ids):
+        self._lock.acquire()
+        try:
+            for other_job_id, (other_source_id, _) in self._queues.items():
+                if other_source_id == source_id:
+                    del self._queues[other_job_id]
+            self._queues[job_id] = (source_id, [
+                object_id for object_id in object_ids
+                if self.objects[object_id].fetch_finished is None])
+        finally:
+            self._lock.release()
+
+
+    def claim(self, job_id, limit):
+        waiting = []
+        self._lock.acquire()
+        try:
+            for object_id in self._queues.get(job_id, (None, []))[1]:
+                if len(waiting) >= limit:
+                    break
+                if object_id in self._claimed:
+                    continue
+                self._claimed.add(object_id)
+                obj = self.objects[object_id]
+                if obj.state == u'WAITING' and obj.fetch_finished is None:
+                    waiting.append((object_id, obj.guid))
+        finally:
+            self._lock.release()
+        return waiting
+
+
+    def contents(self, object_ids):
+        return dict((object_id, self.objects[object_id].content)
+                    for object_id in object_ids
+                    if self.objects[object_id].state == u'WAITING')
+
+
+    def update(self, values_by_id):
+        for object_id, values in values_by_id.iteritems():
+            obj = self.objects[object_id]
+            if obj.state == u'WAITING':
+                for key, value in values.iteritems():
+                    setattr(obj, key, value)
+
+
+_cache = None
+_prefetchers = {}
+_prefetcher_jobs = []
+_prefetchers_lock = threading.Lock()
+
+
+def get_document_cache():
+    '''
+    Returns the DocumentCache of the process.
+    '''
+    global _cache
+    if _cache is None:
+        _cache = DocumentCache.from_config()
+    return _cache
+
+
+def get_prefetcher(job_id, fetch, window=DEFAULT_WINDOW):
+    '''
+    Returns the Prefetcher of a harvest job in this process, making it if
+    there is none. The prefetchers of the jobs before the last MAX_JOBS are
+    closed.
+
+    :param job_id: ID of the harvest job.
+    :param fetch: Callable that returns the document of a URL.
+    :param window: Requests that are going at most.
+    '''
+    with _prefetchers_lock:
+        prefetcher = _prefetchers.get(job_id)
+        if prefetcher is not None:
+            return prefetcher
+        while len(_prefetcher_jobs) >= MAX_JOBS:
+            _prefetchers.pop(_prefetcher_jobs.pop(0)).close()
+        prefetcher = _prefetchers[job_id] = Prefetcher(
+            fetch, window, get_document_cache())
+        _prefetcher_jobs.append(job_id)
+        return prefetcher
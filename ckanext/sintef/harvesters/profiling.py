@@ -0,0 +1,344 @@
+'''
+Profiling of harvest jobs.
+
+When profiling is turned on for a job, its gather and import stages run
+under cProfile, and a sampling profiler records the stack of the stage at a
+fixed interval of CPU time. The results are saved in a directory of the job:
+
+    <profile_dir>/<source id>/<job id>/<stage>-<pid>.pstats
+    <profile_dir>/<source id>/<job id>/<stage>-<pid>.collapsed
+
+The .pstats files can be read with the pstats module, and the .collapsed
+files, one "frame;frame;frame count" line per stack, with flamegraph.pl or
+speedscope.
+
+A stage that runs in several threads at once, like the import stage, has a
+cProfile profiler per thread, which are added up when the results are
+saved.
+
+Profiling is turned on for every job of a source with "profile": true in the
+source config, for every job with ckanext.sintef.profile = true in the CKAN
+config, or for one job with "paster sintef profile {job-id}".
+'''
+import os
+import time
+import signal
+import atexit
+import pstats
+import cProfile
+import tempfile
+import functools
+import threading
+
+from pylons import config
+from paste.deploy.converters import asbool
+
+from ckanext.sintef.harvesters.config import get_source_config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Seconds of CPU time between two stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Seconds between two writes of the results of a stage that runs many times
+DUMP_INTERVAL = 10
+
+# File in the directory of a job that turns profiling on for it
+ENABLED_MARKER = 'enabled'
+
+
+def get_profile_dir():
+    '''
+    Returns the directory the profiles of all jobs are saved in.
+    '''
+    profile_dir = config.get('ckanext.sintef.profile_dir')
+    if not profile_dir:
+        profile_dir = os.path.join(config.get('cache_dir') or
+                                   tempfile.gettempdir(), 'sintef_profiles')
+    return profile_dir
+
+
+def get_job_profile_dir(source_id, job_id):
+    return os.path.join(get_profile_dir(), source_id, job_id)
+
+
+def enable_job_profiling(source_id, job_id):
+    '''
+    Turns profiling on for one job, by creating the marker file in its
+    directory.
+    '''
+    job_dir = get_job_profile_dir(source_id, job_id)
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    open(os.path.join(job_dir, ENABLED_MARKER), 'w').close()
+    return job_dir
+
+
+def is_profiling_enabled(harvest_job):
+    '''
+    Checks whether a job is to be profiled.
+
+    :param harvest_job: HarvestJob object.
+    '''
+    if asbool(config.get('ckanext.sintef.profile', False)):
+        return True
+    try:
+        source_config = get_source_config(harvest_job.source.config,
+                                          harvest_job.source_id)
+        if source_config.get_bool('profile'):
+            return True
+    except ValueError:
+        pass
+    return os.path.exists(os.path.join(
+        get_job_profile_dir(harvest_job.source_id, harvest_job.id),
+        ENABLED_MARKER))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s:%s' % (os.path.basename(code.co_filename), code.co_name,
+                         code.co_firstlineno)
+
+
+class StackSampler(object):
+    '''
+    Sampling profiler that records the stack of the main thread every
+    'interval' seconds of CPU time, using SIGPROF. Stacks are counted in
+    collapsed form, outermost frame first.
+
+    Signals are only delivered to the main thread, so nothing is recorded
+    when a stage runs in another thread.
+    '''
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self._previous_handler = None
+        self._running = False
+
+
+    def start(self):
+        if threading.current_thread().name != 'MainThread' or \
+                not hasattr(signal, 'setitimer'):
+            return False
+        try:
+            self._previous_handler = signal.signal(signal.SIGPROF,
+                                                   self._sample)
+        except ValueError:
+            return False
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._running = True
+        return True
+
+
+    def stop(self):
+        if not self._running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self._running = False
+
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        names.reverse()
+        stack = ';'.join(names)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class StageProfile(object):
+    '''
+    The profiles of one stage of one job in this process. A stage that runs
+    many times, like the import stage, adds every run to the same profile.
+
+    cProfile only sees the thread it was enabled in, so every thread that
+    runs the stage gets a profiler of its own. A profiler that is running
+    when the results are saved is left out until the next time.
+    '''
+
+    def __init__(self, job_dir, stage):
+        self.job_dir = job_dir
+        self.stage = stage
+        self.sampler = StackSampler(float(config.get(
+            'ckanext.sintef.profile_sample_interval',
+            DEFAULT_SAMPLE_INTERVAL)))
+        self.last_dump = time.time()
+        self.dirty = False
+        self._profilers = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+
+    def run(self, func, *args, **kwargs):
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            profiler = self._profilers.get(thread_id)
+            if profiler is None:
+                profiler = self._profilers[thread_id] = cProfile.Profile()
+            self._running.add(thread_id)
+        sampling = self.sampler.start()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            if sampling:
+                self.sampler.stop()
+            with self._lock:
+                self._running.discard(thread_id)
+                self.dirty = True
+
+
+    def dump(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            profilers = [profiler for thread_id, profiler
+                         in self._profilers.iteritems()
+                         if thread_id not in self._running]
+            if not profilers:
+                return
+            stats = pstats.Stats(profilers[0])
+            for profiler in profilers[1:]:
+                stats.add(profiler)
+
+            if not os.path.isdir(self.job_dir):
+                os.makedirs(self.job_dir)
+            prefix = os.path.join(self.job_dir,
+                                  '%s-%s' % (self.stage, os.getpid()))
+            stats.dump_stats(prefix + '.pstats')
+            self.sampler.write(prefix + '.collapsed')
+            self.last_dump = time.time()
+            self.dirty = bool(self._running)
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def _get_stage_profile(harvest_job, stage):
+    key = (harvest_job.id, stage)
+    with _profiles_lock:
+        profile = _profiles.get(key)
+        if profile is None:
+            # Only the profiles of the latest job are kept open
+            for other_key in _profiles.keys():
+                if other_key[1] == stage:
+                    _profiles.pop(other_key).dump()
+            job_dir = get_job_profile_dir(harvest_job.source_id,
+                                          harvest_job.id)
+            profile = _profiles[key] = StageProfile(job_dir, stage)
+    return profile
+
+
+def _dump_all():
+    for profile in _profiles.values():
+        try:
+            profile.dump()
+        except Exception, e:
+            log.error('Could not save profile of %s: %s', profile.job_dir, e)
+
+
+atexit.register(_dump_all)
+
+
+def profiled(stage, get_job):
+    '''
+    Decorator for the stages of a harvester that profiles them for the jobs
+    profiling is turned on for.
+
+    :param stage: Name of the stage, used in the names of the files.
+    :param get_job: Callable that returns the HarvestJob from the argument
+                    the stage is called with.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, obj, *args, **kwargs):
+            try:
+                harvest_job = get_job(obj)
+                enabled = harvest_job is not None and \
+                    is_profiling_enabled(harvest_job)
+            except Exception, e:
+                log.debug('Could not check whether to profile: %s', e)
+                enabled = False
+            if not enabled:
+                return func(self, obj, *args, **kwargs)
+
+            profile = _get_stage_profile(harvest_job, stage)
+            try:
+                return profile.run(func, self, obj, *args, **kwargs)
+            finally:
+                if stage == 'gather' or \
+                        time.time() - profile.last_dump > DUMP_INTERVAL:
+                    try:
+                        profile.dump()
+                    except Exception, e:
+                        log.error('Could not save profile of %s: %s',
+                                  profile.job_dir, e)
+        return wrapper
+    return decorator
+
+
+def job_of_job(harvest_job):
+    return harvest_job
+
+
+def job_of_object(harvest_object):
+    return harvest_object.job if harvest_object else None
+
+
+def find_profile_files(extension, source_or_job_ids=None):
+    '''
+    Returns the paths of the files of the profiled jobs with the given
+    extension, optionally only of the given sources or jobs.
+
+    :param extension: '.pstats' or '.collapsed'.
+    :param source_or_job_ids: List of IDs of sources or jobs.
+    '''
+    profile_dir = get_profile_dir()
+    paths = []
+    if not os.path.isdir(profile_dir):
+        return paths
+    wanted = set(source_or_job_ids or [])
+    for source_id in sorted(os.listdir(profile_dir)):
+        source_dir = os.path.join(profile_dir, source_id)
+        if not os.path.isdir(source_dir):
+            continue
+        for job_id in sorted(os.listdir(source_dir)):
+            if wanted and source_id not in wanted and job_id not in wanted:
+                continue
+            job_dir = os.path.join(source_dir, job_id)
+            if not os.path.isdir(job_dir):
+                continue
+            for name in sorted(os.listdir(job_dir)):
+                if name.endswith(extension):
+                    paths.append(os.path.join(job_dir, name))
+    return paths
+
+
+def merge_collapsed(paths, out):
+    '''
+    Adds up the collapsed stacks of several files, and writes them to the
+    file-like object 'out'.
+    '''
+    stacks = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack:
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+    for stack, count in sorted(stacks.iteritems()):
+        out.write('%s %d\n' % (stack, count))
+    return len(stacks)
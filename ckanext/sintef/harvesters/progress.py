@@ -0,0 +1,397 @@
+'''
+Progress and throughput of running harvest jobs.
+
+The gather and import stages count the objects they handle, and the time
+each one took, in memory. The counters of each process are written to the
+'sintef_harvest_progress' table in batches, every FLUSH_EVERY objects or
+FLUSH_SECONDS seconds, with one row per job, stage and process. Rows are
+only written by the process they belong to, so the writes of import
+workers running at the same time never conflict.
+
+Latencies are kept as histograms with fixed buckets, which can be added up
+across processes to get the percentiles of a whole job.
+'''
+import os
+import time
+import bisect
+import socket
+import datetime
+import threading
+
+from sqlalchemy import and_
+
+from ckan import model
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Upper bounds in seconds of the latency buckets. The last bucket counts
+# everything slower.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+# Objects, and seconds, between two writes of the counters of a process
+FLUSH_EVERY = 200
+FLUSH_SECONDS = 10
+
+# Seconds after which the counters of a job that is no longer updated are
+# dropped from memory
+FORGET_SECONDS = 3600
+
+STAGES = ('gather', 'import')
+
+
+def worker_name():
+    return u'%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def _empty_histogram():
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def percentile(histogram, fraction):
+    '''
+    Returns the upper bound in seconds of the bucket that holds the given
+    percentile of a histogram, or None if it is in the last bucket or the
+    histogram is empty.
+
+    :param histogram: List of counts, one for each bucket.
+    :param fraction: Percentile between 0 and 1.
+    '''
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            break
+    if index < len(LATENCY_BUCKETS):
+        return LATENCY_BUCKETS[index]
+    return None
+
+
+class ProgressTracker(object):
+    '''
+    Counts the objects handled by the stages of this process.
+
+    :param store_factory: Callable returning the store the counters are
+                          written to, called on the first write.
+    :param flush_every: Objects between two writes.
+    :param flush_seconds: Seconds between two writes.
+    '''
+
+    def __init__(self, store_factory=None, flush_every=FLUSH_EVERY,
+                 flush_seconds=FLUSH_SECONDS):
+        self._store_factory = store_factory or DbProgressStore
+        self._store = None
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._counters = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flusher = None
+
+
+    def _counter(self, job_id, source_id, stage):
+        key = (job_id, stage)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = {
+                'job_id': job_id, 'source_id': source_id, 'stage': stage,
+                'count': 0, 'errors': 0, 'total': None,
+                'histogram': _empty_histogram(),
+                'started': datetime.datetime.utcnow(), 'dirty': True}
+        counter['updated'] = datetime.datetime.utcnow()
+        return counter
+
+
+    def record(self, job_id, source_id, stage, seconds, ok=True):
+        '''
+        Counts an object handled by a stage.
+
+        :param job_id: ID of the harvest job.
+        :param source_id: ID of the harvest source.
+        :param stage: 'gather' or 'import'.
+        :param seconds: Time it took to handle the object.
+        :param ok: False if handling the object failed.
+        '''
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        self._lock.acquire()
+        try:
+            counter = self._counter(job_id, source_id, stage)
+            if ok:
+                counter['count'] += 1
+            else:
+                counter['errors'] += 1
+            counter['histogram'][bucket] += 1
+            counter['dirty'] = True
+            self._pending += 1
+            flush = self._pending >= self.flush_every
+            self._start_flusher()
+        finally:
+            self._lock.release()
+        if flush:
+            self.flush()
+
+
+    def set_total(self, job_id, source_id, total):
+        '''
+        Sets the number of objects a job has to import, and writes the
+        counters right away.
+        '''
+        self._lock.acquire()
+        try:
+            counter = self._counter(job_id, source_id, 'gather')
+            counter['total'] = total
+            counter['dirty'] = True
+        finally:
+            self._lock.release()
+        self.flush()
+
+
+    def flush(self):
+        '''
+        Writes the counters that changed since the last write.
+        '''
+        now = datetime.datetime.utcnow()
+        forget = datetime.timedelta(seconds=FORGET_SECONDS)
+        self._lock.acquire()
+        try:
+            rows = []
+            for key, counter in self._counters.items():
+                if counter['dirty']:
+                    rows.append(dict(counter,
+                                     histogram=list(counter['histogram'])))
+                    counter['dirty'] = False
+                elif now - counter['updated'] > forget:
+                    del self._counters[key]
+            self._pending = 0
+        finally:
+            self._lock.release()
+        if not rows:
+            return
+
+        try:
+            if self._store is None:
+                self._store = self._store_factory()
+            self._store.put(rows, worker_name())
+        except Exception, e:
+            log.warning('Could not save the progress of harvest jobs: %s', e)
+            # The counters hold totals, so the next write makes up for this
+            self._lock.acquire()
+            try:
+                for row in rows:
+                    counter = self._counters.get((row['job_id'],
+                                                  row['stage']))
+                    if counter is not None:
+                        counter['dirty'] = True
+            finally:
+                self._lock.release()
+
+
+    def _start_flusher(self):
+        # Writes the last counters of a job when no more objects come
+        if self._flusher is not None and self._flusher.isAlive():
+            return
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name='sintef-progress-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+
+class DbProgressStore(object):
+    '''
+    Keeps the counters in the 'sintef_harvest_progress' table. Writes use a
+    connection of their own, never the Session of the stage.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.harvest_progress_table
+
+
+    def put(self, rows, worker):
+        table = self.table
+        connection = model.meta.engine.connect()
+        transaction = connection.begin()
+        try:
+            for row in rows:
+                values = {'source_id': row['source_id'],
+                          'count': row['count'],
+                          'errors': row['errors'],
+                          'total': row['total'],
+                          'histogram': json.dumps(row['histogram']),
+                          'started': row['started'],
+                          'updated': row['updated']}
+                result = connection.execute(table.update().where(and_(
+                    table.c.job_id == row['job_id'],
+                    table.c.stage == row['stage'],
+                    table.c.worker == worker)).values(**values))
+                if result.rowcount == 0:
+                    connection.execute(table.insert().values(
+                        job_id=row['job_id'], stage=row['stage'],
+                        worker=worker, **values))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+    def rows(self, job_ids):
+        '''
+        Returns the counters of the given jobs, of every process.
+        '''
+        if not job_ids:
+            return []
+        table = self.table
+        result = model.Session.execute(
+            table.select().where(table.c.job_id.in_(list(job_ids))))
+        rows = []
+        for row in result.fetchall():
+            row = dict(row)
+            row['histogram'] = json.loads(row['histogram'] or '[]')
+            rows.append(row)
+        return rows
+
+
+class MemoryProgressStore(object):
+    '''
+    Keeps the counters in memory, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self._rows = {}
+
+
+    def put(self, rows, worker):
+        for row in rows:
+            self._rows[(row['job_id'], row['stage'], worker)] = \
+                dict(row, worker=worker)
+
+
+    def rows(self, job_ids):
+        return [row for key, row in sorted(self._rows.items())
+                if key[0] in job_ids]
+
+
+def _add_histograms(histograms):
+    total = _empty_histogram()
+    for histogram in histograms:
+        for index, count in enumerate(histogram[:len(total)]):
+            total[index] += count
+    return total
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _isoformat(value):
+    if value is None:
+        return None
+    return value.replace(microsecond=0).isoformat()
+
+
+def summarize(job_id, rows, now=None):
+    '''
+    Adds up the counters of the processes working on a job.
+
+    :param job_id: ID of the harvest job.
+    :param rows: Counters of the job, as returned by a store.
+    :param now: Time to estimate the completion from, in UTC.
+    :returns: A dictionary with the figures of each stage, the number of
+              objects remaining and the estimated completion time.
+    '''
+    now = now or datetime.datetime.utcnow()
+    summary = {'job_id': job_id, 'source_id': None, 'total': None,
+               'stages': {}}
+    for stage in STAGES:
+        stage_rows = [row for row in rows if row['stage'] == stage]
+        if not stage_rows:
+            continue
+        summary['source_id'] = stage_rows[0]['source_id']
+        started = min(row['started'] for row in stage_rows)
+        updated = max(row['updated'] for row in stage_rows)
+        count = sum(row['count'] for row in stage_rows)
+        errors = sum(row['errors'] for row in stage_rows)
+        histogram = _add_histograms(row['histogram'] for row in stage_rows)
+        elapsed = _seconds(updated - started)
+        for row in stage_rows:
+            if row.get('total') is not None:
+                summary['total'] = row['total']
+        summary['stages'][stage] = {
+            'count': count,
+            'errors': errors,
+            'workers': len(stage_rows),
+            'started': _isoformat(started),
+            'updated': _isoformat(updated),
+            'rate': (count + errors) / elapsed if elapsed > 0 else None,
+            'p50': percentile(histogram, 0.5),
+            'p90': percentile(histogram, 0.9),
+            'p99': percentile(histogram, 0.99),
+        }
+
+    summary['remaining'] = None
+    summary['eta'] = None
+    if summary['total'] is not None:
+        imported = summary['stages'].get('import', {})
+        done = imported.get('count', 0) + imported.get('errors', 0)
+        summary['remaining'] = max(summary['total'] - done, 0)
+        rate = imported.get('rate')
+        if summary['remaining'] == 0:
+            summary['eta'] = imported.get('updated')
+        elif rate:
+            summary['eta'] = _isoformat(now + datetime.timedelta(
+                seconds=summary['remaining'] / rate))
+    return summary
+
+
+def get_progress(job_ids=None, source_id=None, store=None):
+    '''
+    Returns the progress of harvest jobs.
+
+    :param job_ids: IDs of the jobs. By default every job that has not
+                    finished.
+    :param source_id: Only jobs of this harvest source.
+    :param store: Store to read the counters from.
+    :returns: A list of summaries, see summarize().
+    '''
+    from ckanext.harvest.model import HarvestJob
+
+    query = model.Session.query(HarvestJob)
+    if job_ids:
+        query = query.filter(HarvestJob.id.in_(list(job_ids)))
+    else:
+        query = query.filter(HarvestJob.status.in_([u'New', u'Running']))
+    if source_id:
+        query = query.filter(HarvestJob.source_id == source_id)
+    jobs = query.order_by(HarvestJob.created).all()
+    if not jobs:
+        return []
+
+    store = store or DbProgressStore()
+    rows = store.rows([job.id for job in jobs])
+    summaries = []
+    for job in jobs:
+        summary = summarize(job.id, [row for row in rows
+                                     if row['job_id'] == job.id])
+        summary['source_id'] = job.source_id
+        summary['status'] = job.status
+        summaries.append(summary)
+    return summaries
+
+
+progress_tracker = ProgressTracker()
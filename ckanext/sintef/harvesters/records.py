@@ -0,0 +1,134 @@
+'''
+Compact representation of the datasets found in the gather stage.
+
+The gather stage may hold every dataset of a remote catalogue in memory at
+once. Instead of keeping the decoded dictionaries around, each dataset is
+kept as the JSON string that will be stored in HarvestObject.content, along
+with the few fields the gather stage needs. Where the response is split into
+the raw JSON of each dataset, that text is kept as it is.
+'''
+import struct
+import hashlib
+
+from ckan.lib.helpers import json
+
+
+class GatherRecord(object):
+    '''
+    One dataset found in the gather stage.
+
+    :param guid: The remote identifier of the dataset.
+    :param title: The title of the dataset, used for logging.
+    :param raw: The metadata of the dataset as a JSON string, either unicode
+                or UTF-8 encoded.
+    :param modified: When the metadata of the dataset was last modified on
+                     the remote, if known.
+    '''
+    __slots__ = ('guid', 'title', 'raw', 'modified')
+
+    def __init__(self, guid, title, raw, modified=None):
+        self.guid = guid
+        self.title = title
+        self.raw = raw
+        self.modified = modified
+
+
+    @classmethod
+    def from_raw(cls, raw, pkg_dict, guid_key, title_key, modified_key=None):
+        '''
+        Makes a record out of the raw JSON of a dataset, as it was split out
+        of the response, and the decoded dataset, which is only read. The
+        dataset is not encoded again.
+        '''
+        modified = pkg_dict.get(modified_key) if modified_key else None
+        return cls(pkg_dict[guid_key], pkg_dict.get(title_key), raw, modified)
+
+
+    @classmethod
+    def from_dict(cls, pkg_dict, guid_key, title_key, modified_key=None):
+        '''
+        Makes a record out of a decoded dataset. The dataset is encoded to
+        JSON once, and the dictionary can be thrown away afterwards.
+        '''
+        modified = pkg_dict.get(modified_key) if modified_key else None
+        return cls(pkg_dict[guid_key], pkg_dict.get(title_key),
+                   json.dumps(pkg_dict), modified)
+
+
+    @classmethod
+    def from_list(cls, values):
+        '''
+        Makes a record out of the list returned by as_list.
+        '''
+        return cls(*values)
+
+
+    def as_list(self):
+        '''
+        Returns the record as a list that can be encoded to JSON.
+        '''
+        return [self.guid, self.title, self.raw, self.modified]
+
+
+    @property
+    def content(self):
+        '''
+        The metadata of the dataset as the unicode JSON string stored in
+        HarvestObject.content. The raw JSON of a response is kept UTF-8
+        encoded, which takes less memory, until it is stored.
+        '''
+        if isinstance(self.raw, str):
+            return self.raw.decode('utf-8')
+        return self.raw
+
+
+    def as_dict(self):
+        '''
+        Returns the decoded metadata of the dataset.
+        '''
+        return json.loads(self.raw)
+
+
+class IdSet(object):
+    '''
+    Set of dataset identifiers used to drop duplicates in the gather stage.
+
+    Only a 64 bit hash of each identifier is kept, which is much smaller than
+    the identifier itself when identifiers are URLs. The chance of two
+    different identifiers getting the same hash is negligible for catalogues
+    of any realistic size.
+    '''
+    __slots__ = ('_hashes',)
+
+    def __init__(self, ids=()):
+        self._hashes = set()
+        for id in ids:
+            self.add(id)
+
+
+    @staticmethod
+    def _hash(id):
+        if isinstance(id, unicode):
+            id = id.encode('utf-8')
+        return struct.unpack('<q', hashlib.md5(id).digest()[:8])[0]
+
+
+    def add(self, id):
+        '''
+        Adds an identifier to the set.
+
+        :returns: False if the identifier was in the set already, else True.
+        '''
+        id_hash = self._hash(id)
+        if id_hash in self._hashes:
+            return False
+        self._hashes.add(id_hash)
+        return True
+
+
+    def __contains__(self, id):
+        return self._hash(id) in self._hashes
+
+
+    def __len__(self):
+        return len(self._hashes)
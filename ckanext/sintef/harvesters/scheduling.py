@@ -0,0 +1,169 @@
+'''
+Import order of the HarvestObjects of a gather stage.
+
+ckanext-harvest sends the HarvestObjects of a job to the fetch queue in the
+order the gather stage returns their IDs, and the import consumers take them
+in that order. The scheduler sorts the IDs so that the datasets that actually
+changed are imported first:
+
+    1. datasets that have not been harvested from the source before,
+    2. datasets modified on the remote since they were last harvested, the
+       most recently modified first,
+    3. datasets that are only harvested again to check them.
+
+The modified date of each dataset is stored in
+HarvestObject.metadata_modified_date, which is what the next job compares
+with. A dataset whose record has no modified date keeps the date stored
+before, and the fetch stage stores the date of the metadata document it
+adds, if any.
+'''
+import re
+import datetime
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestObject
+
+import logging
+log = logging.getLogger(__name__)
+
+
+PRIORITY_NEW = 0
+PRIORITY_CHANGED = 1
+PRIORITY_REVALIDATE = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_NEW: 'new',
+    PRIORITY_CHANGED: 'changed',
+    PRIORITY_REVALIDATE: 'revalidate',
+}
+
+_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})'
+                      r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?')
+
+
+def parse_modified(value):
+    '''
+    Parses the modified date of a remote dataset, like '2017-03-14' or
+    '2017-03-14T10:31:02.123Z'. Any time zone is ignored.
+
+    :returns: A datetime, or None if the value is not a date.
+    '''
+    if isinstance(value, datetime.datetime):
+        return value
+    if not isinstance(value, basestring):
+        return None
+    match = _DATE_RE.match(value.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime.datetime(int(year), int(month), int(day),
+                                 int(hour or 0), int(minute or 0),
+                                 int(second or 0),
+                                 int((fraction or '0').ljust(6, '0')))
+    except ValueError:
+        return None
+
+
+def current_modified_dates(source_id):
+    '''
+    Returns a dictionary with the GUID of every dataset that has a current
+    HarvestObject from the source, and its stored modified date, or None if
+    it was not stored.
+    '''
+    rows = model.Session.query(HarvestObject.guid,
+                               HarvestObject.metadata_modified_date) \
+                .filter(HarvestObject.harvest_source_id == source_id) \
+                .filter(HarvestObject.current == True)
+    return dict((guid, modified) for guid, modified in rows)
+
+
+class ImportScheduler(object):
+    '''
+    Collects the HarvestObjects made by a gather stage, and returns their IDs
+    in import order.
+
+    :param source_id: ID of the harvest source.
+    :param known: Dictionary from GUID to stored modified date of the
+                  datasets harvested before. Read from the database if not
+                  given.
+    '''
+
+    def __init__(self, source_id, known=None):
+        self.source_id = source_id
+        self._known = known
+        self._entries = []
+
+
+    @property
+    def known(self):
+        if self._known is None:
+            self._known = current_modified_dates(self.source_id)
+        return self._known
+
+
+    def modified(self, record):
+        '''
+        Returns the modified date to store for a GatherRecord: its own, or
+        else the one stored when it was harvested before, if any.
+        '''
+        modified = parse_modified(record.modified)
+        if modified is None:
+            modified = self.known.get(record.guid)
+        return modified
+
+
+    def priority(self, record, modified=None):
+        '''
+        Returns the priority of a GatherRecord, lowest first.
+
+        :param modified: The parsed modified date of the record, if already
+                         known.
+        '''
+        if record.guid not in self.known:
+            return PRIORITY_NEW
+        if modified is None:
+            modified = parse_modified(record.modified)
+        stored = self.known[record.guid]
+        if modified is not None and (stored is None or modified > stored):
+            return PRIORITY_CHANGED
+        return PRIORITY_REVALIDATE
+
+
+    def add(self, object_id, record, modified=None):
+        '''
+        Adds the HarvestObject made for a GatherRecord.
+        '''
+        if modified is None:
+            modified = parse_modified(record.modified)
+        priority = self.priority(record, modified)
+        # Newer changes first, and otherwise the order of the gather stage
+        newest_first = 0
+        if priority == PRIORITY_CHANGED:
+            delta = modified - datetime.datetime(1970, 1, 1)
+            newest_first = -(delta.days * 86400 + delta.seconds)
+        self._entries.append((priority, newest_first, len(self._entries),
+                              object_id))
+
+
+    def counts(self):
+        '''
+        Returns the number of objects with each priority, by name.
+        '''
+        counts = dict((name, 0) for name in PRIORITY_NAMES.values())
+        for entry in self._entries:
+            counts[PRIORITY_NAMES[entry[0]]] += 1
+        return counts
+
+
+    def ordered_ids(self):
+        '''
+        Returns the IDs of the HarvestObjects in import order.
+        '''
+        self._entries.sort()
+        return [entry[3] for entry in self._entries]
+
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,462 @@
+'''
+Sharded gather stage.
+
+The searches of one gather job are split into shards. The gather consumer
+that runs the job is the coordinator: it stores the shards, sends messages
+for helpers on the shard queue and runs shards itself until none are left.
+Every shard consumer that receives one of the messages becomes a helper,
+which claims and runs shards of the job until none are left. The records
+found by each shard are handed back to the coordinator through the shard
+store, and the coordinator merges them, dropping duplicates, once every
+shard is done.
+
+The shard queue is a queue of its own, next to the gather and fetch queues
+of ckanext-harvest, and is consumed by "paster sintef shard-consumer". The
+gather queue can not be used: ckanext-harvest sets gather_finished on the
+job when a gather consumer is done with a message, and would then mark the
+job as finished before the coordinator has created any HarvestObjects.
+Without shard consumers, the coordinator runs every shard itself.
+'''
+import time
+import datetime
+import operator
+import threading
+
+from pylons import config
+
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+SHARD_PENDING = u'pending'
+SHARD_RUNNING = u'running'
+SHARD_DONE = u'done'
+SHARD_ERROR = u'error'
+SHARD_MERGED = u'merged'
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardedGather(object):
+    '''
+    Runs the shards of gather jobs.
+
+    :param store: Where shards and their results are kept, e.g. a
+                  DbShardStore.
+    :param queue: Where messages for helpers are sent, e.g. a ShardQueue.
+    :param search: Function that takes a shard spec and returns a list of
+                   records that can be encoded to JSON.
+    :param key: Function that returns the identifier of a record.
+    :param poll_interval: Seconds between checks of unfinished shards.
+    :param shard_timeout: Seconds after which a shard that is still running
+                          is taken over by the coordinator.
+    '''
+
+    def __init__(self, store, queue, search, key=operator.itemgetter('Uuid'),
+                 poll_interval=1, shard_timeout=600):
+        self.store = store
+        self.queue = queue
+        self.search = search
+        self.key = key
+        self.poll_interval = poll_interval
+        self.shard_timeout = shard_timeout
+
+
+    def is_helper(self, job_id):
+        '''
+        Returns True if the job has been split into shards by a coordinator
+        already, in which case the caller should act as a helper.
+        '''
+        return self.store.has_shards(job_id)
+
+
+    def coordinate(self, source_id, job_id, shards, helpers):
+        '''
+        Splits the job into the given shards, asks for 'helpers' shard
+        consumers, runs shards until every shard is done and merges the
+        results.
+
+        :param source_id: ID of the harvest source.
+        :param job_id: ID of the harvest job.
+        :param shards: List of shard specs, one for each call to 'search'.
+        :param helpers: Number of messages to send for helpers.
+        :returns: The merged list of records, without duplicates.
+        '''
+        self.store.create(source_id, job_id, shards)
+        helpers = min(helpers, len(shards) - 1)
+        for helper in range(helpers):
+            self.queue.send({'harvest_job_id': job_id})
+        log.info('Gather job %s split into %s shards, asked for %s helpers',
+                 job_id, len(shards), helpers)
+
+        self.work(job_id)
+        self._wait(job_id)
+        return self._merge(job_id)
+
+
+    def work(self, job_id, reclaim_stale=False):
+        '''
+        Claims and runs shards of the job until there are none left.
+
+        :param job_id: ID of the harvest job.
+        :param reclaim_stale: Whether shards that have been running for
+                              longer than 'shard_timeout' may be taken over.
+        :returns: The number of shards that were run.
+        '''
+        shard_count = 0
+        while True:
+            stale_before = None
+            if reclaim_stale:
+                stale_before = datetime.datetime.utcnow() - \
+                    datetime.timedelta(seconds=self.shard_timeout)
+            claimed = self.store.claim(job_id, stale_before)
+            if claimed is None:
+                return shard_count
+
+            index, spec, token = claimed
+            log.debug('Running shard %s of gather job %s: %r',
+                      index, job_id, spec)
+            try:
+                records = self.search(spec)
+            except Exception, e:
+                log.info('Shard %s of gather job %s failed: %s',
+                         index, job_id, e)
+                saved = self.store.fail(job_id, index, token, '%s' % e)
+            else:
+                saved = self.store.complete(job_id, index, token, records)
+            if not saved:
+                # The shard was taken over, or the job merged, while it ran
+                log.info('Dropping the result of shard %s of gather job %s, '
+                         'which is no longer run by this consumer',
+                         index, job_id)
+            shard_count += 1
+
+
+    def _wait(self, job_id):
+        while True:
+            states = self.store.states(job_id)
+            if not [s for s in states.values()
+                    if s in (SHARD_PENDING, SHARD_RUNNING)]:
+                return
+            # Take over shards of helpers that seem to have died
+            if not self.work(job_id, reclaim_stale=True):
+                time.sleep(self.poll_interval)
+
+
+    def _merge(self, job_id):
+        records = []
+        keys = set()
+        duplicates = 0
+        errors = []
+        for index, state, shard_records, error in self.store.results(job_id):
+            if state == SHARD_ERROR:
+                errors.append('shard %s: %s' % (index, error))
+                continue
+            for record in shard_records:
+                record_key = self.key(record)
+                if record_key in keys:
+                    log.debug('Discarding duplicate dataset %s found by more '
+                              'than one shard', record_key)
+                    duplicates += 1
+                    continue
+                keys.add(record_key)
+                records.append(record)
+        self.store.mark_merged(job_id)
+        if duplicates:
+            log.info('Discarded %s duplicate datasets found by more than one '
+                     'shard of gather job %s', duplicates, job_id)
+
+        if errors:
+            raise ShardError('Gather job %s had failing shards: %s' %
+                             (job_id, '; '.join(errors)))
+        return records
+
+
+def get_shard_routing_key():
+    return 'ckanext-sintef:%s:shard' % config.get('ckan.site_id', 'default')
+
+
+def get_shard_queue_name():
+    return 'ckan.sintef.%s.shard' % config.get('ckan.site_id', 'default')
+
+
+class ShardQueue(object):
+    '''
+    Sends messages for helpers on the shard queue, with the queue backend of
+    ckanext-harvest.
+    '''
+
+    def send(self, message):
+        from ckanext.harvest.queue import get_publisher
+        publisher = get_publisher(get_shard_routing_key())
+        try:
+            publisher.send(message)
+        finally:
+            publisher.close()
+
+
+def shard_callback(channel, method, header, body, run_helper):
+    '''
+    Handles a message of the shard queue.
+
+    :param run_helper: Callable that runs shards of the job with the ID in
+                       the message.
+    :returns: False if the message could not be read.
+    '''
+    # Acknowledged first: the coordinator takes over the shards of a
+    # helper that dies
+    channel.basic_ack(method.delivery_tag)
+    try:
+        job_id = json.loads(body)['harvest_job_id']
+    except (ValueError, KeyError, TypeError), e:
+        log.error('Could not read shard message %r: %s', body, e)
+        return False
+    try:
+        shard_count = run_helper(job_id)
+        log.info('Ran %s shards of gather job %s', shard_count, job_id)
+    except Exception, e:
+        log.error('Running shards of gather job %s failed: %s', job_id, e)
+    return True
+
+
+def consume_shards(run_helper, consumer=None):
+    '''
+    Handles the messages of the shard queue until interrupted.
+
+    :param run_helper: Callable that runs shards of the job with the given
+                       ID.
+    :param consumer: Consumer of the queue, by default one of the queue
+                     backend of ckanext-harvest.
+    '''
+    if consumer is None:
+        from ckanext.harvest.queue import get_consumer
+        consumer = get_consumer(get_shard_queue_name(),
+                                get_shard_routing_key())
+    for method, header, body in consumer.consume(
+            queue=get_shard_queue_name()):
+        shard_callback(consumer, method, header, body, run_helper)
+
+
+class DbShardStore(object):
+    '''
+    Keeps shards in the 'sintef_gather_shard' table, so that gather consumers
+    on different nodes can share them.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.gather_shard_table
+
+
+    @property
+    def session(self):
+        from ckan import model
+        return model.Session
+
+
+    def create(self, source_id, job_id, shards):
+        table = self.table
+        # Shards of earlier jobs of the source are no longer needed
+        self.session.execute(table.delete().where(
+            (table.c.source_id == source_id) | (table.c.job_id == job_id)))
+        now = datetime.datetime.utcnow()
+        for index, spec in enumerate(shards):
+            self.session.execute(table.insert().values(
+                job_id=job_id, shard_index=index, source_id=source_id,
+                spec=json.dumps(spec), state=SHARD_PENDING, updated=now))
+        self.session.commit()
+
+
+    def has_shards(self, job_id):
+        table = self.table
+        return self.session.execute(
+            table.select().where(table.c.job_id == job_id).limit(1)
+        ).first() is not None
+
+
+    def claim(self, job_id, stale_before=None):
+        '''
+        Claims a pending shard of a job, or one that has been running since
+        before 'stale_before'.
+
+        :returns: The index and spec of the shard, and the token to save its
+                  result with, or None if there is no shard to claim.
+        '''
+        table = self.table
+        claimable = table.c.state == SHARD_PENDING
+        if stale_before is not None:
+            claimable = claimable | ((table.c.state == SHARD_RUNNING) &
+                                     (table.c.updated < stale_before))
+        rows = self.session.execute(
+            table.select().where((table.c.job_id == job_id) & claimable)
+                          .order_by(table.c.shard_index)).fetchall()
+
+        for row in rows:
+            # Only one consumer can move the shard away from the state
+            # it was read in, which makes the claim atomic.
+            token = datetime.datetime.utcnow()
+            result = self.session.execute(table.update().where(
+                (table.c.job_id == job_id) &
+                (table.c.shard_index == row['shard_index']) &
+                (table.c.state == row['state']) &
+                (table.c.updated == row['updated'])
+            ).values(state=SHARD_RUNNING, updated=token))
+            self.session.commit()
+            if result.rowcount == 1:
+                return row['shard_index'], json.loads(row['spec']), token
+        return None
+
+
+    def complete(self, job_id, index, token, records):
+        '''
+        Saves the records found by a shard, unless the shard is no longer
+        run with the token of its claim.
+
+        :returns: True if the records were saved.
+        '''
+        return self._finish(job_id, index, token, state=SHARD_DONE,
+                            records=json.dumps(records))
+
+
+    def fail(self, job_id, index, token, error):
+        '''
+        Saves why a shard failed, unless the shard is no longer run with the
+        token of its claim.
+
+        :returns: True if the error was saved.
+        '''
+        return self._finish(job_id, index, token, state=SHARD_ERROR,
+                            error=error)
+
+
+    def states(self, job_id):
+        table = self.table
+        rows = self.session.execute(
+            table.select().where(table.c.job_id == job_id)).fetchall()
+        return dict((row['shard_index'], row['state']) for row in rows)
+
+
+    def results(self, job_id):
+        table = self.table
+        rows = self.session.execute(
+            table.select().where(table.c.job_id == job_id)
+                          .order_by(table.c.shard_index)).fetchall()
+        for row in rows:
+            records = json.loads(row['records']) if row['records'] else []
+            yield row['shard_index'], row['state'], records, row['error']
+
+
+    def mark_merged(self, job_id):
+        table = self.table
+        self.session.execute(table.update().where(table.c.job_id == job_id)
+                             .values(state=SHARD_MERGED, records=None))
+        self.session.commit()
+
+
+    def _finish(self, job_id, index, token, **values):
+        # A shard taken over by another consumer has another token, and a
+        # merged one is no longer running
+        table = self.table
+        values['updated'] = datetime.datetime.utcnow()
+        result = self.session.execute(table.update().where(
+            (table.c.job_id == job_id) & (table.c.shard_index == index) &
+            (table.c.state == SHARD_RUNNING) & (table.c.updated == token)
+        ).values(**values))
+        self.session.commit()
+        return result.rowcount == 1
+
+
+class MemoryShardStore(object):
+    '''
+    Keeps shards in memory. Only useful when every gather consumer runs in
+    the same process, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self._shards = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+
+    def create(self, source_id, job_id, shards):
+        self._lock.acquire()
+        try:
+            for other_job_id, other_source_id in self._sources.items():
+                if other_source_id == source_id:
+                    self._shards.pop(other_job_id, None)
+            self._sources[job_id] = source_id
+            now = datetime.datetime.utcnow()
+            self._shards[job_id] = [
+                {'spec': json.loads(json.dumps(spec)), 'state': SHARD_PENDING,
+                 'records': None, 'error': None, 'updated': now}
+                for spec in shards]
+        finally:
+            self._lock.release()
+
+
+    def has_shards(self, job_id):
+        return job_id in self._shards
+
+
+    def claim(self, job_id, stale_before=None):
+        self._lock.acquire()
+        try:
+            for index, shard in enumerate(self._shards.get(job_id, [])):
+                stale = stale_before is not None and \
+                    shard['state'] == SHARD_RUNNING and \
+                    shard['updated'] < stale_before
+                if shard['state'] == SHARD_PENDING or stale:
+                    shard['state'] = SHARD_RUNNING
+                    shard['updated'] = datetime.datetime.utcnow()
+                    return index, shard['spec'], shard['updated']
+            return None
+        finally:
+            self._lock.release()
+
+
+    def complete(self, job_id, index, token, records):
+        return self._finish(job_id, index, token, state=SHARD_DONE,
+                            records=json.loads(json.dumps(records)))
+
+
+    def fail(self, job_id, index, token, error):
+        return self._finish(job_id, index, token, state=SHARD_ERROR,
+                            error=error)
+
+
+    def states(self, job_id):
+        return dict((index, shard['state']) for index, shard
+                    in enumerate(self._shards.get(job_id, [])))
+
+
+    def results(self, job_id):
+        for index, shard in enumerate(self._shards.get(job_id, [])):
+            yield index, shard['state'], shard['records'] or [], shard['error']
+
+
+    def mark_merged(self, job_id):
+        self._lock.acquire()
+        try:
+            for shard in self._shards.get(job_id, []):
+                shard.update(state=SHARD_MERGED, records=None,
+                             updated=datetime.datetime.utcnow())
+        finally:
+            self._lock.release()
+
+
+    def _finish(self, job_id, index, token, **values):
+        self._lock.acquire()
+        try:
+            shard = self._shards[job_id][index]
+            if shard['state'] != SHARD_RUNNING or shard['updated'] != token:
+                return False
+            shard.update(values)
+            shard['updated'] = datetime.datetime.utcnow()
+            return True
+        finally:
+            self._lock.release()
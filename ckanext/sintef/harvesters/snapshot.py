@@ -0,0 +1,236 @@
+'''
+Snapshots of the datasets gathered by a harvest job.
+
+A snapshot is a single file with the GatherRecords of a job, which a source
+with "snapshot": "/path/to/file" in its config gathers from instead of the
+remote. Replays are then fast, offline and give the same datasets every
+time, and the file can be used as input for the benchmarks.
+
+Layout of the file, all integers little-endian:
+
+    header   magic (8 bytes), version (uint32), record count (uint32),
+             offset of the metadata (uint64), offset of the index (uint64)
+    records  for each record: length (uint32), zlib compressed JSON list
+             of the values of the GatherRecord
+    metadata length (uint32), zlib compressed JSON object
+    index    offset of each record (uint64)
+
+The reader maps the file into memory, and only decompresses the records
+that are read.
+'''
+import os
+import mmap
+import zlib
+import struct
+import datetime
+
+from ckan import model
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestObject
+from ckanext.sintef.harvesters.records import GatherRecord
+
+import logging
+log = logging.getLogger(__name__)
+
+
+MAGIC = 'SNTFSNAP'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sIIQQ')
+_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotWriter(object):
+    '''
+    Writes a snapshot file.
+
+    :param path: Path of the file.
+    :param meta: Dictionary describing the snapshot, like the source and job
+                 it was made from.
+    :param level: zlib compression level.
+    '''
+
+    def __init__(self, path, meta=None, level=6):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.level = level
+        self._offsets = []
+        self._file = open(path + '.tmp', 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+
+
+    def _write_block(self, data):
+        offset = self._file.tell()
+        data = zlib.compress(data, self.level)
+        self._file.write(_LENGTH.pack(len(data)))
+        self._file.write(data)
+        return offset
+
+
+    def add(self, record):
+        '''
+        Adds a GatherRecord to the snapshot.
+        '''
+        self._offsets.append(self._write_block(json.dumps(record.as_list())))
+
+
+    def close(self):
+        '''
+        Writes the metadata and the index, and moves the file into place.
+        '''
+        self.meta.setdefault('created', datetime.datetime.utcnow().isoformat())
+        self.meta['records'] = len(self._offsets)
+        meta_offset = self._write_block(json.dumps(self.meta))
+        index_offset = self._file.tell()
+        for offset in self._offsets:
+            self._file.write(_OFFSET.pack(offset))
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, VERSION, len(self._offsets),
+                                      meta_offset, index_offset))
+        self._file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+
+    def __len__(self):
+        return len(self._offsets)
+
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self.path + '.tmp')
+
+
+class SnapshotReader(object):
+    '''
+    Reads a snapshot file. Records can be read in order or by position.
+
+    :param path: Path of the file.
+    :raises SnapshotError: If the file is not a snapshot.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._file = open(path, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotError('%s is not a snapshot' % path)
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error), e:
+            raise SnapshotError('Could not open snapshot %s: %s' % (path, e))
+
+        magic, version, self._count, meta_offset, self._index_offset = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError('%s is not a snapshot' % path)
+        if version != VERSION:
+            self.close()
+            raise SnapshotError('Snapshot %s has unsupported version %s' %
+                                (path, version))
+        if self._index_offset + self._count * _OFFSET.size > size:
+            self.close()
+            raise SnapshotError('Snapshot %s is truncated' % path)
+        self.meta = json.loads(self._read_block(meta_offset))
+
+
+    def _read_block(self, offset):
+        length, = _LENGTH.unpack_from(self._map, offset)
+        start = offset + _LENGTH.size
+        try:
+            return zlib.decompress(self._map[start:start + length])
+        except zlib.error, e:
+            raise SnapshotError('Snapshot %s is corrupt: %s' % (self.path, e))
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('snapshot index out of range')
+        offset, = _OFFSET.unpack_from(
+            self._map, self._index_offset + index * _OFFSET.size)
+        return GatherRecord.from_list(json.loads(self._read_block(offset)))
+
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def _title_of(content):
+    try:
+        pkg_dict = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    return pkg_dict.get('Title') or pkg_dict.get('title')
+
+
+def export_job_snapshot(harvest_job, path):
+    '''
+    Writes the datasets gathered by a job to a snapshot file.
+
+    :param harvest_job: HarvestJob object.
+    :param path: Path of the file.
+    :returns: The number of records written.
+    '''
+    objects = model.Session.query(HarvestObject.guid, HarvestObject.content,
+                                  HarvestObject.metadata_modified_date) \
+                   .filter(HarvestObject.harvest_job_id == harvest_job.id) \
+                   .order_by(HarvestObject.gathered) \
+                   .yield_per(500)
+
+    writer = SnapshotWriter(path, {
+        'source_id': harvest_job.source_id,
+        'source_type': harvest_job.source.type,
+        'source_url': harvest_job.source.url,
+        'job_id': harvest_job.id,
+    })
+    try:
+        for guid, content, modified in objects:
+            if content is None:
+                continue
+            if modified is not None:
+                modified = modified.isoformat()
+            writer.add(GatherRecord(guid, _title_of(content), content,
+                                    modified))
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    return len(writer)
+
+
+def read_snapshot_records(path):
+    '''
+    Yields the GatherRecords of a snapshot file, one at a time. The file is
+    closed when every record has been read, or when the generator is closed.
+
+    :raises SnapshotError: If the file can not be read.
+    '''
+    reader = SnapshotReader(path)
+    try:
+        log.info('Gathering %s datasets from snapshot %s of job %s',
+                 len(reader), path, reader.meta.get('job_id'))
+        for record in reader:
+            yield record
+    finally:
+        reader.close()
@@ -0,0 +1,266 @@
+'''
+Validation of the records of the remotes, and quarantine of invalid ones.
+
+Each harvester describes the fields it needs of a remote record in a
+RecordSchema, which is compiled into a list of checks once, when the
+harvester class is defined. Every record is checked as it is gathered, and
+a record that fails is put in quarantine instead of being turned into a
+HarvestObject: it is kept in the 'sintef_quarantine' table with the reasons
+it failed, and the other records of the job are gathered as usual. Records
+are checked again before they are imported, as older HarvestObjects and
+snapshots were not checked when they were gathered.
+
+A search page that can not be read at all is put in quarantine too, and
+the search goes on with the next page. The job gets a gather error, so that
+the next job searches for the datasets of that page again.
+
+"paster sintef quarantine" shows the records in quarantine.
+'''
+import datetime
+import threading
+
+from sqlalchemy import select, func
+
+from ckan import model
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Characters of the content of a record kept in quarantine
+MAX_CONTENT_LENGTH = 65536
+
+_TYPE_NAMES = {basestring: 'a string', unicode: 'a string', str: 'a string',
+               bool: 'a boolean', int: 'an integer', float: 'a number',
+               dict: 'an object', list: 'a list'}
+
+
+def _type_name(types):
+    if not isinstance(types, tuple):
+        types = (types,)
+    return ' or '.join(_TYPE_NAMES.get(type_, type_.__name__)
+                       for type_ in types)
+
+
+class RecordSchema(object):
+    '''
+    The fields a harvester needs in the records of its remote.
+
+    :param fields: List of (path, types, required). The path is the key of
+                   the field, with '.' between the keys of nested objects and
+                   '[]' after a list whose items are checked, e.g.
+                   'publisher.name' or 'distribution[].accessURL'. The value
+                   must be an instance of types. A field that is not
+                   required may be missing or null.
+    '''
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._checks = [self._compile(path, types, required)
+                        for path, types, required in self.fields]
+
+
+    def _compile(self, path, types, required):
+        steps = []
+        for key in path.split('.'):
+            if key.endswith('[]'):
+                steps.append((key[:-2], True))
+            else:
+                steps.append((key, False))
+        expected = _type_name(types)
+        # True is an int, but not a valid integer
+        allows_bool = bool in (types if isinstance(types, tuple) else (types,))
+
+        def check(record):
+            values = [record]
+            seen = []
+            for key, is_list in steps:
+                found = []
+                for value in values:
+                    if not isinstance(value, dict):
+                        return '%s is not an object' % '.'.join(seen)
+                    value = value.get(key)
+                    if value is None:
+                        if required:
+                            return '%s is missing' % path
+                        continue
+                    if is_list:
+                        if not isinstance(value, list):
+                            return '%s is not a list' % \
+                                '.'.join(seen + [key])
+                        found.extend(value)
+                    else:
+                        found.append(value)
+                seen.append(key + '[]' if is_list else key)
+                values = found
+            for value in values:
+                if not isinstance(value, types) or \
+                        (isinstance(value, bool) and not allows_bool):
+                    return '%s is not %s' % (path, expected)
+            return None
+        return check
+
+
+    def validate(self, record):
+        '''
+        Returns the reasons a decoded record is not valid, an empty list if
+        it is.
+        '''
+        if not isinstance(record, dict):
+            return ['the record is not an object']
+        reasons = []
+        for check in self._checks:
+            reason = check(record)
+            if reason is not None:
+                reasons.append(reason)
+        return reasons
+
+
+class Quarantine(object):
+    '''
+    Puts the invalid records of a harvest job in quarantine.
+
+    :param job_id: ID of the harvest job.
+    :param source_id: ID of the harvest source.
+    :param store: DbQuarantineStore or MemoryQuarantineStore.
+    '''
+
+    def __init__(self, job_id, source_id, store=None):
+        self.job_id = job_id
+        self.source_id = source_id
+        self.store = store or DbQuarantineStore()
+        # Records and responses put in quarantine
+        self.count = 0
+        # Responses of the remote that could not be read
+        self.responses = 0
+
+
+    def put(self, stage, guid, reasons, content):
+        '''
+        Puts a record in quarantine.
+
+        :param stage: 'gather', 'fetch' or 'import'.
+        :param guid: Identifier of the record, or the URL of a search page
+                     that could not be read.
+        :param reasons: List of the reasons the record is invalid.
+        :param content: The record, decoded or as text.
+        '''
+        if not isinstance(content, basestring):
+            content = json.dumps(content)
+        self.count += 1
+        self.store.put({
+            'source_id': self.source_id,
+            'job_id': self.job_id,
+            'stage': stage,
+            'guid': guid,
+            'reason': u'; '.join(reasons),
+            'content': content[:MAX_CONTENT_LENGTH],
+        })
+
+
+    def put_response(self, url, reason, content=None):
+        '''
+        Puts a response of the remote that could not be read in quarantine.
+
+        :param url: URL of the request.
+        :param reason: Why the response could not be read.
+        :param content: The response, if it was read.
+        '''
+        self.responses += 1
+        self.put('gather', url, [reason], content or u'')
+
+
+class DbQuarantineStore(object):
+    '''
+    Keeps the records in quarantine in the 'sintef_quarantine' table.
+    '''
+
+    def __init__(self):
+        from ckanext.sintef import model as sintef_model
+        sintef_model.setup()
+        self.table = sintef_model.quarantine_table
+
+
+    def put(self, entry):
+        # Written with a connection of its own, so a failing import does not
+        # roll it back
+        connection = model.meta.engine.connect()
+        try:
+            connection.execute(self.table.insert().values(
+                created=datetime.datetime.utcnow(), **entry))
+        finally:
+            connection.close()
+
+
+    def counts(self):
+        '''
+        Returns the number of records in quarantine of each source.
+        '''
+        table = self.table
+        rows = model.Session.execute(
+            select([table.c.source_id, func.count()])
+            .group_by(table.c.source_id)).fetchall()
+        return dict((source_id, count) for source_id, count in rows)
+
+
+    def latest(self, source_id, limit=30):
+        '''
+        Returns the latest records in quarantine of a source, newest first.
+        '''
+        table = self.table
+        rows = model.Session.execute(table.select()
+            .where(table.c.source_id == source_id)
+            .order_by(table.c.created.desc()).limit(limit)).fetchall()
+        return [dict(row) for row in rows]
+
+
+    def clear(self, source_id):
+        table = self.table
+        result = model.Session.execute(
+            table.delete().where(table.c.source_id == source_id))
+        model.Session.commit()
+        return result.rowcount
+
+
+class MemoryQuarantineStore(object):
+    '''
+    Keeps the records in quarantine in memory, e.g. in tests.
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self._lock = threading.Lock()
+
+
+    def put(self, entry):
+        self._lock.acquire()
+        try:
+            self.entries.append(dict(entry,
+                                     created=datetime.datetime.utcnow()))
+        finally:
+            self._lock.release()
+
+
+    def counts(self):
+        counts = {}
+        for entry in self.entries:
+            counts[entry['source_id']] = counts.get(entry['source_id'], 0) + 1
+        return counts
+
+
+    def latest(self, source_id, limit=30):
+        entries = [entry for entry in self.entries
+                   if entry['source_id'] == source_id]
+        return list(reversed(entries))[:limit]
+
+
+    def clear(self, source_id):
+        self._lock.acquire()
+        try:
+            before = len(self.entries)
+            self.entries = [entry for entry in self.entries
+                            if entry['source_id'] != source_id]
+            return before - len(self.entries)
+        finally:
+            self._lock.release()
@@ -0,0 +1,81 @@
+'''
+Actions of the SINTEF harvesters.
+'''
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestSource
+
+from ckanext.sintef.harvesters.config import get_source_config
+from ckanext.sintef.harvesters.progress import get_progress
+from ckanext.sintef.harvesters.frequency import source_recommendation
+
+# Source types of the SINTEF harvesters
+SOURCE_TYPES = (u'geonorge', u'datanorge')
+
+
+@toolkit.side_effect_free
+def sintef_harvest_progress(context, data_dict):
+    '''
+    Returns the progress of harvest jobs: for the gather and import stage
+    the objects handled, the errors, the rate in objects per second and the
+    50th, 90th and 99th percentile of the time per object in seconds, and
+    for the job the objects remaining and the estimated completion time in
+    UTC.
+
+    :param id: ID of a harvest job. By default every job that has not
+               finished is returned.
+    :type id: string
+    :param source_id: Only return jobs of this harvest source.
+    :type source_id: string
+    :rtype: list of dictionaries
+    '''
+    toolkit.check_access('sintef_harvest_progress', context, data_dict)
+
+    job_ids = None
+    if data_dict.get('id'):
+        job_ids = [data_dict['id']]
+    return get_progress(job_ids, data_dict.get('source_id'))
+
+
+@toolkit.side_effect_free
+def sintef_harvest_frequency(context, data_dict):
+    '''
+    Returns how often harvest sources should be harvested, from the changes
+    found by their last finished jobs: the recommended hours between two
+    jobs, the frequency of ckanext-harvest that comes closest without being
+    longer, when the next job is due in UTC and why, and the changed
+    datasets per hour, the share of the objects that changed and the number
+    of jobs that found no changes.
+
+    :param id: ID or name of a harvest source. By default every active
+               Geonorge and Data Norge source is returned.
+    :type id: string
+    :rtype: list of dictionaries
+    '''
+    toolkit.check_access('sintef_harvest_frequency', context, data_dict)
+
+    if data_dict.get('id'):
+        source = HarvestSource.get(data_dict['id'])
+        if source is None:
+            package = model.Package.get(data_dict['id'])
+            if package is not None:
+                source = HarvestSource.get(package.id)
+        if source is None:
+            raise toolkit.ObjectNotFound('Harvest source not found')
+        sources = [source]
+    else:
+        sources = model.Session.query(HarvestSource) \
+            .filter(HarvestSource.active == True) \
+            .filter(HarvestSource.type.in_(SOURCE_TYPES)) \
+            .order_by(HarvestSource.created).all()
+
+    recommendations = []
+    for source in sources:
+        recommendation = source_recommendation(
+            source, get_source_config(source.config, source.id))
+        if recommendation['next_run'] is not None:
+            recommendation['next_run'] = \
+                recommendation['next_run'].isoformat()
+        recommendations.append(recommendation)
+    return recommendations
@@ -0,0 +1,14 @@
+'''
+Authorization of the actions of the SINTEF harvesters. Only sysadmins, who
+are never checked, may use them.
+'''
+
+
+def sintef_harvest_progress(context, data_dict):
+    return {'success': False,
+            'msg': 'Only sysadmins can see the progress of harvest jobs'}
+
+
+def sintef_harvest_frequency(context, data_dict):
+    return {'success': False,
+            'msg': 'Only sysadmins can see the harvest frequency of sources'}
@@ -0,0 +1,250 @@
+'''
+Structured logging of harvest jobs.
+
+The harvesters log events: a name like 'import.imported' with fields like
+the job and source IDs. Events are rendered as "name key=value ..." by the
+usual formatters, and as one JSON object per line by JsonFormatter, which
+can be set in the logging config of the CKAN ini file:
+
+    [formatters]
+    keys = generic, json
+
+    [formatter_json]
+    class = ckanext.sintef.logs.JsonFormatter
+
+Errors are always logged with all their fields. Events that happen for
+every record of a job and mean that all went well are not logged one by
+one: EventAggregator counts them and logs one summary event per job every
+ckanext.sintef.log_summary_seconds seconds (60 by default), and one in
+every ckanext.sintef.log_sample_every events (100 by default, 0 for none)
+is also logged on its own at DEBUG level.
+
+Nothing is formatted for events of a level that is not enabled.
+'''
+# Loaded by the logging config, before CKAN is, so the json module of CKAN
+# is not used here
+import json
+import time
+import datetime
+import logging
+import threading
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SUMMARY_SECONDS = 60
+DEFAULT_SAMPLE_EVERY = 100
+
+# Attributes every LogRecord has, which are not fields of an event
+_RECORD_ATTRIBUTES = frozenset(logging.LogRecord(
+    '', 0, '', 0, '', (), None).__dict__) | frozenset(['message', 'asctime'])
+
+
+class _EventMessage(object):
+    '''
+    Message of an event, only rendered when a handler formats it.
+    '''
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+
+    def __str__(self):
+        parts = [self.event]
+        for key in sorted(self.fields):
+            parts.append('%s=%s' % (key, _text(self.fields[key])))
+        return ' '.join(parts)
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, default=_json_default)
+    return '%s' % (value,)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return '%r' % (value,)
+
+
+def log_event(logger, level, event, exc_info=None, **fields):
+    '''
+    Logs an event with fields, if the level is enabled for the logger.
+
+    :param logger: Logger to log with.
+    :param level: Level of the event, e.g. logging.INFO.
+    :param event: Name of the event, e.g. 'import.failed'.
+    :param exc_info: True or an exception tuple to log a traceback.
+    :param fields: Fields of the event. Fields that are None are left out.
+    '''
+    if not logger.isEnabledFor(level):
+        return
+    for key, value in fields.items():
+        if value is None:
+            del fields[key]
+    extra = dict(fields)
+    extra['event'] = event
+    logger.log(level, _EventMessage(event, fields), exc_info=exc_info,
+               extra=extra)
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats each record as a JSON object on one line, with the fields of
+    the event at the top level.
+    '''
+
+    def format(self, record):
+        document = {
+            'time': datetime.datetime.utcfromtimestamp(record.created)
+                            .isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+        }
+        if getattr(record, 'event', None) is None:
+            document['message'] = record.getMessage()
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=_json_default)
+
+
+class EventAggregator(object):
+    '''
+    Counts the success events of the records of harvest jobs and logs a
+    summary of them per job, see the module docstring.
+
+    :param summary_seconds: Seconds between two summaries of a job.
+    :param sample_every: Log one in this many events on its own, at DEBUG
+                         level. 0 to log none.
+    '''
+
+    def __init__(self, summary_seconds=None, sample_every=None):
+        self._summary_seconds = summary_seconds
+        self._sample_every = sample_every
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+
+    @property
+    def summary_seconds(self):
+        if self._summary_seconds is None:
+            self._summary_seconds = int(config.get(
+                'ckanext.sintef.log_summary_seconds',
+                DEFAULT_SUMMARY_SECONDS))
+        return self._summary_seconds
+
+
+    @property
+    def sample_every(self):
+        if self._sample_every is None:
+            self._sample_every = int(config.get(
+                'ckanext.sintef.log_sample_every', DEFAULT_SAMPLE_EVERY))
+        return self._sample_every
+
+
+    def count(self, logger, event, job_id, source_id, **fields):
+        '''
+        Counts a success event of a record.
+
+        :param logger: Logger the summary and samples are logged with.
+        :param event: Name of the event.
+        :param job_id: ID of the harvest job.
+        :param source_id: ID of the harvest source.
+        :param fields: Fields of the record, only logged if it is sampled.
+        '''
+        now = time.time()
+        key = (logger.name, event, job_id)
+        self._lock.acquire()
+        try:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = {
+                    'logger': logger, 'event': event, 'job_id': job_id,
+                    'source_id': source_id, 'count': 0, 'total': 0,
+                    'since': now}
+            counter['count'] += 1
+            counter['total'] += 1
+            total = counter['total']
+            sampled = self.sample_every and \
+                total % self.sample_every == 1 % self.sample_every
+            summary = None
+            if now - counter['since'] >= self.summary_seconds:
+                summary = self._take(counter, now)
+            self._start_flusher()
+        finally:
+            self._lock.release()
+
+        if sampled:
+            log_event(logger, logging.DEBUG, event, job_id=job_id,
+                      source_id=source_id, sample_of=total,
+                      **fields)
+        if summary:
+            self._log_summary(summary)
+
+
+    def _take(self, counter, now):
+        # Returns the summary of a counter and starts counting again
+        summary = dict(counter, seconds=round(now - counter['since'], 1))
+        counter['count'] = 0
+        counter['since'] = now
+        return summary
+
+
+    def _log_summary(self, summary):
+        log_event(summary['logger'], logging.INFO, summary['event'],
+                  job_id=summary['job_id'], source_id=summary['source_id'],
+                  count=summary['count'], seconds=summary['seconds'],
+                  total=summary['total'], summary=True)
+
+
+    def flush(self, job_id=None):
+        '''
+        Logs the summaries of the events counted since the last ones, of
+        one job or all of them.
+        '''
+        now = time.time()
+        summaries = []
+        self._lock.acquire()
+        try:
+            for key, counter in self._counters.items():
+                if job_id is not None and counter['job_id'] != job_id:
+                    continue
+                if counter['count']:
+                    summaries.append(self._take(counter, now))
+                elif now - counter['since'] > 10 * self.summary_seconds:
+                    # The job has not counted anything for a long time
+                    del self._counters[key]
+        finally:
+            self._lock.release()
+        for summary in summaries:
+            self._log_summary(summary)
+
+
+    def _start_flusher(self):
+        # Logs the last summaries of a job when no more records come
+        if self._flusher is not None and self._flusher.isAlive():
+            return
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name='sintef-log-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(max(self.summary_seconds, 1))
+            self.flush()
+
+
+event_aggregator = EventAggregator()
@@ -0,0 +1,109 @@
+'''
+Database tables used by the SINTEF harvesters.
+
+The tables are created the first time they are needed, by calling setup().
+'''
+import datetime
+
+from sqlalchemy import Table, Column, types
+
+from ckan.model.meta import metadata
+
+import logging
+log = logging.getLogger(__name__)
+
+
+gather_shard_table = Table('sintef_gather_shard', metadata,
+    Column('job_id', types.UnicodeText, primary_key=True),
+    Column('shard_index', types.Integer, primary_key=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('spec', types.UnicodeText),
+    Column('state', types.UnicodeText, default=u'pending'),
+    Column('records', types.UnicodeText),
+    Column('error', types.UnicodeText),
+    Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+remote_health_table = Table('sintef_remote_health', metadata,
+    Column('remote', types.UnicodeText, primary_key=True),
+    Column('state', types.UnicodeText, default=u'closed'),
+    Column('failures', types.Integer, default=0),
+    Column('last_failure', types.DateTime),
+    Column('last_success', types.DateTime),
+    Column('opened', types.DateTime),
+    Column('last_full_fallback', types.DateTime),
+    Column('reason', types.UnicodeText),
+    Column('decision', types.UnicodeText),
+    Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+harvest_progress_table = Table('sintef_harvest_progress', metadata,
+    Column('job_id', types.UnicodeText, primary_key=True),
+    Column('stage', types.UnicodeText, primary_key=True),
+    Column('worker', types.UnicodeText, primary_key=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('count', types.Integer, default=0),
+    Column('errors', types.Integer, default=0),
+    Column('total', types.Integer),
+    Column('histogram', types.UnicodeText),
+    Column('started', types.DateTime),
+    Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+gather_checkpoint_table = Table('sintef_gather_checkpoint', metadata,
+    Column('job_id', types.UnicodeText, primary_key=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('state', types.UnicodeText, default=u'partial'),
+    Column('mode', types.UnicodeText),
+    Column('since', types.UnicodeText),
+    Column('position', types.UnicodeText),
+    Column('config_digest', types.UnicodeText),
+    Column('chain_started', types.DateTime),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+dataset_identity_table = Table('sintef_dataset_identity', metadata,
+    Column('identifier', types.UnicodeText, primary_key=True),
+    Column('package_id', types.UnicodeText, index=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+quarantine_table = Table('sintef_quarantine', metadata,
+    Column('id', types.Integer, primary_key=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('job_id', types.UnicodeText),
+    Column('stage', types.UnicodeText),
+    Column('guid', types.UnicodeText),
+    Column('reason', types.UnicodeText),
+    Column('content', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+prefetch_queue_table = Table('sintef_prefetch_queue', metadata,
+    Column('object_id', types.UnicodeText, primary_key=True),
+    Column('job_id', types.UnicodeText, index=True),
+    Column('source_id', types.UnicodeText, index=True),
+    Column('import_order', types.Integer),
+    Column('claimed', types.DateTime),
+)
+
+_tables_created = False
+
+
+def setup():
+    '''
+    Creates the tables of the SINTEF harvesters if they do not exist yet.
+    '''
+    global _tables_created
+    if _tables_created:
+        return
+
+    for table in (gather_shard_table, remote_health_table,
+                  harvest_progress_table, gather_checkpoint_table,
+                  dataset_identity_table, quarantine_table,
+                  prefetch_queue_table):
+        if not table.exists():
+            table.create()
+            log.debug('Table %s created', table.name)
+    _tables_created = True
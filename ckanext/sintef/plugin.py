@@ -0,0 +1,27 @@
+from ckan.plugins.core import SingletonPlugin, implements
+from ckan.plugins.interfaces import IActions, IAuthFunctions
+
+from ckanext.sintef.logic import action, auth
+
+
+class SintefPlugin(SingletonPlugin):
+    '''
+    Actions for following the harvest jobs of the SINTEF harvesters and
+    scheduling them.
+    '''
+    implements(IActions)
+    implements(IAuthFunctions)
+
+
+    def get_actions(self):
+        return {
+            'sintef_harvest_progress': action.sintef_harvest_progress,
+            'sintef_harvest_frequency': action.sintef_harvest_frequency,
+        }
+
+
+    def get_auth_functions(self):
+        return {
+            'sintef_harvest_progress': auth.sintef_harvest_progress,
+            'sintef_harvest_frequency': auth.sintef_harvest_frequency,
+        }
@@ -0,0 +1,188 @@
+"""Tests for harvesters/budget.py."""
+import urlparse
+import datetime
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.budget import (GatherBudget,
+                                              GatherBudgetExhausted,
+                                              MemoryCheckpointStore,
+                                              CHECKPOINT_PARTIAL,
+                                              CHECKPOINT_CONTINUED,
+                                              CHECKPOINT_COMPLETE,
+                                              MODE_MODIFIED,
+                                              MODE_EVERYTHING)
+from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+
+
+BASE_URL = 'http://kartkatalog.geonorge.no'
+
+SEARCHES = [{'text': 'a'}, {'text': 'b'}]
+
+# Results of each search by offset, one page of results and an empty one
+PAGES = {
+    ('a', '1'): ['a1'],
+    ('b', '1'): ['b1'],
+}
+
+SINCE = '2017-02-28T11:00:00'
+
+
+class _Job(object):
+    source_id = 'source'
+
+    def __init__(self, job_id, gather_started):
+        self.id = job_id
+        self.gather_started = gather_started
+
+
+class SearchingHarvester(GeonorgeHarvester):
+    '''Answers the searches from PAGES, and charges the budget for every
+    request like the real requests do.'''
+
+    def __init__(self):
+        self.requests = []
+
+    def _get_content(self, url):
+        budget = self.gather_budget
+        if budget is not None:
+            budget.charge_request()
+        query = urlparse.parse_qs(urlparse.urlparse(url).query)
+        key = (query['text'][0], query['offset'][0])
+        self.requests.append(key)
+        return json.dumps({'Results': [{'Uuid': uuid, 'Title': uuid,
+                                        'Organization': 'Kartverket'}
+                                       for uuid in PAGES.get(key, [])]})
+
+
+def _harvester(config='{}'):
+    harvester = SearchingHarvester()
+    harvester._set_config(config, 'source')
+    return harvester
+
+
+def _gather(harvester, budget):
+    '''
+    Does the searches within a budget, and returns the GUIDs found and why
+    the budget stopped them, if it did.
+    '''
+    harvester.gather_budget = budget
+    guids = []
+    try:
+        for record in harvester._iter_searches(BASE_URL, SEARCHES):
+            guids.append(record.guid)
+    except GatherBudgetExhausted, e:
+        return guids, '%s' % e
+    finally:
+        harvester.gather_budget = None
+    return guids, None
+
+
+def _partial(harvester, job, budget, chain_started):
+    return {'job_id': job.id, 'source_id': job.source_id,
+            'state': CHECKPOINT_PARTIAL, 'mode': MODE_MODIFIED,
+            'since': SINCE, 'position': budget.position,
+            'config_digest': harvester.config.digest,
+            'chain_started': chain_started}
+
+
+def test_budget_only_stops_searches_that_made_progress():
+    budget = GatherBudget(requests=1, resume_position={'search': 1,
+                                                       'offset': 1})
+    budget.checkpoint({'search': 1, 'offset': 1})
+    budget.charge_request()
+    budget.charge_request()
+    assert budget.request_count == 2
+
+    budget.checkpoint({'search': 1, 'offset': 11})
+    try:
+        budget.charge_request()
+    except GatherBudgetExhausted, e:
+        assert '%s' % e == 'used its 1 requests'
+    else:
+        assert False, 'GatherBudgetExhausted not raised'
+
+
+def test_next_job_continues_the_searches():
+    store = MemoryCheckpointStore()
+    first_job = _Job('job1', datetime.datetime(2017, 3, 1, 12))
+    harvester = _harvester()
+
+    # The budget runs out at the start of the second search
+    budget = GatherBudget(requests=2)
+    guids, reason = _gather(harvester, budget)
+    assert guids == ['a1']
+    assert reason == 'used its 2 requests'
+    assert budget.position == {'search': 1, 'offset': 1}
+    store.put(_partial(harvester, first_job, budget,
+                       first_job.gather_started))
+
+    # A job never continues its own searches
+    assert harvester._continued_checkpoint(first_job, store) is None
+    assert store.get('job1')['state'] == CHECKPOINT_PARTIAL
+
+    second_job = _Job('job2', datetime.datetime(2017, 3, 1, 13))
+    checkpoint = harvester._continued_checkpoint(second_job, store)
+    assert checkpoint['job_id'] == 'job1'
+    assert store.get('job1')['state'] == CHECKPOINT_CONTINUED
+    assert store.latest_partial('source') is None
+
+    harvester.requests = []
+    guids, reason = _gather(harvester, GatherBudget(
+        requests=2, resume_position=checkpoint['position']))
+    assert guids == ['b1']
+    assert reason is None
+    assert harvester.requests == [('b', '1'), ('b', '11')]
+
+    # The job that completes the searches is recorded with the searches,
+    # and the start, of the first job
+    harvester._complete_checkpoint(second_job, checkpoint, store,
+                                   harvester._searched_from(
+                                       checkpoint['chain_started']),
+                                   MODE_EVERYTHING, None)
+    completed = store.get('job2')
+    assert completed['state'] == CHECKPOINT_COMPLETE
+    assert completed['mode'] == MODE_MODIFIED
+    assert completed['since'] == SINCE
+    assert completed['chain_started'] == first_job.gather_started
+    assert store.incomplete_job_ids('source') == ['job1']
+
+
+def test_changed_config_starts_the_searches_over():
+    store = MemoryCheckpointStore()
+    first_job = _Job('job1', datetime.datetime(2017, 3, 1, 12))
+    budget = GatherBudget(requests=2)
+    _gather(_harvester(), budget)
+    store.put(_partial(_harvester(), first_job, budget,
+                       first_job.gather_started))
+
+    harvester = _harvester('{"gather_requests": 2}')
+    second_job = _Job('job2', datetime.datetime(2017, 3, 1, 13))
+    assert harvester._continued_checkpoint(second_job, store) is None
+    # The checkpoint is not continued by a later job either
+    assert store.get('job1')['state'] == CHECKPOINT_CONTINUED
+    assert store.latest_partial('source') is None
+
+
+def test_fallback_searches_from_the_beginning():
+    harvester = _harvester()
+    budget = GatherBudget(requests=2, resume_position={'search': 1,
+                                                       'offset': 1})
+    budget.checkpoint({'search': 1, 'offset': 11})
+
+    # The full search that replaces a failed search for changes does not
+    # continue from where the failed one was
+    budget.start_over()
+    assert budget.position is None
+    guids, reason = _gather(harvester, budget)
+    assert guids == ['a1']
+    assert reason == 'used its 2 requests'
+    assert harvester.requests == [('a', '1'), ('a', '11')]
+
+    # A job that completes the searches it started itself needs no
+    # checkpoint
+    store = MemoryCheckpointStore()
+    job = _Job('job', datetime.datetime(2017, 3, 1, 12))
+    harvester._complete_checkpoint(job, None, store, job.gather_started,
+                                   MODE_EVERYTHING, None)
+    assert store.get('job') is None
@@ -0,0 +1,87 @@
+"""Tests for harvesters/delta.py."""
+from ckanext.sintef.harvesters.delta import diff_package
+
+
+def _stored():
+    return {
+        'id': 'pkg',
+        'title': u'Roads',
+        'notes': u'All roads',
+        'tags': [{'name': u'roads'}],
+        'extras': [{'key': 'metadata_provenance', 'value': 'old'}],
+        'resources': [
+            {'id': 'r1', 'url': u'http://a/1', 'name': u'One',
+             'format': u'CSV'},
+            {'id': 'r2', 'url': u'http://a/2', 'name': u'Two',
+             'format': u'WMS'},
+        ],
+    }
+
+
+def _harvested():
+    return {
+        'title': 'Roads',
+        'notes': 'All roads',
+        'tags': [{'name': 'roads'}],
+        'extras': [{'key': 'metadata_provenance', 'value': 'new'}],
+        'resources': [
+            {'url': 'http://a/1', 'name': 'One', 'format': 'CSV'},
+            {'url': 'http://a/2', 'name': 'Two', 'format': 'WMS'},
+        ],
+    }
+
+
+def test_unchanged_package():
+    delta = diff_package(_harvested(), _stored())
+    assert not delta.changed
+    assert delta.fields == {}
+
+
+def test_changed_field():
+    new = _harvested()
+    new['title'] = 'Roads and paths'
+    delta = diff_package(new, _stored())
+
+    assert delta.changed
+    assert not delta.resources_changed
+    assert delta.fields['title'] == 'Roads and paths'
+    # The volatile extras are written along with it
+    assert delta.fields['extras'] == new['extras']
+
+
+def test_added_resource():
+    new = _harvested()
+    new['resources'].append({'url': 'http://a/3', 'name': 'Three'})
+    delta = diff_package(new, _stored())
+
+    assert delta.resources_changed
+    assert [resource.get('id') for resource in delta.resources] == \
+        ['r1', 'r2', None]
+
+
+def test_removed_resource():
+    new = _harvested()
+    del new['resources'][0]
+    delta = diff_package(new, _stored())
+
+    assert delta.resources_changed
+    assert [resource['id'] for resource in delta.resources] == ['r2']
+
+
+def test_changed_resource():
+    new = _harvested()
+    new['resources'][1]['format'] = 'WFS'
+    delta = diff_package(new, _stored())
+
+    assert delta.resources_changed
+    assert delta.resources[1] == {'id': 'r2', 'url': 'http://a/2',
+                                  'name': 'Two', 'format': 'WFS'}
+
+
+def test_reordered_resources():
+    new = _harvested()
+    new['resources'].reverse()
+    delta = diff_package(new, _stored())
+
+    assert delta.resources_changed
+    assert [resource['id'] for resource in delta.resources] == ['r2', 'r1']
@@ -0,0 +1,81 @@
+"""Tests for harvesters/enrichment.py."""
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from ckanext.sintef.harvesters.enrichment import (find_logo_url,
+                                                  fetch_logo_url,
+                                                  LogoEnrichmentQueue,
+                                                  LOGO_FETCH_CHUNK_SIZE)
+
+
+PAGE_START = ('<html><head><title>Dataset</title></head><body>'
+              '<div class="header logo"><a href="/"><img alt="Logo" '
+              'src="/images/logo.png"></a></div>')
+
+
+class _StallingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Sends the first chunk of a page late, and then nothing for a long
+    time.'''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', '1000000')
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(0.8)
+        self.wfile.write(PAGE_START.ljust(LOGO_FETCH_CHUNK_SIZE))
+        self.wfile.flush()
+        time.sleep(3)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def test_find_logo_url():
+    assert find_logo_url(PAGE_START, 'http://data.norge.no/data/x') == \
+        'http://data.norge.no/images/logo.png'
+    assert find_logo_url('<div class="logos-and-more"><img src="a.png">'
+                         '</div>') is None
+    assert find_logo_url('<div class="logo"></div><img src="a.png">') is None
+
+
+def test_fetch_ends_at_the_deadline():
+    server = _Server(('127.0.0.1', 0), _StallingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        started = time.time()
+        logo_url = fetch_logo_url('http://127.0.0.1:%s/dataset' %
+                                  server.server_address[1], timeout=1)
+        # The second read only waits until the deadline
+        assert time.time() - started < 1.5
+        # What was read before the deadline is still looked at
+        assert logo_url == 'http://127.0.0.1:%s/images/logo.png' % \
+            server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_queue_looks_up_each_organization_once():
+    looked_up = []
+
+    class RecordingQueue(LogoEnrichmentQueue):
+        def _enrich(self, organization_name, page_url, user_name):
+            looked_up.append(organization_name)
+
+    queue = RecordingQueue()
+    assert queue.enqueue('org-a', 'http://a/1', 'harvest')
+    assert not queue.enqueue('org-a', 'http://a/2', 'harvest')
+    assert queue.enqueue('org-b', 'http://b/1', 'harvest')
+    assert not queue.enqueue('org-c', None, 'harvest')
+    queue.join()
+    assert looked_up == ['org-a', 'org-b']
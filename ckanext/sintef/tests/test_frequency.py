@@ -0,0 +1,85 @@
+"""Tests for harvesters/frequency.py."""
+import datetime
+
+from ckanext.sintef.harvesters.frequency import (harvest_frequency,
+                                                 recommend_interval,
+                                                 schedule_next_run)
+
+
+def _job(interval_hours, changed, objects=10, lag_hours=None):
+    return {'job_id': 'job', 'interval_hours': interval_hours,
+            'objects': objects, 'changed': changed,
+            'newest_change_lag_hours': lag_hours}
+
+
+class _Source(object):
+    '''A harvest source that remembers if it was saved.'''
+    id = 'source'
+    frequency = u'MANUAL'
+    next_run = None
+    saved = False
+
+    def save(self):
+        self.saved = True
+
+
+def test_harvest_frequency():
+    assert harvest_frequency(1000) == u'MONTHLY'
+    assert harvest_frequency(720) == u'MONTHLY'
+    assert harvest_frequency(200) == u'WEEKLY'
+    assert harvest_frequency(24) == u'DAILY'
+    # A source is never harvested again as soon as its last job ends
+    assert harvest_frequency(2) == u'DAILY'
+    assert harvest_frequency(0) == u'DAILY'
+
+
+def test_recommend_interval():
+    # The oldest job only tells when the first interval started
+    changes = [_job(None, 5), _job(12, 2, lag_hours=3), _job(12, 4),
+               _job(24, 0)]
+    recommendation = recommend_interval(changes, 1, 720, 3)
+    assert recommendation['jobs'] == 3
+    assert recommendation['changed'] == 6
+    assert recommendation['changes_per_hour'] == 0.125
+    assert recommendation['change_fraction'] == 0.2
+    assert recommendation['empty_jobs'] == 1
+    assert recommendation['max_newest_change_lag_hours'] == 3
+    assert recommendation['interval_hours'] == 24
+    assert recommendation['frequency'] == u'DAILY'
+
+
+def test_recommend_interval_bounds():
+    # Changes faster than the shortest interval
+    recommendation = recommend_interval([_job(1, 60)], 2, 720, 1)
+    assert recommendation['interval_hours'] == 2
+    assert recommendation['frequency'] == u'DAILY'
+    assert recommendation['reason'].endswith('raised to the shortest '
+                                             'interval')
+
+    # No changes at all
+    recommendation = recommend_interval([_job(24, 0), _job(24, 0)], 1, 500,
+                                        1)
+    assert recommendation['interval_hours'] == 500
+    assert recommendation['frequency'] == u'BIWEEKLY'
+
+    recommendation = recommend_interval([_job(None, 3)], 1, 720, 1)
+    assert recommendation['interval_hours'] is None
+    assert recommendation['frequency'] is None
+    assert recommendation['reason'].startswith('Too few finished jobs')
+
+
+def test_short_interval_only_sets_the_next_run():
+    source = _Source()
+    started = datetime.datetime(2017, 3, 1, 12)
+    recommendation = recommend_interval([_job(1, 60)], 2, 720, 1)
+    assert schedule_next_run(source, recommendation, started) == \
+        datetime.datetime(2017, 3, 1, 14)
+    assert source.next_run == datetime.datetime(2017, 3, 1, 14)
+    assert source.frequency == u'DAILY'
+    assert source.saved
+
+    # Nothing is scheduled without a recommendation
+    source = _Source()
+    assert schedule_next_run(source, recommend_interval([], 1, 720, 1),
+                             started) is None
+    assert not source.saved
@@ -0,0 +1,105 @@
+"""Tests for harvesters/health.py."""
+import datetime
+
+from ckanext.sintef.harvesters.health import (RemoteHealth, MemoryHealthStore,
+                                              STATE_CLOSED, STATE_OPEN,
+                                              STATE_HALF_OPEN)
+
+
+REMOTE = 'https://kartkatalog.geonorge.no'
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.time = datetime.datetime(2017, 3, 1, 12)
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += datetime.timedelta(seconds=seconds)
+
+
+def _health(store, clock):
+    return RemoteHealth(store, failure_threshold=3, cooldown=1800,
+                        full_fallback_interval=6 * 3600, now=clock)
+
+
+def test_breaker_opens_and_closes_again():
+    store = MemoryHealthStore()
+    clock = Clock()
+    health = _health(store, clock)
+
+    health.record_failure(REMOTE, 'timed out')
+    health.record_failure(REMOTE, 'timed out')
+    assert store.get(REMOTE)['state'] == STATE_CLOSED
+    assert health.allow_request(REMOTE) == (True, None)
+
+    health.record_failure(REMOTE, 'timed out')
+    assert store.get(REMOTE)['state'] == STATE_OPEN
+    allowed, reason = health.allow_request(REMOTE)
+    assert not allowed
+    assert 'failed 3 times in a row' in reason
+
+    # After the cooldown, one job tries the remote again
+    clock.advance(1800)
+    assert health.allow_request(REMOTE) == (True, None)
+    assert store.get(REMOTE)['state'] == STATE_HALF_OPEN
+
+    # A failure opens the breaker again at once
+    health.record_failure(REMOTE, 'timed out')
+    assert store.get(REMOTE)['state'] == STATE_OPEN
+    assert store.get(REMOTE)['opened'] == clock.time
+
+    clock.advance(1800)
+    assert health.allow_request(REMOTE) == (True, None)
+    health.record_success(REMOTE)
+    state = store.get(REMOTE)
+    assert state['state'] == STATE_CLOSED
+    assert state['failures'] == 0
+    assert state['decision'] == 'remote is healthy again'
+
+
+def test_failures_recorded_at_the_same_time_all_count():
+    store = MemoryHealthStore()
+    clock = Clock()
+    # Two gather consumers, each with its own tracker
+    first = _health(store, clock)
+    second = _health(store, clock)
+
+    first.record_failure(REMOTE, 'timed out')
+    second.record_failure(REMOTE, 'timed out')
+    first.record_failure(REMOTE, 'timed out')
+
+    state = store.get(REMOTE)
+    assert state['failures'] == 3
+    assert state['state'] == STATE_OPEN
+
+
+def test_one_full_fallback_per_interval():
+    store = MemoryHealthStore()
+    clock = Clock()
+    health = _health(store, clock)
+
+    health.record_failure(REMOTE, 'incremental search failed')
+    assert health.allow_full_fallback(REMOTE) == (True, None)
+
+    clock.advance(3600)
+    allowed, reason = health.allow_full_fallback(REMOTE)
+    assert not allowed
+    assert 'one was already made' in reason
+
+    clock.advance(5 * 3600)
+    assert health.allow_full_fallback(REMOTE) == (True, None)
+
+
+def test_no_full_fallback_while_unhealthy():
+    store = MemoryHealthStore()
+    health = _health(store, Clock())
+    for i in range(3):
+        health.record_failure(REMOTE, 'timed out')
+
+    allowed, reason = health.allow_full_fallback(REMOTE)
+    assert not allowed
+    assert 'the remote is unhealthy after 3 failures' in reason
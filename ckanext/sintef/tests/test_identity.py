@@ -0,0 +1,57 @@
+"""Tests for harvesters/identity.py."""
+from ckanext.sintef.harvesters.identity import (normalize_identifiers,
+                                                dataset_identifiers,
+                                                IdentityIndex,
+                                                MemoryIdentityStore)
+
+
+UUID = u'a0b1c2d3-e4f5-4a6b-8c7d-9e0f1a2b3c4d'
+
+
+def test_normalize_identifiers():
+    assert normalize_identifiers(UUID.upper()) == [u'uuid:' + UUID]
+    assert normalize_identifiers(
+        u'https://www.Kartkatalog.geonorge.no/metadata/%s/' % UUID) == \
+        [u'uuid:' + UUID,
+         u'url:kartkatalog.geonorge.no/metadata/' + UUID]
+    assert normalize_identifiers(u'http://data.norge.no/node/123') == \
+        [u'url:data.norge.no/node/123']
+    assert normalize_identifiers(u' 12345 ') == [u'id:12345']
+    assert normalize_identifiers(u'') == []
+    assert normalize_identifiers(None) == []
+    assert normalize_identifiers(12345) == []
+
+
+def test_dataset_identifiers():
+    assert dataset_identifiers([
+        UUID,
+        [u'http://kartkatalog.geonorge.no/metadata/%s' % UUID,
+         u'https://www.kartkatalog.geonorge.no/metadata/%s/' % UUID],
+        None,
+        u'12345',
+    ]) == [u'uuid:' + UUID,
+           u'url:kartkatalog.geonorge.no/metadata/' + UUID,
+           u'id:12345']
+
+
+def test_claim():
+    index = IdentityIndex(MemoryIdentityStore())
+    identifiers = [u'uuid:' + UUID, u'url:data.norge.no/node/123']
+    assert index.claim(identifiers, 'package1', 'geonorge') is None
+    assert index.claim(identifiers, 'package1', 'geonorge') is None
+
+    # Another source finds the dataset claimed
+    claim = index.claim([u'url:data.norge.no/node/123'], 'package2',
+                        'datanorge', lambda package_id: True)
+    assert claim == {'identifier': u'url:data.norge.no/node/123',
+                     'package_id': 'package1', 'source_id': 'geonorge'}
+
+    # The claims of a package that was deleted are taken over
+    assert index.claim(identifiers, 'package2', 'datanorge',
+                       lambda package_id: package_id != 'package1') is None
+    assert index.lookup(identifiers)['package_id'] == 'package2'
+    assert index.lookup(identifiers)['source_id'] == 'datanorge'
+    assert index.lookup([u'id:other']) is None
+
+    index.store.forget('package2')
+    assert index.lookup(identifiers) is None
@@ -0,0 +1,42 @@
+"""Tests for harvesters/jsonstream.py."""
+from ckanext.sintef.harvesters.jsonstream import (RawArraySplitter,
+                                                  iter_raw_items)
+
+
+DOCUMENT = ('{"count": 3, "title": "Datasets [all]", "datasets": ['
+            '{"id": "1", "title": "A \\"quoted\\" name, with [brackets]"}, '
+            '{"id": "2", "keyword": ["a", "b}"], "publisher": {"name": "X"}}'
+            ', {"id": "3", "title": "Escaped \\\\"}], "next": null}')
+
+ITEMS = ['{"id": "1", "title": "A \\"quoted\\" name, with [brackets]"}',
+         '{"id": "2", "keyword": ["a", "b}"], "publisher": {"name": "X"}}',
+         '{"id": "3", "title": "Escaped \\\\"}']
+
+
+def _feed_in_chunks(document, key, size):
+    splitter = RawArraySplitter(key)
+    items = []
+    for start in range(0, len(document), size):
+        items.extend(splitter.feed(document[start:start + size]))
+    splitter.close()
+    return items
+
+
+def test_items_of_a_document_in_memory():
+    assert list(iter_raw_items(DOCUMENT, 'datasets')) == ITEMS
+    assert list(iter_raw_items('[%s]' % ', '.join(ITEMS))) == ITEMS
+
+
+def test_chunks_may_end_anywhere():
+    # Every chunk size splits strings, escapes and keys at some point
+    for size in range(1, len(DOCUMENT) + 1):
+        assert _feed_in_chunks(DOCUMENT, 'datasets', size) == ITEMS, size
+
+
+def test_document_ending_in_the_array_is_an_error():
+    try:
+        _feed_in_chunks(DOCUMENT[:60], 'datasets', 7)
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
@@ -0,0 +1,99 @@
+"""Tests for harvesters/listing.py."""
+import time
+import shutil
+import datetime
+import tempfile
+
+from ckanext.sintef.harvesters import listing as listing_module
+from ckanext.sintef.harvesters.listing import SharedListing
+from ckanext.sintef.harvesters.records import GatherRecord
+from ckanext.sintef.harvesters.budget import (MemoryCheckpointStore,
+                                              MODE_MODIFIED)
+from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+
+
+RECORDS = [GatherRecord('1', 'One', '{"Uuid": "1", "Type": "dataset"}'),
+           GatherRecord('2', 'Two', '{"Uuid": "2", "Type": "service"}')]
+
+
+class Clock(object):
+    '''Stands in for the time module, with a time that only moves when it
+    is told to.'''
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class _Job(object):
+    id = 'job'
+    source_id = 'source'
+
+    def __init__(self, gather_started):
+        self.gather_started = gather_started
+
+
+def test_search_tells_when_the_listing_was_fetched():
+    listing_dir = tempfile.mkdtemp()
+    try:
+        before = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        listing = SharedListing('http://geonorge', listing_dir=listing_dir,
+                                window=3600)
+        records = listing.search(lambda: RECORDS, [{'type': 'dataset'}])
+        assert [record.guid for record in records] == ['1']
+        assert before < listing.fetched < datetime.datetime.utcnow()
+
+        # A later search of the same listing was fetched at the same time
+        time.sleep(0.01)
+        later = SharedListing('http://geonorge', listing_dir=listing_dir,
+                              window=3600)
+        later.search(lambda: [], [{'type': 'service'}])
+        assert later.fetched == listing.fetched
+    finally:
+        shutil.rmtree(listing_dir)
+
+
+def test_listing_counts_as_fetched_when_the_fetch_started():
+    listing_dir = tempfile.mkdtemp()
+    clock = Clock(1488369600)
+    original_time = listing_module.time
+    listing_module.time = clock
+
+    def fetch():
+        # Fetching the listing takes half an hour
+        for record in RECORDS:
+            clock.now += 900
+            yield record
+
+    try:
+        listing = SharedListing('http://geonorge', listing_dir=listing_dir,
+                                window=3600)
+        listing.search(fetch, [{'type': 'dataset'}])
+        assert listing.fetched == datetime.datetime(2017, 3, 1, 12)
+    finally:
+        listing_module.time = original_time
+        shutil.rmtree(listing_dir)
+
+
+def test_next_job_searches_from_when_the_listing_was_fetched():
+    harvester = GeonorgeHarvester()
+    harvester._set_config('{}', 'source')
+    job = _Job(datetime.datetime(2017, 3, 1, 12))
+    store = MemoryCheckpointStore()
+
+    # Without a listing, the job started the searches itself
+    harvester._complete_checkpoint(job, None, store, job.gather_started,
+                                   MODE_MODIFIED, '2017-02-28T11:00:00')
+    assert store.get('job') is None
+
+    # The listing was fetched two hours before the job started, longer ago
+    # than the overlap of the next search for changes
+    harvester.gather_listed = datetime.datetime(2017, 3, 1, 10)
+    harvester._complete_checkpoint(
+        job, None, store, harvester._searched_from(job.gather_started),
+        MODE_MODIFIED, '2017-02-28T11:00:00')
+    assert store.get('job')['state'] == 'complete'
+    assert store.get('job')['chain_started'] == \
+        datetime.datetime(2017, 3, 1, 10)
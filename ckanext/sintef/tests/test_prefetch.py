@@ -0,0 +1,202 @@
+"""Tests for harvesters/prefetch.py."""
+import time
+import datetime
+import threading
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.base import ContentFetchError
+from ckanext.sintef.harvesters.prefetch import (Prefetcher, DocumentCache,
+                                                MemoryPrefetchStore,
+                                                get_prefetcher, has_document,
+                                                DOCUMENT_KEY)
+from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+
+
+BASE_URL = 'http://kartkatalog.geonorge.no'
+
+
+class _Source(object):
+    id = 'source'
+    url = BASE_URL + '/'
+    config = '{"full_metadata": true}'
+
+
+class _Job(object):
+    source_id = 'source'
+    source = _Source()
+
+    def __init__(self, job_id):
+        self.id = job_id
+
+
+class _Object(object):
+    '''Stands in for a HarvestObject.'''
+
+    def __init__(self, job, name):
+        self.id = name
+        self.guid = 'uuid-' + name
+        self.job = job
+        self.harvest_job_id = job.id
+        self.source = job.source
+        self.state = u'WAITING'
+        self.content = json.dumps({'Uuid': self.guid})
+        self.fetch_finished = None
+        self.saved = False
+
+    def save(self):
+        self.saved = True
+
+
+class DocumentHarvester(GeonorgeHarvester):
+    '''Answers the getdata requests, failing the first request of the GUIDs
+    in 'failing', and keeps its prefetch queue in memory.'''
+
+    def __init__(self, store, failing=()):
+        self.store = store
+        self.failing = set(failing)
+        self.requested = []
+
+    def _get_content(self, url):
+        guid = url.rsplit('/', 1)[1]
+        self.requested.append(guid)
+        if guid in self.failing:
+            self.failing.discard(guid)
+            raise ContentFetchError('Remote is down')
+        return json.dumps({'Uuid': guid,
+                           'DateMetadataUpdated': '2017-03-01T12:00:00'})
+
+    def _get_prefetch_store(self):
+        return self.store
+
+
+def _objects(job_id, names):
+    job = _Job(job_id)
+    return [_Object(job, name) for name in names]
+
+
+def _harvester(objects, import_order, failing=()):
+    store = MemoryPrefetchStore(objects)
+    store.add('source', objects[0].harvest_job_id, import_order)
+    harvester = DocumentHarvester(store, failing)
+    harvester._set_config(_Source.config, 'source')
+    return harvester
+
+
+def test_requests_never_exceed_the_window():
+    lock = threading.Lock()
+    counts = {'running': 0, 'most': 0}
+    release = threading.Event()
+
+    def fetch(url):
+        with lock:
+            counts['running'] += 1
+            counts['most'] = max(counts['most'], counts['running'])
+        release.wait(5)
+        with lock:
+            counts['running'] -= 1
+        return '{}'
+
+    prefetcher = Prefetcher(fetch, window=3, cache=DocumentCache())
+    for index in range(10):
+        prefetcher.request(index, 'http://remote/%s' % index)
+    assert prefetcher.free == -7
+    time.sleep(0.1)
+    assert counts['running'] == 3
+
+    release.set()
+    prefetcher.join()
+    assert len(prefetcher.completed()) == 10
+    assert counts['most'] == 3
+    assert prefetcher.free == 3
+    prefetcher.close()
+
+
+def test_prefetched_document_is_read_from_the_cache():
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return '{"Uuid": "a"}'
+
+    cache = DocumentCache()
+    first = Prefetcher(fetch, window=2, cache=cache)
+    assert first.request('object-a', 'http://remote/a')
+    assert not first.request('object-a', 'http://remote/a')
+    first.join()
+    assert first.completed() == [('object-a', '{"Uuid": "a"}', None)]
+    first.close()
+
+    # Another job of the process needs the same document
+    second = Prefetcher(fetch, window=2, cache=cache)
+    assert second.get('http://remote/a') == '{"Uuid": "a"}'
+    second.request('object-b', 'http://remote/a')
+    assert second.completed() == [('object-b', '{"Uuid": "a"}', None)]
+    assert fetched == ['http://remote/a']
+    second.close()
+
+
+def test_documents_are_prefetched_in_import_order():
+    objects = _objects('prefetch-job', ['own', 'a', 'b', 'c', 'd'])
+    own = objects[0]
+    own.state = u'FETCH'
+    harvester = _harvester(objects, ['own', 'd', 'b', 'c', 'a'])
+    prefetcher = Prefetcher(harvester._fetch_document, window=2,
+                            cache=DocumentCache())
+
+    harvester._prefetch(prefetcher, own, BASE_URL)
+    # The window is full until the documents are collected
+    assert prefetcher.free == 0
+    prefetcher.join()
+    assert sorted(harvester.requested) == ['uuid-b', 'uuid-d']
+
+    # The documents are written into the objects that are waiting
+    objects[3].state = u'FETCH'
+    objects[4].state = u'FETCH'
+    harvester._prefetch(prefetcher, own, BASE_URL)
+    prefetcher.join()
+    content = json.loads(objects[2].content)
+    assert content[DOCUMENT_KEY]['Uuid'] == 'uuid-b'
+    assert objects[2].fetch_finished is not None
+    assert objects[2].metadata_modified_date == \
+        datetime.datetime(2017, 3, 1, 12)
+    assert not has_document(objects[4].content)
+    assert objects[4].fetch_finished is None
+    assert not has_document(own.content)
+
+    # The next objects are claimed, skipping those taken by a consumer
+    assert sorted(harvester.requested) == ['uuid-a', 'uuid-b', 'uuid-d']
+
+    # Another process finds every object claimed
+    other = Prefetcher(harvester._fetch_document, window=2,
+                       cache=DocumentCache())
+    harvester._prefetch(other, own, BASE_URL)
+    assert other.free == 2
+    other.close()
+    prefetcher.close()
+
+
+def test_failed_prefetch_is_requested_again_in_the_fetch_stage():
+    objects = _objects('failing-job', ['own', 'a', 'b'])
+    own, failed, prefetched = objects
+    own.state = u'FETCH'
+    harvester = _harvester(objects, ['own', 'a', 'b'], failing=['uuid-a'])
+
+    assert harvester.fetch_stage(own) is True
+    assert has_document(own.content)
+    assert own.saved
+    prefetcher = get_prefetcher('failing-job', None)
+    prefetcher.join()
+
+    # The next fetch stage writes what was prefetched
+    prefetched.state = u'FETCH'
+    assert harvester.fetch_stage(prefetched) is True
+    assert failed.fetch_finished is not None
+    assert not has_document(failed.content)
+
+    failed.state = u'FETCH'
+    assert harvester.fetch_stage(failed) is True
+    assert has_document(failed.content)
+    assert sorted(harvester.requested) == ['uuid-a', 'uuid-a', 'uuid-b',
+                                           'uuid-own']
+    prefetcher.close()
@@ -0,0 +1,36 @@
+"""Tests for harvesters/profiling.py."""
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+
+from ckanext.sintef.harvesters.profiling import StageProfile
+
+
+def _import_in_worker(n):
+    return sum(range(n))
+
+
+def _import_in_main_thread(n):
+    return sum(range(n))
+
+
+def test_each_thread_is_profiled():
+    job_dir = tempfile.mkdtemp()
+    try:
+        profile = StageProfile(job_dir, 'import')
+        worker = threading.Thread(target=profile.run,
+                                  args=(_import_in_worker, 1000))
+        worker.start()
+        worker.join()
+        assert profile.run(_import_in_main_thread, 1000) == 499500
+        profile.dump()
+
+        stats = pstats.Stats(os.path.join(job_dir,
+                                          'import-%s.pstats' % os.getpid()))
+        functions = set(name for (filename, line, name) in stats.stats)
+        assert '_import_in_worker' in functions
+        assert '_import_in_main_thread' in functions
+    finally:
+        shutil.rmtree(job_dir)
@@ -0,0 +1,98 @@
+"""Tests for harvesters/progress.py."""
+import datetime
+
+from ckanext.sintef.harvesters.progress import (ProgressTracker,
+                                                MemoryProgressStore,
+                                                LATENCY_BUCKETS,
+                                                percentile, summarize,
+                                                worker_name)
+
+
+def _tracker(flush_every):
+    store = MemoryProgressStore()
+    tracker = ProgressTracker(store_factory=lambda: store,
+                              flush_every=flush_every, flush_seconds=3600)
+    return tracker, store
+
+
+def test_percentile():
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    assert percentile(histogram, 0.5) is None
+    histogram[0] = 9
+    histogram[3] = 1
+    assert percentile(histogram, 0.5) == LATENCY_BUCKETS[0]
+    assert percentile(histogram, 0.99) == LATENCY_BUCKETS[3]
+    histogram[-1] = 90
+    assert percentile(histogram, 0.99) is None
+
+
+def test_tracker_writes_every_few_objects():
+    tracker, store = _tracker(flush_every=2)
+    tracker.record('job1', 'source1', 'import', 0.004)
+    assert store.rows(['job1']) == []
+
+    tracker.record('job1', 'source1', 'import', 0.3, ok=False)
+    rows = store.rows(['job1'])
+    assert len(rows) == 1
+    assert rows[0]['count'] == 1
+    assert rows[0]['errors'] == 1
+    assert rows[0]['worker'] == worker_name()
+    assert sum(rows[0]['histogram']) == 2
+
+    # A total is written right away
+    tracker.set_total('job1', 'source1', 10)
+    rows = store.rows(['job1'])
+    assert [row['stage'] for row in rows] == ['gather', 'import']
+    assert rows[0]['total'] == 10
+    assert store.rows(['job2']) == []
+
+
+def test_tracker_writes_again_after_a_failed_write():
+    written = []
+
+    class FailingStore(MemoryProgressStore):
+        '''Fails the first write.'''
+
+        def put(self, rows, worker):
+            written.append(len(rows))
+            if len(written) == 1:
+                raise IOError('Database is gone')
+            MemoryProgressStore.put(self, rows, worker)
+
+    store = FailingStore()
+    tracker = ProgressTracker(store_factory=lambda: store, flush_every=1,
+                              flush_seconds=3600)
+    tracker.record('job1', 'source1', 'import', 0.01)
+    assert store.rows(['job1']) == []
+    tracker.flush()
+    assert written == [1, 1]
+    assert store.rows(['job1'])[0]['count'] == 1
+
+
+def test_summarize_adds_up_workers():
+    started = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    store = MemoryProgressStore()
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    histogram[2] = 5
+    for worker in ('host:1', 'host:2'):
+        store.put([{'job_id': 'job1', 'source_id': 'source1',
+                    'stage': 'import', 'count': 5, 'errors': 0,
+                    'total': None, 'histogram': list(histogram),
+                    'started': started,
+                    'updated': started + datetime.timedelta(seconds=10)}],
+                  worker)
+    store.put([{'job_id': 'job1', 'source_id': 'source1', 'stage': 'gather',
+                'count': 0, 'errors': 0, 'total': 30,
+                'histogram': [0] * len(histogram), 'started': started,
+                'updated': started}], 'host:1')
+
+    summary = summarize('job1', store.rows(['job1']),
+                        now=started + datetime.timedelta(seconds=10))
+    imported = summary['stages']['import']
+    assert imported['count'] == 10
+    assert imported['workers'] == 2
+    assert imported['rate'] == 1.0
+    assert imported['p50'] == LATENCY_BUCKETS[2]
+    assert summary['total'] == 30
+    assert summary['remaining'] == 20
+    assert summary['eta'] == '2024-01-01T12:00:30'
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""Tests for harvesters/records.py."""
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.jsonstream import iter_raw_items
+from ckanext.sintef.harvesters.records import GatherRecord
+
+
+PAGE = '{"Results": [{"Uuid": "1", "Title": "Vegnett i Tr\xc3\xb8ndelag"},' \
+       ' {"Uuid": "2", "Title": "\\u00c5ser"}]}'
+
+
+def test_raw_json_of_the_response_is_kept():
+    pkg_dicts = json.loads(PAGE)['Results']
+    records = [GatherRecord.from_raw(raw, pkg_dict, 'Uuid', 'Title')
+               for pkg_dict, raw in zip(pkg_dicts,
+                                        iter_raw_items(PAGE, 'Results'))]
+
+    assert [record.guid for record in records] == ['1', '2']
+    assert records[0].raw == \
+        '{"Uuid": "1", "Title": "Vegnett i Tr\xc3\xb8ndelag"}'
+    assert records[1].raw == '{"Uuid": "2", "Title": "\\u00c5ser"}'
+    assert records[0].content == \
+        u'{"Uuid": "1", "Title": "Vegnett i Tr\xf8ndelag"}'
+    assert records[0].as_dict() == pkg_dicts[0]
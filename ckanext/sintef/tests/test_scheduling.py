@@ -0,0 +1,72 @@
+"""Tests for harvesters/scheduling.py."""
+import datetime
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+from ckanext.sintef.harvesters.scheduling import ImportScheduler
+
+
+def _result(uuid, modified=None):
+    result = {'Uuid': uuid, 'Title': uuid.title(),
+              'Organization': 'Kartverket'}
+    if modified is not None:
+        result['DateMetadataUpdated'] = modified
+    return result
+
+
+PAGES = [
+    json.dumps({'NumFound': 5, 'Results': [
+        _result('unchanged', '2017-03-01T10:00:00'),
+        _result('undated'),
+        _result('changed', '2017-05-01T10:00:00'),
+        _result('new', '2017-04-01T10:00:00'),
+        _result('changed-later', '2017-06-01T10:00:00'),
+    ]}),
+    json.dumps({'NumFound': 5, 'Results': []}),
+]
+
+KNOWN = {
+    'unchanged': datetime.datetime(2017, 3, 1, 10),
+    'undated': datetime.datetime(2016, 5, 1),
+    'changed': datetime.datetime(2017, 1, 1),
+    'changed-later': datetime.datetime(2017, 1, 1),
+}
+
+
+class PagedGeonorgeHarvester(GeonorgeHarvester):
+    '''Returns the pages of a search, one per request.'''
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+
+    def _get_content(self, url):
+        return self.pages.pop(0)
+
+
+def _search():
+    harvester = PagedGeonorgeHarvester(PAGES)
+    harvester._set_config('{}', 'source')
+    return list(harvester._iter_search('http://kartkatalog.geonorge.no', {}))
+
+
+def test_full_refresh_imports_new_and_changed_datasets_first():
+    records = _search()
+
+    scheduler = ImportScheduler('source', KNOWN)
+    for record in records:
+        scheduler.add(record.guid, record, scheduler.modified(record))
+
+    assert scheduler.ordered_ids() == ['new', 'changed-later', 'changed',
+                                       'unchanged', 'undated']
+    assert scheduler.counts() == {'new': 1, 'changed': 2, 'revalidate': 2}
+
+
+def test_dataset_without_date_keeps_the_stored_date():
+    records = dict((record.guid, record) for record in _search())
+
+    scheduler = ImportScheduler('source', KNOWN)
+    assert scheduler.modified(records['undated']) == \
+        datetime.datetime(2016, 5, 1)
+    assert scheduler.modified(records['changed']) == \
+        datetime.datetime(2017, 5, 1, 10)
@@ -0,0 +1,190 @@
+"""Tests for harvesters/sharding.py."""
+import time
+import threading
+import Queue
+
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.sharding import (ShardedGather, ShardError,
+                                                MemoryShardStore,
+                                                consume_shards)
+
+
+class InProcessQueue(object):
+    '''Stands in for the shard queue.'''
+
+    def __init__(self):
+        self.messages = Queue.Queue()
+
+    def send(self, message):
+        self.messages.put(message)
+
+
+RESULTS = {
+    'a': [{'Uuid': '1', 'Title': 'One'}, {'Uuid': '2', 'Title': 'Two'}],
+    'b': [{'Uuid': '2', 'Title': 'Two'}, {'Uuid': '3', 'Title': 'Three'}],
+    'c': [{'Uuid': '4', 'Title': 'Four'}],
+}
+SHARDS = [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]
+
+
+def _search(shard, delay=0):
+    time.sleep(delay)
+    if shard['name'] == 'broken':
+        raise ValueError('Remote is down')
+    return RESULTS[shard['name']]
+
+
+def _uuids(records):
+    return [record['Uuid'] for record in records]
+
+
+def test_coordinator_without_helpers():
+    queue = InProcessQueue()
+    gather = ShardedGather(MemoryShardStore(), queue, _search)
+
+    records = gather.coordinate('source', 'job', SHARDS, helpers=2)
+
+    assert _uuids(records) == ['1', '2', '3', '4']
+    assert queue.messages.qsize() == 2
+
+
+def test_helpers_run_shards_of_the_same_job():
+    store = MemoryShardStore()
+    queue = InProcessQueue()
+    shards_run = []
+
+    def search(shard):
+        shards_run.append(shard['name'])
+        return _search(shard, delay=0.05)
+
+    def helper():
+        message = queue.messages.get(timeout=5)
+        gather = ShardedGather(store, queue, search)
+        assert gather.is_helper(message['harvest_job_id'])
+        gather.work(message['harvest_job_id'])
+
+    coordinator = ShardedGather(store, queue, search, poll_interval=0.01)
+    helpers = [threading.Thread(target=helper) for i in range(2)]
+    for thread in helpers:
+        thread.start()
+    records = coordinator.coordinate('source', 'job', SHARDS, helpers=2)
+    for thread in helpers:
+        thread.join()
+
+    assert _uuids(records) == ['1', '2', '3', '4']
+    assert sorted(shards_run) == ['a', 'b', 'c']
+
+
+def test_late_helper_finds_no_shards():
+    store = MemoryShardStore()
+    queue = InProcessQueue()
+    ShardedGather(store, queue, _search).coordinate('source', 'job', SHARDS,
+                                                    helpers=2)
+
+    helper = ShardedGather(store, queue, _search)
+    assert helper.is_helper('job')
+    assert helper.work('job') == 0
+
+
+def test_failing_shard_fails_the_merge():
+    gather = ShardedGather(MemoryShardStore(), InProcessQueue(), _search)
+    try:
+        gather.coordinate('source', 'job', SHARDS + [{'name': 'broken'}], 0)
+    except ShardError, e:
+        assert 'Remote is down' in str(e)
+    else:
+        assert False, 'ShardError was not raised'
+
+
+def test_coordinator_takes_over_stale_shards():
+    store = MemoryShardStore()
+    gather = ShardedGather(store, InProcessQueue(), _search,
+                           poll_interval=0.01, shard_timeout=0)
+    store.create('source', 'job', SHARDS)
+    # A helper claims a shard and dies before finishing it
+    store.claim('job')
+
+    gather.work('job')
+    gather._wait('job')
+
+    assert _uuids(gather._merge('job')) == ['1', '2', '3', '4']
+
+
+def test_result_of_a_shard_taken_over_is_dropped():
+    store = MemoryShardStore()
+    gather = ShardedGather(store, InProcessQueue(), _search,
+                           poll_interval=0.01, shard_timeout=0)
+    store.create('source', 'job', SHARDS)
+    # A helper claims a shard and is slow to finish it
+    index, spec, token = store.claim('job')
+    time.sleep(0.01)
+
+    gather.work('job', reclaim_stale=True)
+    assert store.states('job') == {0: 'done', 1: 'done', 2: 'done'}
+
+    # The helper can not overwrite the result of the coordinator
+    assert not store.fail('job', index, token, 'Remote is down')
+    assert store.states('job')[index] == 'done'
+
+    records = gather._merge('job')
+    assert _uuids(records) == ['1', '2', '3', '4']
+
+    # Nor bring back a shard that has been merged
+    assert not store.complete('job', index, token, RESULTS['a'])
+    assert store.states('job')[index] == 'merged'
+
+
+def test_new_job_replaces_shards_of_the_same_source():
+    store = MemoryShardStore()
+    store.create('source', 'old-job', SHARDS)
+    store.create('source', 'new-job', SHARDS)
+
+    assert not store.has_shards('old-job')
+    assert store.has_shards('new-job')
+
+
+class _Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class InProcessConsumer(object):
+    '''Stands in for a consumer of the shard queue.'''
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.acked = []
+
+    def consume(self, queue):
+        for index, body in enumerate(self.bodies):
+            yield _Method(index), None, body
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+def test_shard_consumer_runs_helpers():
+    store = MemoryShardStore()
+    queue = InProcessQueue()
+    ShardedGather(store, queue, _search).coordinate('source', 'job', SHARDS,
+                                                    helpers=1)
+    store.create('source', 'other-job', SHARDS)
+    helper_jobs = []
+
+    def run_helper(job_id):
+        helper_jobs.append(job_id)
+        if job_id == 'failing-job':
+            raise ValueError('Remote is down')
+        return ShardedGather(store, queue, _search).work(job_id)
+
+    bodies = [json.dumps(queue.messages.get()), 'not json']
+    bodies += [json.dumps({'harvest_job_id': job_id})
+               for job_id in ('failing-job', 'other-job')]
+    consumer = InProcessConsumer(bodies)
+    consume_shards(run_helper, consumer)
+
+    # Every message is acknowledged, also the ones that fail
+    assert consumer.acked == [0, 1, 2, 3]
+    assert helper_jobs == ['job', 'failing-job', 'other-job']
+    assert store.states('other-job') == {0: 'done', 1: 'done', 2: 'done'}
@@ -0,0 +1,63 @@
+"""Tests for harvesters/snapshot.py."""
+import os
+import shutil
+import tempfile
+
+from ckanext.sintef.harvesters import snapshot
+from ckanext.sintef.harvesters.snapshot import (SnapshotReader,
+                                                SnapshotWriter, SnapshotError,
+                                                read_snapshot_records)
+from ckanext.sintef.harvesters.records import GatherRecord
+
+
+class RecordingReader(SnapshotReader):
+    closed = []
+
+    def close(self):
+        RecordingReader.closed.append(self.path)
+        super(RecordingReader, self).close()
+
+
+def _write_snapshot(path, count):
+    writer = SnapshotWriter(path, {'job_id': 'job'})
+    for index in range(count):
+        writer.add(GatherRecord(str(index), 'Dataset %s' % index,
+                                '{"Uuid": "%s"}' % index))
+    writer.close()
+
+
+def test_records_are_read_one_at_a_time():
+    snapshot_dir = tempfile.mkdtemp()
+    snapshot.SnapshotReader = RecordingReader
+    try:
+        path = os.path.join(snapshot_dir, 'job.snapshot')
+        _write_snapshot(path, 3)
+
+        records = read_snapshot_records(path)
+        assert [record.guid for record in records] == ['0', '1', '2']
+        assert RecordingReader.closed == [path]
+
+        # A gather that stops early closes the file too
+        records = read_snapshot_records(path)
+        assert records.next().guid == '0'
+        records.close()
+        assert RecordingReader.closed == [path, path]
+    finally:
+        snapshot.SnapshotReader = SnapshotReader
+        shutil.rmtree(snapshot_dir)
+
+
+def test_file_that_is_not_a_snapshot():
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(snapshot_dir, 'job.snapshot')
+        with open(path, 'wb') as f:
+            f.write('not a snapshot' * 10)
+        try:
+            list(read_snapshot_records(path))
+        except SnapshotError, e:
+            assert 'not a snapshot' in str(e)
+        else:
+            assert False, 'SnapshotError was not raised'
+    finally:
+        shutil.rmtree(snapshot_dir)
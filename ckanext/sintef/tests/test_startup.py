@@ -0,0 +1,22 @@
+"""Tests of what loading the plugins of ckanext-sintef loads."""
+from ckanext.sintef.benchmarks.import_time import (ENTRY_POINTS,
+                                                   import_entry_point,
+                                                   forbidden_modules)
+
+
+def test_entry_points_load_only_their_harvester():
+    for name, target, forbidden in ENTRY_POINTS:
+        seconds, modules = import_entry_point(target)
+        assert forbidden_modules(modules, forbidden) == [], name
+
+
+def test_harvesters_package_loads_harvesters_on_first_use():
+    seconds, modules = import_entry_point(
+        'ckanext.sintef.harvesters:__name__')
+    assert 'ckanext.sintef.harvesters.geonorgeharvester' not in modules
+    assert 'ckanext.sintef.harvesters.datanorgeharvester' not in modules
+
+    seconds, modules = import_entry_point(
+        'ckanext.sintef.harvesters:GeonorgeHarvester')
+    assert 'ckanext.sintef.harvesters.geonorgeharvester' in modules
+    assert 'ckanext.sintef.harvesters.datanorgeharvester' not in modules
@@ -0,0 +1,107 @@
+"""Tests for harvesters/validation.py."""
+from ckan.lib.helpers import json
+
+from ckanext.sintef.harvesters.base import SearchError, MAX_MALFORMED_RESPONSES
+from ckanext.sintef.harvesters.validation import (RecordSchema, Quarantine,
+                                                  MemoryQuarantineStore)
+from ckanext.sintef.harvesters.geonorgeharvester import GeonorgeHarvester
+
+
+SCHEMA = RecordSchema([
+    ('id', basestring, True),
+    ('count', int, False),
+    ('open', bool, False),
+    ('publisher.name', basestring, False),
+    ('distribution[].accessURL', basestring, True),
+])
+
+
+class PagedGeonorgeHarvester(GeonorgeHarvester):
+    '''Returns the pages of a search, one per request.'''
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+
+    def _get_content(self, url):
+        return self.pages.pop(0)
+
+
+def _page(*uuids):
+    return json.dumps({'Results': [{'Uuid': uuid, 'Title': uuid,
+                                    'Organization': 'Kartverket'}
+                                   for uuid in uuids]})
+
+
+def _search(pages):
+    '''
+    Searches the pages with a quarantine, and returns the GUIDs found and
+    the quarantine.
+    '''
+    harvester = PagedGeonorgeHarvester(pages)
+    harvester._set_config('{}', 'source')
+    quarantine = harvester.gather_quarantine = Quarantine(
+        'job', 'source', MemoryQuarantineStore())
+    try:
+        return ([record.guid for record in harvester._iter_search(
+                    'http://kartkatalog.geonorge.no', {})],
+                quarantine)
+    finally:
+        harvester.gather_quarantine = None
+
+
+def test_schema():
+    assert SCHEMA.validate({'id': 'a', 'distribution': []}) == []
+    assert SCHEMA.validate({'id': 'a', 'count': 2, 'open': None,
+                            'publisher': {'name': 'Kartverket'},
+                            'distribution': [{'accessURL': 'http://a'}]}) \
+        == []
+    assert SCHEMA.validate([]) == ['the record is not an object']
+    assert SCHEMA.validate({'count': True, 'open': 1, 'publisher': 'K',
+                            'distribution': [{'accessURL': 1}, 'b']}) == \
+        ['id is missing', 'count is not an integer', 'open is not a boolean',
+         'publisher is not an object',
+         'distribution[] is not an object']
+    assert SCHEMA.validate({'id': 'a', 'distribution': {}}) == \
+        ['distribution is not a list']
+    assert SCHEMA.validate({'id': 'a', 'distribution': [{'accessURL': 1}]}) \
+        == ['distribution[].accessURL is not a string']
+
+
+def test_invalid_records_are_put_in_quarantine():
+    invalid = {'Uuid': 'invalid', 'Organization': 'Kartverket'}
+    page = json.dumps({'Results': [{'Uuid': 'a', 'Title': 'A',
+                                    'Organization': 'Kartverket'},
+                                   invalid]})
+    guids, quarantine = _search([page, _page()])
+    assert guids == ['a']
+    assert quarantine.count == 1
+    assert quarantine.responses == 0
+    entry, = quarantine.store.latest('source')
+    assert entry['job_id'] == 'job'
+    assert entry['stage'] == 'gather'
+    assert entry['guid'] == 'invalid'
+    assert entry['reason'] == 'Title is missing'
+    assert json.loads(entry['content']) == invalid
+
+
+def test_unreadable_pages_are_skipped():
+    pages = ['<html>'] * (MAX_MALFORMED_RESPONSES - 1) + \
+        [_page('a'), '{"Results": {}}', _page('b'), _page()]
+    guids, quarantine = _search(pages)
+    assert guids == ['a', 'b']
+    assert quarantine.responses == MAX_MALFORMED_RESPONSES
+    assert quarantine.store.counts() == {'source': MAX_MALFORMED_RESPONSES}
+    assert quarantine.store.latest('source')[0]['content'] == \
+        '{"Results": {}}'
+    assert quarantine.store.clear('source') == MAX_MALFORMED_RESPONSES
+    assert quarantine.store.counts() == {}
+
+
+def test_search_fails_after_unreadable_pages_in_a_row():
+    pages = ['<html>'] * MAX_MALFORMED_RESPONSES + [_page('a'), _page()]
+    try:
+        _search(pages)
+    except SearchError, e:
+        assert 'responses in a row' in '%s' % e
+    else:
+        assert False, 'SearchError not raised'
@@ -59,7 +59,7 @@ setup(
     # project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
-    install_requires=['beautifulsoup4'],
+    install_requires=[],
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
@@ -79,8 +79,11 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points='''
         [ckan.plugins]
+        sintef=ckanext.sintef.plugin:SintefPlugin
         geonorge_harvester=ckanext.sintef.harvesters.geonorgeharvester:GeonorgeHarvester
         datanorge_harvester=ckanext.sintef.harvesters.datanorgeharvester:DataNorgeHarvester
+        [paste.paster_command]
+        sintef=ckanext.sintef.commands:SintefCommand
 	[babel.extractors]
 	ckan = ckan.lib.extract:extract_ckan
     ''',